@@ -3,6 +3,7 @@
 from __future__ import annotations
 
 import argparse
+import concurrent.futures
 import configparser
 import contextlib
 import crypt
@@ -12,8 +13,7 @@ import dataclasses
 import datetime
 import errno
 import fcntl
-import glob
-import hashlib
+import functools
 import http.server
 import importlib
 import importlib.resources
@@ -34,6 +34,7 @@ import uuid
 from pathlib import Path
 from textwrap import dedent, wrap
 from typing import (
+    IO,
     TYPE_CHECKING,
     Any,
     BinaryIO,
@@ -55,7 +56,11 @@ from typing import (
 
 from mkosi.backend import (
     ARG_DEBUG,
+    OUTPUT_COMPRESSORS,
+    Checkpoint,
+    Compressor,
     Distribution,
+    ForkedCall,
     ManifestFormat,
     MkosiConfig,
     MkosiException,
@@ -66,6 +71,7 @@ from mkosi.backend import (
     SourceFileTransfer,
     Verb,
     chown_to_running_user,
+    close_workspace_sessions,
     detect_distribution,
     die,
     is_centos_variant,
@@ -75,29 +81,54 @@ from mkosi.backend import (
     nspawn_knows_arg,
     nspawn_rlimit_params,
     nspawn_version,
+    parse_compressor,
     patch_file,
     path_relative_to_cwd,
     run,
     run_workspace_command,
-    scandir_recursive,
     set_umask,
     should_compress_output,
     spawn,
     tmp_dir,
     warn,
 )
+from mkosi.bmap import scan_image, write_bmap
+from mkosi.cache import (
+    cache_components,
+    cache_fingerprint,
+    cache_miss_reason,
+    cache_sidecar,
+    cache_variants,
+    extra_trees_components,
+    write_cache_components,
+)
+from mkosi.checksum import copy_and_sha256, seed_sha256, sha256_file, sha256_files
+from mkosi.cpio import write_cpio
 from mkosi.install import (
     add_dropin_config,
     add_dropin_config_from_resource,
     copy_file,
     copy_file_object,
+    copy_files,
     copy_path,
+    flock_path,
     install_skeleton_trees,
     open_close,
+    sync_path,
 )
-from mkosi.manifest import Manifest
+from mkosi.manifest import Manifest, load_manifest, write_manifest_diff
 from mkosi.mounts import dissect_and_mount, mount_bind, mount_overlay, mount_tmpfs
-from mkosi.remove import unlink_try_hard
+from mkosi.probe import which
+from mkosi.remove import (
+    empty_directory,
+    remove_stale_trash,
+    unlink_in_background,
+    unlink_try_hard,
+    wait_for_trash,
+)
+from mkosi.scheduler import DependencyFailed, run_graph
+from mkosi.trace import Tracer
+from mkosi.walk import DiskUsageVisitor, GlobVisitor, walk_tree
 
 complete_step = MkosiPrinter.complete_step
 color_error = MkosiPrinter.color_error
@@ -121,7 +152,7 @@ PathString = Union[Path, str]
 
 MKOSI_COMMANDS_NEED_BUILD = (Verb.shell, Verb.boot, Verb.qemu, Verb.serve)
 MKOSI_COMMANDS_SUDO = (Verb.build, Verb.clean, Verb.shell, Verb.boot)
-MKOSI_COMMANDS_CMDLINE = (Verb.build, Verb.shell, Verb.boot, Verb.qemu, Verb.ssh)
+MKOSI_COMMANDS_CMDLINE = (Verb.build, Verb.shell, Verb.boot, Verb.qemu, Verb.ssh, Verb.manifest_diff)
 
 DRACUT_SYSTEMD_EXTRAS = [
     "/usr/bin/systemd-ask-password",
@@ -227,6 +258,20 @@ def btrfs_subvol_create(path: Path, mode: int = 0o755) -> None:
         run(["btrfs", "subvol", "create", path])
 
 
+# The inode number of the root directory of every btrfs subvolume.
+BTRFS_FIRST_FREE_OBJECTID = 256
+
+
+def btrfs_subvol_snapshot(src: Path, dst: Path) -> bool:
+    """Snapshot @src to @dst if @src is a btrfs subvolume, returns whether that worked"""
+    if src.stat().st_ino != BTRFS_FIRST_FREE_OBJECTID or dst.exists() or not which("btrfs"):
+        return False
+
+    c = run(["btrfs", "subvol", "snapshot", src, dst],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=False)
+    return c.returncode == 0
+
+
 def disable_cow(path: PathString) -> None:
     """Disable copy-on-write if applicable on filesystem"""
 
@@ -270,7 +315,7 @@ def mount_image(state: MkosiState, cached: bool) -> Iterator[None]:
                 base = stack.enter_context(dissect_and_mount(state.config.base_image, state.workspace / "base"))
 
             workdir = state.workspace / "workdir"
-            workdir.mkdir()
+            workdir.mkdir(exist_ok=True)
             stack.enter_context(mount_overlay(base, state.root, workdir, state.root))
         else:
             # always have a root of the tree as a mount point so we can recursively unmount anything that
@@ -325,14 +370,54 @@ def configure_hostname(state: MkosiState, cached: bool) -> None:
 @contextlib.contextmanager
 def mount_cache(state: MkosiState) -> Iterator[None]:
     cache_paths = state.installer.cache_path()
+    cache = state.workspace / "package-cache"
+    upper = state.workspace / "package-cache-upper"
+    workdir = state.workspace / "package-cache-workdir"
 
     # We can't do this in mount_image() yet, as /var itself might have to be created as a subvolume first
     with complete_step("Mounting Package Cache", "Unmounting Package Cache"), contextlib.ExitStack() as stack:
+        # The stages of a build and jobs built in parallel might share the same package cache. Each of them gets an
+        # overlayfs on top of it, so their package managers can run at the same time, and only merging what they
+        # downloaded back into the shared cache is serialized.
+        for d in (upper, workdir):
+            d.mkdir(mode=0o755, exist_ok=True)
+        stack.callback(merge_package_cache, upper, state.cache)
+        stack.enter_context(mount_overlay(state.cache, upper, workdir, cache))
         for cache_path in cache_paths:
-            stack.enter_context(mount_bind(state.cache, state.root / cache_path))
+            stack.enter_context(mount_bind(cache, state.root / cache_path))
         yield
 
 
+def merge_package_cache(upper: Path, cache: Path) -> None:
+    """Move the files package managers added to or changed in the overlayfs upper layer @upper into @cache
+
+    Files that already exist in @cache are replaced, as package managers
+    only change metadata they refreshed. Files are replaced atomically, so
+    package managers that use @cache as their lower layer in the meantime
+    never see partially copied files.
+    """
+    with flock_path(cache):
+        for dirpath, dirnames, filenames in os.walk(upper):
+            dest = cache / os.path.relpath(dirpath, upper)
+            dest.mkdir(mode=0o755, exist_ok=True)
+
+            # Symlinks to directories are listed as directories but not descended into.
+            links = [d for d in dirnames if os.path.islink(os.path.join(dirpath, d))]
+            dirnames[:] = [d for d in dirnames if d not in links]
+
+            for name in filenames + links:
+                try:
+                    os.replace(os.path.join(dirpath, name), dest / name)
+                except OSError as e:
+                    if e.errno != errno.EXDEV:
+                        raise
+                    tmp = dest / f".{name}.mkosi-merge"
+                    copy_file(os.path.join(dirpath, name), tmp)
+                    os.replace(tmp, dest / name)
+
+    shutil.rmtree(upper)
+
+
 def configure_dracut(state: MkosiState, cached: bool) -> None:
     if not state.config.bootable or state.do_run_build_script or cached:
         return
@@ -383,134 +468,85 @@ def prepare_tree(state: MkosiState, cached: bool) -> None:
         state.root.joinpath("etc/kernel/install.conf").write_text("layout=bls\n")
 
 
-def flatten(lists: Iterable[Iterable[T]]) -> List[T]:
-    """Flatten a sequence of sequences into a single list."""
-    return list(itertools.chain.from_iterable(lists))
-
-
-def clean_paths(
-        root: Path,
-        globs: Sequence[str],
-        tool: str,
-        always: bool) -> None:
-    """Remove globs under root if always or if tool is not found under root."""
-
-    toolp = root / tool.lstrip('/')
-    cond = always or not os.access(toolp, os.F_OK, follow_symlinks=False)
-
-    paths = flatten(root.glob(glob.lstrip('/')) for glob in globs)
-
-    if not cond or not paths:
-        return
-
-    with complete_step(f"Cleaning {toolp.name} metadata…"):
-        for path in paths:
-            unlink_try_hard(path)
-
-
-def clean_dnf_metadata(root: Path, always: bool) -> None:
-    """Remove dnf metadata if /bin/dnf is not present in the image
-
-    If dnf is not installed, there doesn't seem to be much use in keeping the
-    dnf metadata, since it's not usable from within the image anyway.
-    """
-    paths = [
+# Package manager metadata, keyed by the package manager binary. With CleanPackageMetadata=auto, metadata is only
+# removed if the package manager is not installed in the image: there doesn't seem to be much use in keeping it,
+# since it's not usable from within the image anyway.
+PACKAGE_MANAGER_METADATA = {
+    "/bin/dnf": [
         "/var/lib/dnf",
         "/var/log/dnf.*",
         "/var/log/hawkey.*",
         "/var/cache/dnf",
-    ]
-
-    clean_paths(root, paths, tool='/bin/dnf', always=always)
-
-
-def clean_yum_metadata(root: Path, always: bool) -> None:
-    """Remove yum metadata if /bin/yum is not present in the image"""
-    paths = [
+    ],
+    "/bin/yum": [
         "/var/lib/yum",
         "/var/log/yum.*",
         "/var/cache/yum",
-    ]
-
-    clean_paths(root, paths, tool='/bin/yum', always=always)
-
-
-def clean_rpm_metadata(root: Path, always: bool) -> None:
-    """Remove rpm metadata if /bin/rpm is not present in the image"""
-    paths = [
+    ],
+    "/bin/rpm": [
         "/var/lib/rpm",
         "/usr/lib/sysimage/rpm",
-    ]
-
-    clean_paths(root, paths, tool='/bin/rpm', always=always)
-
-
-def clean_apt_metadata(root: Path, always: bool) -> None:
-    """Remove apt metadata if /usr/bin/apt is not present in the image"""
-    paths = [
+    ],
+    "/usr/bin/apt": [
         "/var/lib/apt",
         "/var/log/apt",
         "/var/cache/apt",
-    ]
-
-    clean_paths(root, paths, tool='/usr/bin/apt', always=always)
-
-
-def clean_dpkg_metadata(root: Path, always: bool) -> None:
-    """Remove dpkg metadata if /usr/bin/dpkg is not present in the image"""
-    paths = [
+    ],
+    "/usr/bin/dpkg": [
         "/var/lib/dpkg",
         "/var/log/dpkg.log",
-    ]
-
-    clean_paths(root, paths, tool='/usr/bin/dpkg', always=always)
-
-
-def clean_pacman_metadata(root: Path, always: bool) -> None:
-    """Remove pacman metadata if /usr/bin/pacman is not present in the image"""
-    paths = [
+    ],
+    "/usr/bin/pacman": [
         "/var/lib/pacman",
         "/var/cache/pacman",
-        "/var/log/pacman.log"
-    ]
-
-    clean_paths(root, paths, tool='/usr/bin/pacman', always=always)
+        "/var/log/pacman.log",
+    ],
+    # FIXME: implement cleanup for other package managers: swupd
+}
 
 
-def clean_package_manager_metadata(state: MkosiState) -> None:
-    """Remove package manager metadata
+def package_manager_metadata_visitors(state: MkosiState) -> Dict[str, GlobVisitor]:
+    """Return visitors collecting the metadata of every package manager whose metadata should be removed
 
-    Try them all regardless of the distro: metadata is only removed if the
-    package manager is present in the image.
+    Try them all regardless of the distro: metadata will only be touched if
+    any of them are in the final image.
     """
 
     assert state.config.clean_package_metadata in (False, True, 'auto')
     if state.config.clean_package_metadata is False:
-        return
+        return {}
 
-    # we try then all: metadata will only be touched if any of them are in the
-    # final image
     always = state.config.clean_package_metadata is True
-    clean_dnf_metadata(state.root, always=always)
-    clean_yum_metadata(state.root, always=always)
-    clean_rpm_metadata(state.root, always=always)
-    clean_apt_metadata(state.root, always=always)
-    clean_dpkg_metadata(state.root, always=always)
-    clean_pacman_metadata(state.root, always=always)
-    # FIXME: implement cleanup for other package managers: swupd
+    visitors = {}
+    for tool, globs in PACKAGE_MANAGER_METADATA.items():
+        toolp = state.root / tool.lstrip('/')
+        if always or not os.access(toolp, os.F_OK, follow_symlinks=False):
+            visitors[toolp.name] = GlobVisitor(globs)
 
+    return visitors
 
-def remove_files(state: MkosiState) -> None:
-    """Remove files based on user-specified patterns"""
 
-    if not state.config.remove_files:
-        return
+def clean_image_tree(state: MkosiState) -> None:
+    """Remove package manager metadata and files matching RemoveFiles= patterns
 
-    with complete_step("Removing files…"):
-        # Note: Path('/foo') / '/bar' == '/bar'. We need to strip the slash.
-        # https://bugs.python.org/issue44452
-        paths = [state.root / str(p).lstrip("/") for p in state.config.remove_files]
-        remove_glob(*paths)
+    Both are collected in a single walk of the image tree, which only
+    descends into the directories that the patterns can match in.
+    """
+
+    metadata = package_manager_metadata_visitors(state)
+    remove = GlobVisitor([str(p) for p in state.config.remove_files])
+    walk_tree(state.root, [*metadata.values(), remove])
+
+    for tool, visitor in metadata.items():
+        if visitor.matches:
+            with complete_step(f"Cleaning {tool} metadata…"):
+                for path in visitor.matches:
+                    unlink_try_hard(state.root / path)
+
+    if state.config.remove_files:
+        with complete_step("Removing files…"):
+            for path in remove.matches:
+                unlink_try_hard(state.root / path)
 
 
 def link_rpm_db(root: Path) -> None:
@@ -715,6 +751,9 @@ def nspawn_params_for_build_sources(config: MkosiConfig, sft: SourceFileTransfer
     if sft == SourceFileTransfer.mount:
         idmap_opt = ":rootidmap" if nspawn_id_map_supported() and config.idmap else ""
         params += [f"--bind={config.build_sources}:/root/src{idmap_opt}"]
+    elif sft == SourceFileTransfer.sync:
+        idmap_opt = ":rootidmap" if nspawn_id_map_supported() and config.idmap else ""
+        params += [f"--bind={source_snapshot_path(config)}:/root/src{idmap_opt}"]
 
     return params
 
@@ -807,60 +846,45 @@ def install_extra_trees(state: MkosiState) -> None:
                 shutil.unpack_archive(cast(str, tree), state.root)
 
 
-def copy_git_files(src: Path, dest: Path, *, source_file_transfer: SourceFileTransfer) -> None:
-    what_files = ["--exclude-standard", "--cached"]
-    if source_file_transfer == SourceFileTransfer.copy_git_others:
-        what_files += ["--others", "--exclude=.mkosi-*"]
-
+def git_ls_files(src: Path, *args: PathString) -> Iterator[str]:
+    """Yield the paths printed by git ls-files while it is still running"""
     uid = int(os.getenv("SUDO_UID", 0))
 
-    c = run(["git", "-C", src, "ls-files", "-z", *what_files], stdout=subprocess.PIPE, text=False, user=uid)
-    files: Set[str] = {x.decode("utf-8") for x in c.stdout.rstrip(b"\0").split(b"\0")}
+    with spawn(["git", "-C", src, "ls-files", "-z", *args], stdout=subprocess.PIPE, user=uid) as p:
+        assert p.stdout is not None
+        rest = b""
+        for chunk in iter(lambda: cast(BinaryIO, p.stdout).read(64 * 1024), b""):
+            *paths, rest = (rest + chunk).split(b"\0")
+            yield from (os.fsdecode(x) for x in paths)
 
-    # Add the .git/ directory in as well.
-    if source_file_transfer == SourceFileTransfer.copy_git_more:
-        top = os.path.join(src, ".git/")
-        for path, _, filenames in os.walk(top):
-            for filename in filenames:
-                fp = os.path.join(path, filename)  # full path
-                fr = os.path.join(".git/", fp[len(top) :])  # relative to top
-                files.add(fr)
-
-    # Get submodule files
-    c = run(["git", "-C", src, "submodule", "status", "--recursive"], stdout=subprocess.PIPE, text=True, user=uid)
-    submodules = {x.split()[1] for x in c.stdout.splitlines()}
-
-    # workaround for git ls-files returning the path of submodules that we will
-    # still parse
-    files -= submodules
-
-    for sm in submodules:
-        sm = Path(sm)
-        c = run(
-            ["git", "-C", src / sm, "ls-files", "-z"] + what_files,
-            stdout=subprocess.PIPE,
-            text=False,
-            user=uid,
-        )
-        files |= {sm / x.decode("utf-8") for x in c.stdout.rstrip(b"\0").split(b"\0")}
-        files -= submodules
+    if p.returncode != 0:
+        die(f"git ls-files failed in {src} with exit code {p.returncode}.")
 
-        # Add the .git submodule file well.
-        if source_file_transfer == SourceFileTransfer.copy_git_more:
-            files.add(os.path.join(sm, ".git"))
 
-    del c
+def copy_git_files(src: Path, dest: Path, *, source_file_transfer: SourceFileTransfer) -> None:
+    # A single git ls-files invocation lists the tracked files of the repository and of all its submodules. Files
+    # are copied while they are listed.
+    paths: List[Iterable[str]] = [git_ls_files(src, "--cached", "--recurse-submodules")]
+
+    if source_file_transfer in (SourceFileTransfer.copy_git_others, SourceFileTransfer.copy_git_more):
+        uid = int(os.getenv("SUDO_UID", 0))
+        c = run(["git", "-C", src, "submodule", "status", "--recursive"], stdout=subprocess.PIPE, text=True, user=uid)
+        submodules = [x.split()[1] for x in c.stdout.splitlines()]
+    else:
+        submodules = []
 
-    for path in files:
-        src_path = src / path
-        dest_path = dest / path
+    if source_file_transfer == SourceFileTransfer.copy_git_others:
+        # --recurse-submodules can't be combined with --others, so untracked files of submodules have to be
+        # listed for each submodule separately.
+        others = ["--others", "--exclude-standard", "--exclude=.mkosi-*"]
+        paths += [git_ls_files(src, *others)]
+        paths += [(os.path.join(sm, x) for x in git_ls_files(src / sm, *others)) for sm in submodules]
 
-        dest_path.parent.mkdir(parents=True, exist_ok=True)
+    if source_file_transfer == SourceFileTransfer.copy_git_more:
+        # Add the .git/ directory in as well, as well as the .git files of the submodules pointing into it.
+        paths += [[".git"], [os.path.join(sm, ".git") for sm in submodules]]
 
-        if src_path.is_dir():
-            copy_path(src_path, dest_path)
-        else:
-            copy_file(src_path, dest_path)
+    copy_files(src, dest, itertools.chain.from_iterable(paths))
 
 
 def install_build_src(state: MkosiState) -> None:
@@ -886,6 +910,13 @@ def install_build_src(state: MkosiState) -> None:
     if sft is None:
         return
 
+    if sft == SourceFileTransfer.sync:
+        snapshot = source_snapshot_path(state.config)
+        with complete_step("Synchronizing sources…", f"Synchronized sources to {path_relative_to_cwd(snapshot)}"):
+            sync_path(state.config.build_sources, snapshot, source_snapshot_index(state.config),
+                      ignore=source_ignore(state.config))
+        return
+
     with complete_step("Copying in sources…"):
         target = state.root / "root/src"
 
@@ -896,19 +927,62 @@ def install_build_src(state: MkosiState) -> None:
         ):
             copy_git_files(state.config.build_sources, target, source_file_transfer=sft)
         elif sft == SourceFileTransfer.copy_all:
-            ignore = shutil.ignore_patterns(
-                ".git",
-                ".mkosi-*",
-                "*.cache-pre-dev",
-                "*.cache-pre-inst",
-                f"{state.config.output_dir.name}/" if state.config.output_dir else "mkosi.output/",
-                f"{state.config.workspace_dir.name}/" if state.config.workspace_dir else "mkosi.workspace/",
-                f"{state.config.cache_path.name}/" if state.config.cache_path else "mkosi.cache/",
-                f"{state.config.build_dir.name}/" if state.config.build_dir else "mkosi.builddir/",
-                f"{state.config.include_dir.name}/" if state.config.include_dir else "mkosi.includedir/",
-                f"{state.config.install_dir.name}/" if state.config.install_dir else "mkosi.installdir/",
-            )
-            shutil.copytree(state.config.build_sources, target, symlinks=not resolve_symlinks, ignore=ignore)
+            shutil.copytree(state.config.build_sources, target, symlinks=not resolve_symlinks,
+                            ignore=source_ignore(state.config))
+
+
+def source_ignore(config: MkosiConfig) -> Callable[[str, List[str]], Set[str]]:
+    """Return a function for the ignore argument of shutil.copytree() that leaves out what never goes into the image
+
+    Patterns for files mkosi creates apply at every depth of the build
+    sources, while the directories mkosi uses are only left out at the top
+    level, so directories that happen to have the same name deeper down in
+    the sources are still copied.
+    """
+    patterns = shutil.ignore_patterns(
+        ".git",
+        ".mkosi-*",
+        "*.cache-pre-dev",
+        "*.cache-pre-inst",
+        f"{source_snapshot_path(config).name}*",
+    )
+    root = os.path.normpath(config.build_sources.absolute())
+    directories = set()
+    for path, default in (
+        (config.output_dir, "mkosi.output"),
+        (config.workspace_dir, "mkosi.workspace"),
+        (config.cache_path, "mkosi.cache"),
+        (config.build_dir, "mkosi.builddir"),
+        (config.include_dir, "mkosi.includedir"),
+        (config.install_dir, "mkosi.installdir"),
+    ):
+        if path is None:
+            directories.add(default)
+            continue
+        # Configured directories may be nested, e.g. the output directory gets a subdirectory per distribution,
+        # so leave out the top level directory of the sources that contains them, if any.
+        relative = os.path.relpath(os.path.normpath(path.absolute()), root)
+        if relative != "." and not relative.startswith(".."):
+            directories.add(relative.split(os.sep)[0])
+
+    def ignore(path: str, names: List[str]) -> Set[str]:
+        ignored = set(patterns(path, names))
+        if os.path.normpath(os.path.abspath(path)) == root:
+            ignored |= directories.intersection(names)
+        return ignored
+
+    return ignore
+
+
+def source_snapshot_path(config: MkosiConfig) -> Path:
+    """Return the path of the persistent copy of the build sources used by SourceFileTransfer=sync"""
+    prefix = cache_tree_prefix(config)
+    return prefix.with_name(f"{prefix.name}.src-cache")
+
+
+def source_snapshot_index(config: MkosiConfig) -> Path:
+    snapshot = source_snapshot_path(config)
+    return snapshot.with_name(f"{snapshot.name}.json")
 
 
 def install_build_dest(state: MkosiState) -> None:
@@ -925,18 +999,87 @@ def install_build_dest(state: MkosiState) -> None:
 
 
 def xz_binary() -> str:
-    return "pxz" if shutil.which("pxz") else "xz"
+    return "pxz" if which("pxz") else "xz"
+
+
+def output_compressor(config: MkosiConfig) -> Optional[Compressor]:
+    compress = should_compress_output(config)
+    if not compress:
+        return None
+
+    try:
+        return parse_compressor(str(compress))
+    except ValueError as e:
+        die(str(e))
+
 
+def compressor_command(compressor: Compressor, src: Optional[Path] = None) -> List[PathString]:
+    """Returns a command suitable for compressing archives.
 
-def compressor_command(option: Union[str, bool], src: Path) -> List[PathString]:
-    """Returns a command suitable for compressing archives."""
+    Without @src, the command compresses its standard input to its standard output.
+    """
 
-    if option == "xz":
-        return [xz_binary(), "--check=crc32", "--lzma2=dict=1MiB", "-T0", src]
-    elif option == "zstd":
-        return ["zstd", "-15", "-q", "-T0", "--rm", src]
+    cmd: List[PathString]
+    if compressor.algorithm == "xz":
+        cmd = [xz_binary(), "--check=crc32", f"-T{compressor.threads}"]
+        # Without an explicit level, stick to a small dictionary, which keeps decompression cheap.
+        cmd += [f"-{compressor.level}"] if compressor.level is not None else ["--lzma2=dict=1MiB"]
+    elif compressor.algorithm == "zstd":
+        level = compressor.level if compressor.level is not None else 15
+        cmd = ["zstd", f"-{level}", "-q", f"-T{compressor.threads}"]
+        if level > 19:
+            cmd += ["--ultra"]
+        if compressor.long is not None:
+            cmd += [f"--long={compressor.long}" if compressor.long else "--long"]
+        if src:
+            cmd += ["--rm"]
     else:
-        die(f"Unknown compression {option}")
+        assert src is not None
+        if not which("t2sz"):
+            die("t2sz is required for zstd-seekable compression")
+
+        level = compressor.level if compressor.level is not None else 15
+        threads = compressor.threads or os.cpu_count() or 1
+        return ["t2sz", "-r", "-f", "-l", str(level), "-T", str(threads), "-o", f"{src}{compressor.suffix}", src]
+
+    return cmd + [src] if src else cmd + ["-c"]
+
+
+@contextlib.contextmanager
+def open_output_stream(config: MkosiConfig, path: Path) -> Iterator[IO[bytes]]:
+    """Yield a stream an archiver should write @path to
+
+    If the output should be compressed, the stream is piped straight into the
+    compressor, whose output is written to @path with the compression suffix
+    appended and hashed on the way, so the uncompressed archive never hits the
+    disk and the compressed one doesn't have to be read again for SHA256SUMS.
+    """
+    compressor = output_compressor(config)
+    if not compressor or not compressor.streamable:
+        # compress_output() takes care of compressors that need the complete file.
+        with path.open("wb") as f:
+            yield f
+        return
+
+    dst = path.with_name(path.name + compressor.suffix)
+
+    with dst.open("wb") as f, \
+         spawn(compressor_command(compressor), stdin=subprocess.PIPE, stdout=subprocess.PIPE) as proc, \
+         concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        assert proc.stdin is not None and proc.stdout is not None
+
+        digest = executor.submit(copy_and_sha256, proc.stdout, f)
+        try:
+            yield proc.stdin
+        finally:
+            # Close our end of the pipe, so the compressor sees EOF once the archiver is done.
+            proc.stdin.close()
+        digest.result()
+
+    if proc.returncode != 0:
+        die(f"Failed to compress {path}")
+
+    seed_sha256(dst, digest.result())
 
 
 def tar_binary() -> str:
@@ -947,7 +1090,7 @@ def tar_binary() -> str:
     # everywhere. In particular given the limited/different SELinux
     # support in BSD tar and the different command line syntax
     # compared to GNU tar.
-    return "gtar" if shutil.which("gtar") else "tar"
+    return "gtar" if which("gtar") else "tar"
 
 
 def make_tar(state: MkosiState) -> None:
@@ -962,16 +1105,22 @@ def make_tar(state: MkosiState) -> None:
     if state.config.tar_strip_selinux_context:
         cmd += ["--xattrs-exclude=security.selinux"]
 
-    cmd += [".", "-f", state.staging / state.config.output.name]
+    cmd += [".", "-f", "-"]
 
-    with complete_step("Creating archive…"):
-        run(cmd)
+    with complete_step("Creating archive…"), \
+         open_output_stream(state.config, state.staging / state.config.output.name) as f:
+        run(cmd, stdout=f)
 
 
-def find_files(root: Path) -> Iterator[Path]:
-    """Generate a list of all filepaths relative to @root"""
-    yield from scandir_recursive(root,
-                                 lambda entry: Path(entry.path).relative_to(root))
+def source_date_epoch(state: MkosiState) -> Optional[int]:
+    value = state.environment.get("SOURCE_DATE_EPOCH", os.environ.get("SOURCE_DATE_EPOCH"))
+    if value is None:
+        return None
+
+    try:
+        return int(value)
+    except ValueError:
+        die(f"Invalid SOURCE_DATE_EPOCH={value}")
 
 
 def make_cpio(state: MkosiState) -> None:
@@ -982,21 +1131,9 @@ def make_cpio(state: MkosiState) -> None:
     if state.for_cache:
         return
 
-    with complete_step("Creating archive…"), open(state.staging / state.config.output.name, "wb") as f:
-        files = find_files(state.root)
-        cmd: List[PathString] = [
-            "cpio", "-o", "--reproducible", "--null", "-H", "newc", "--quiet", "-D", state.root
-        ]
-
-        with spawn(cmd, stdin=subprocess.PIPE, stdout=f) as cpio:
-            #  https://github.com/python/mypy/issues/10583
-            assert cpio.stdin is not None
-
-            for file in files:
-                cpio.stdin.write(os.fspath(file).encode("utf8") + b"\0")
-            cpio.stdin.close()
-        if cpio.wait() != 0:
-            die("Failed to create archive")
+    with complete_step("Creating archive…"), \
+         open_output_stream(state.config, state.staging / state.config.output.name) as f:
+        write_cpio(f, state.root, mtime_clamp=source_date_epoch(state))
 
 
 def make_directory(state: MkosiState) -> None:
@@ -1238,19 +1375,24 @@ def extract_kernel_image_initrd(state: MkosiState) -> None:
     copy_file(initrd, state.staging / state.config.output_split_initrd.name)
 
 
-def compress_output(config: MkosiConfig, src: Path) -> None:
-    compress = should_compress_output(config)
+def compress_output(config: MkosiConfig, src: Path) -> Path:
+    """Compress @src if configured and return the path of the result"""
+    compressor = output_compressor(config)
 
-    if not src.is_file():
-        return
+    if not src.is_file() or not compressor:
+        return src
 
-    if not compress:
-        # If we shan't compress, then at least make the output file sparse
-        with complete_step(f"Digging holes into output file {src}…"):
-            run(["fallocate", "--dig-holes", src])
-    else:
-        with complete_step(f"Compressing output file {src}…"):
-            run(compressor_command(compress, src))
+    if src.name.endswith(compressor.suffix):
+        # Already compressed while it was written, see open_output_stream().
+        return src
+
+    with complete_step(f"Compressing output file {src}…"):
+        run(compressor_command(compressor, src))
+        if src.exists():
+            # Unlike xz and zstd, t2sz keeps its input around.
+            src.unlink()
+
+    return src.with_name(src.name + compressor.suffix)
 
 
 def qcow2_output(state: MkosiState) -> None:
@@ -1275,19 +1417,6 @@ def copy_nspawn_settings(state: MkosiState) -> None:
         copy_file(state.config.nspawn_settings, state.staging / state.config.output_nspawn_settings.name)
 
 
-def hash_file(of: TextIO, path: Path) -> None:
-    bs = 16 * 1024**2
-    h = hashlib.sha256()
-
-    with path.open("wb") as sf:
-        buf = sf.read(bs)
-        while len(buf) > 0:
-            h.update(buf)
-            buf = sf.read(bs)
-
-    of.write(h.hexdigest() + " *" + path.name + "\n")
-
-
 def calculate_sha256sum(state: MkosiState) -> None:
     if state.config.output_format in (OutputFormat.directory, OutputFormat.subvolume):
         return None
@@ -1296,9 +1425,11 @@ def calculate_sha256sum(state: MkosiState) -> None:
         return None
 
     with complete_step("Calculating SHA256SUMS…"):
+        digests = sha256_files(sorted(state.staging.iterdir()))
+
         with open(state.workspace / state.config.output_checksum.name, "w") as f:
-            for p in state.staging.iterdir():
-                hash_file(f, p)
+            for p, digest in digests.items():
+                f.write(f"{digest} *{p.name}\n")
 
         os.rename(state.workspace / state.config.output_checksum.name, state.staging / state.config.output_checksum.name)
 
@@ -1321,63 +1452,152 @@ def calculate_signature(state: MkosiState) -> None:
         run(cmdline)
 
 
-def calculate_bmap(state: MkosiState) -> None:
-    if not state.config.bmap:
-        return
+def compressed_outputs(state: MkosiState) -> List[Path]:
+    """Return the files in the staging directory that compress_output() is applied to"""
+    config = state.config
+    names = {p.name for p in config.output_paths()}
+    return [
+        p for p in sorted(state.staging.iterdir())
+        if p.name in (config.output.name, config.output_split_kernel.name) or
+        (p.name.startswith(config.output.name) and p.name not in names)
+    ]
 
-    if not state.config.output_format == OutputFormat.disk:
+
+def finalize_output(config: MkosiConfig, src: Path, bmap: Optional[Path] = None) -> None:
+    """Compress or sparsify @src, write its block map to @bmap and hash the result
+
+    Uncompressed files are read only once: a single pass over their data
+    digs holes into them, computes their block map and their digest. If
+    the file is compressed, the block map of the uncompressed file is
+    computed before compressing it, which is what bmaptool expects, and the
+    compressed file is hashed afterwards.
+    """
+    compressor = output_compressor(config)
+
+    if not src.is_file() or (compressor and src.name.endswith(compressor.suffix)):
         return
 
-    with complete_step("Creating BMAP file…"):
-        cmdline: List[PathString] = [
-            "bmaptool",
-            "create",
-            "--output", state.staging / state.config.output_bmap.name,
-            state.staging / state.config.output.name,
-        ]
+    if not compressor:
+        # If we shan't compress, then at least make the output file sparse
+        with complete_step(f"Digging holes into output file {src}…"):
+            scan = scan_image(src, punch_holes=True, checksum=config.checksum)
+            if scan.sha256 is not None:
+                seed_sha256(src, scan.sha256)
+    elif bmap is not None:
+        scan = scan_image(src)
 
-        run(cmdline)
+    if bmap is not None:
+        with complete_step("Creating BMAP file…"):
+            with bmap.open("w") as f:
+                write_bmap(scan, f)
+
+    dst = compress_output(config, src)
+
+    if config.checksum and compressor:
+        # Hash the final file right away, while it's likely still in the page cache. calculate_sha256sum() picks
+        # up the digest later on.
+        sha256_file(dst)
+
+
+def postprocess_output(state: MkosiState, manifest: Manifest, previous_manifest: Optional[Dict[str, Any]]) -> None:
+    """Turn the assembled image into the final output files
+
+    The steps are run concurrently as a dependency graph: every output file
+    is compressed and hashed as soon as nothing modifies it anymore, and
+    the manifest is written meanwhile. SHA256SUMS is written once all files
+    are final, as it covers all of them.
+    """
+    steps: Dict[str, Tuple[Callable[[], None], List[str]]] = {
+        "qcow2": (functools.partial(qcow2_output, state), []),
+        "nspawn-settings": (functools.partial(copy_nspawn_settings, state), []),
+        "manifest": (functools.partial(save_manifest, state, manifest, previous_manifest), []),
+    }
+
+    for p in compressed_outputs(state):
+        bmap = None
+        deps = []
+        if p.name == state.config.output.name:
+            # The image is converted to qcow2 in place, so that has to come first.
+            deps = ["qcow2"]
+            if state.config.bmap and state.config.output_format == OutputFormat.disk:
+                bmap = state.staging / state.config.output_bmap.name
+
+        steps[f"compress {p.name}"] = (functools.partial(finalize_output, state.config, p, bmap), deps)
+
+    steps["sha256sums"] = (functools.partial(calculate_sha256sum, state), list(steps))
+    steps["signature"] = (functools.partial(calculate_signature, state), ["sha256sums"])
+
+    graph = {name: deps for name, (_, deps) in steps.items()}
+    # Steps started by the workers are nested below the current one.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(steps), initializer=MkosiPrinter.set_level,
+                                               initargs=(MkosiPrinter.level(),)) as executor:
+        results = run_graph(graph, lambda name: steps[name][0](), executor)
+
+    for e in results.values():
+        if e is not None and not isinstance(e, DependencyFailed):
+            raise e
 
 
 def save_cache(state: MkosiState) -> None:
-    cache = cache_tree_path(state.config, is_final_image=False) if state.do_run_build_script else cache_tree_path(state.config, is_final_image=True)
+    components = cache_components(state.config, is_final_image=not state.do_run_build_script)
+    cache = cache_tree_path(state.config, is_final_image=not state.do_run_build_script)
 
     with complete_step("Installing cache copy…", f"Installed cache copy {path_relative_to_cwd(cache)}"):
-        unlink_try_hard(cache)
+        unlink_in_background(cache)
         shutil.move(cast(str, state.root), cache)  # typing bug, .move() accepts Path
+        write_cache_components(cache, components)
 
     if state.config.chown:
         chown_to_running_user(cache)
+        chown_to_running_user(cache_sidecar(cache))
 
 
 def dir_size(path: PathString) -> int:
-    dir_sum = 0
-    for entry in os.scandir(path):
-        if entry.is_symlink():
-            # We can ignore symlinks because they either point into our tree,
-            # in which case we'll include the size of target directory anyway,
-            # or outside, in which case we don't need to.
-            continue
-        elif entry.is_file():
-            dir_sum += entry.stat().st_blocks * 512
-        elif entry.is_dir():
-            dir_sum += dir_size(entry.path)
-    return dir_sum
+    visitor = DiskUsageVisitor()
+    walk_tree(Path(path), [visitor])
+    return visitor.size
 
 
-def save_manifest(state: MkosiState, manifest: Manifest) -> None:
+def save_manifest(state: MkosiState, manifest: Manifest, previous: Optional[Dict[str, Any]]) -> None:
     if manifest.has_data():
         if ManifestFormat.json in state.config.manifest_format:
             with complete_step(f"Saving manifest {state.config.output_manifest.name}"):
                 with open(state.staging / state.config.output_manifest.name, 'w') as f:
                     manifest.write_json(f)
 
+            if previous is not None:
+                with complete_step(f"Saving manifest diff {state.config.output_manifest_diff.name}"):
+                    with open(state.staging / state.config.output_manifest_diff.name, 'w') as f:
+                        write_manifest_diff(previous, manifest.as_dict(), f)
+
         if ManifestFormat.changelog in state.config.manifest_format:
             with complete_step(f"Saving report {state.config.output_changelog.name}"):
                 with open(state.staging / state.config.output_changelog.name, 'w') as f:
                     manifest.write_package_report(f)
 
 
+def show_manifest_diff(config: MkosiConfig) -> None:
+    """Print the changes between two manifests, or those of the last build if none are given"""
+    if len(config.cmdline) > 2:
+        die("manifest-diff takes at most two manifests")
+
+    if not config.cmdline:
+        if not config.output_manifest_diff.exists():
+            die(f"{path_relative_to_cwd(config.output_manifest_diff)} does not exist, build the image twice first")
+
+        sys.stdout.write(config.output_manifest_diff.read_text())
+        return
+
+    paths = [Path(p) for p in config.cmdline] + [config.output_manifest]
+    old, new = load_manifest(paths[0]), load_manifest(paths[1])
+    if old is None:
+        die(f"Failed to load manifest {paths[0]}")
+    if new is None:
+        die(f"Failed to load manifest {paths[1]}")
+
+    write_manifest_diff(old, new, sys.stdout)
+
+
 def print_output_size(config: MkosiConfig) -> None:
     if not config.output.exists():
         return
@@ -1566,7 +1786,7 @@ def parse_sign_expected_pcr(value: Union[bool, str]) -> bool:
             # a regular import trips pyflakes, though and I haven't found a way
             # to silence that
             importlib.import_module("cryptography") # type: ignore
-            return True if shutil.which('systemd-measure') else False
+            return True if which('systemd-measure') else False
         except ImportError:
             return False
 
@@ -1577,7 +1797,7 @@ def parse_sign_expected_pcr(value: Union[bool, str]) -> bool:
         except ImportError:
             die("Couldn't import the cryptography Python module. This is needed for the --sign-expected-pcr option.")
 
-        if not shutil.which('systemd-measure'):
+        if not which('systemd-measure'):
             die("Couldn't find systemd-measure binary. It is needed for the --sign-expected-pcr option.")
 
     return val
@@ -1742,6 +1962,12 @@ COMPRESSION_ALGORITHMS = "zlib", "lzo", "zstd", "lz4", "xz"
 def parse_compression(value: str) -> Union[str, bool]:
     if value in COMPRESSION_ALGORITHMS:
         return value
+    if value.partition(":")[0] in OUTPUT_COMPRESSORS:
+        try:
+            parse_compressor(value)
+        except ValueError as e:
+            raise argparse.ArgumentTypeError(str(e))
+        return value
     return parse_boolean(value)
 
 
@@ -1802,6 +2028,7 @@ USAGE = """
        mkosi [options...] {b}serve{e}
        mkosi [options...] {b}bump{e}
        mkosi [options...] {b}genkey{e}
+       mkosi [options...] {b}manifest-diff{e} [old manifest] [new manifest]
        mkosi [options...] {b}help{e}
        mkosi -h | --help
        mkosi --version
@@ -1972,7 +2199,7 @@ def create_parser() -> ArgumentParserMkosi:
         "--compress-output",
         type=parse_compression,
         nargs="?",
-        metavar="ALG",
+        metavar="ALG[:OPTIONS]",
         help="Enable whole-output compression (with images or archives)",
     )
     group.add_argument(
@@ -2016,6 +2243,14 @@ def create_parser() -> ArgumentParserMkosi:
         action=BooleanAction,
         help="When using incremental mode, build the initrd in the cache image and don't rebuild it in the final image",
     )
+    group.add_argument(
+        "--checkpoints",
+        metavar="CHECKPOINT",
+        action=CommaDelimitedListAction,
+        type=cast(Callable[[str], Checkpoint], Checkpoint.parse_list),
+        default=[],
+        help="When using incremental mode, cache the image at these additional points of the build",
+    )
     group.add_argument(
         "--split-artifacts",
         metavar="BOOL",
@@ -2028,6 +2263,12 @@ def create_parser() -> ArgumentParserMkosi:
         dest="repart_dir",
         help="Directory containing systemd-repart partition definitions",
     )
+    group.add_argument(
+        "--trace",
+        metavar="BOOL",
+        action=BooleanAction,
+        help="Write a Chrome trace of all build steps next to the output",
+    )
 
     group = parser.add_argument_group("Content options")
     group.add_argument(
@@ -2199,6 +2440,12 @@ def create_parser() -> ArgumentParserMkosi:
         type=script_path,
         metavar="PATH",
     )
+    group.add_argument(
+        "--pipeline-build",
+        metavar="BOOL",
+        action=BooleanAction,
+        help="Prepare the final image while the build script runs",
+    )
     group.add_argument(
         "--prepare-script",
         help="Prepare script to run inside the image before it is cached",
@@ -2235,7 +2482,7 @@ def create_parser() -> ArgumentParserMkosi:
         default=None,
         help='\n'.join(('How to copy build sources to the final image:',
                         *(f"'{k}': {v}" for k, v in SourceFileTransfer.doc().items()
-                          if k != SourceFileTransfer.mount),
+                          if k not in (SourceFileTransfer.mount, SourceFileTransfer.sync)),
                         '(default: None)')),
     )
     group.add_argument(
@@ -2352,6 +2599,12 @@ def create_parser() -> ArgumentParserMkosi:
         action=BooleanAction,
         help="If specified, underlying systemd-nspawn containers use the resources of the current unit.",
     )
+    group.add_argument(
+        "--workspace-session",
+        metavar="BOOL",
+        action=BooleanAction,
+        help="Run all commands in the image of a build phase in a single container",
+    )
     group.add_argument(
         "--qemu-boot",
         help="Configure which qemu boot protocol to use",
@@ -2448,6 +2701,20 @@ def create_parser() -> ArgumentParserMkosi:
         dest="all_directory",
         help="Specify path to directory to read settings files from",
     )
+    group.add_argument(
+        "-j", "--jobs",
+        metavar="JOBS",
+        type=int,
+        default=1,
+        help="Number of settings files from mkosi.files/ to build in parallel",
+    )
+    group.add_argument(
+        "--dependencies",
+        action=CommaDelimitedListAction,
+        default=[],
+        metavar="JOB",
+        help="Settings files in mkosi.files/ that have to be built before this one",
+    )
     group.add_argument(
         "-B",
         "--auto-bump",
@@ -2510,7 +2777,7 @@ def parse_args(argv: Optional[Sequence[str]] = None) -> Dict[str, argparse.Names
     # a parameter with nargs='?'. For example mkosi -i summary would be treated as -i=summary.
     for verb in Verb:
         try:
-            v_i = argv.index(verb.name)
+            v_i = argv.index(verb.value)
         except ValueError:
             continue
 
@@ -2645,54 +2912,49 @@ def parse_bytes(num_bytes: Optional[str], *, sector_size: int = 512) -> int:
     return result
 
 
-def remove_glob(*patterns: PathString) -> None:
-    pathgen = (glob.glob(str(pattern)) for pattern in patterns)
-    paths: Set[str] = set(sum(pathgen, []))  # uniquify
-    for path in paths:
-        unlink_try_hard(Path(path))
-
-
-def empty_directory(path: Path) -> None:
-    try:
-        for f in os.listdir(path):
-            unlink_try_hard(path / f)
-    except FileNotFoundError:
-        pass
-
-
 def unlink_output(config: MkosiConfig) -> None:
+    # Removals that were still pending when an earlier run crashed left their trash directories behind next to
+    # what was removed.
+    dirs = [config.output.parent, config.output_split_kernel.parent, cache_tree_prefix(config).parent]
+    dirs += [d.parent for d in (config.build_dir, config.include_dir, config.install_dir, config.cache_path) if d]
+    remove_stale_trash(d for d in remove_duplicates(dirs) if d.exists())
+
     if not config.skip_final_phase:
         with complete_step("Removing output files…"):
             if config.output.parent.exists():
                 for p in config.output.parent.iterdir():
                     if p.name.startswith(config.output.name) and "cache" not in p.name:
-                        unlink_try_hard(p)
-            unlink_try_hard(f"{config.output}.manifest")
-            unlink_try_hard(f"{config.output}.changelog")
+                        unlink_in_background(p)
+            unlink_in_background(f"{config.output}.manifest")
+            unlink_in_background(f"{config.output}.changelog")
+            unlink_in_background(config.output_manifest_diff)
 
             if config.checksum:
-                unlink_try_hard(config.output_checksum)
+                unlink_in_background(config.output_checksum)
 
             if config.sign:
-                unlink_try_hard(config.output_signature)
+                unlink_in_background(config.output_signature)
 
             if config.bmap:
-                unlink_try_hard(config.output_bmap)
+                unlink_in_background(config.output_bmap)
 
             if config.output_split_kernel.parent.exists():
                 for p in config.output_split_kernel.parent.iterdir():
                     if p.name.startswith(config.output_split_kernel.name):
-                        unlink_try_hard(p)
-            unlink_try_hard(config.output_split_kernel)
-            unlink_try_hard(config.output_split_kernel_image)
-            unlink_try_hard(config.output_split_initrd)
-            unlink_try_hard(config.output_split_cmdline)
+                        unlink_in_background(p)
+            unlink_in_background(config.output_split_kernel)
+            unlink_in_background(config.output_split_kernel_image)
+            unlink_in_background(config.output_split_initrd)
+            unlink_in_background(config.output_split_cmdline)
 
             if config.nspawn_settings is not None:
-                unlink_try_hard(config.output_nspawn_settings)
+                unlink_in_background(config.output_nspawn_settings)
 
         if config.ssh and config.output_sshkey is not None:
-            unlink_try_hard(config.output_sshkey)
+            unlink_in_background(config.output_sshkey)
+
+        if config.trace:
+            unlink_in_background(config.output_trace)
 
     # We remove any cached images if either the user used --force
     # twice, or he/she called "clean" with it passed once. Let's also
@@ -2708,8 +2970,18 @@ def unlink_output(config: MkosiConfig) -> None:
 
     if remove_build_cache:
         with complete_step("Removing incremental cache files…"):
-            unlink_try_hard(cache_tree_path(config, is_final_image=False))
-            unlink_try_hard(cache_tree_path(config, is_final_image=True))
+            prefix = cache_tree_prefix(config)
+            for is_final_image in (False, True):
+                suffix = cache_tree_suffix(is_final_image)
+                # Cache trees from before fingerprints were added to their names.
+                unlink_in_background(f"{prefix}.{suffix}")
+                suffixes = [suffix] + [checkpoint_suffix(is_final_image, c) for c in Checkpoint]
+                for p in itertools.chain.from_iterable(cache_variants(prefix, s) for s in suffixes):
+                    unlink_in_background(p)
+                    unlink_in_background(cache_sidecar(p))
+
+            unlink_in_background(source_snapshot_path(config))
+            unlink_in_background(source_snapshot_index(config))
 
         if config.build_dir is not None:
             with complete_step("Clearing out build directory…"):
@@ -2966,7 +3238,7 @@ def load_args(args: argparse.Namespace) -> MkosiConfig:
         ):
             die("Directory, subvolume, tar, cpio, and plain squashfs images cannot be booted.", MkosiNotSupportedException)
 
-    if shutil.which("bsdtar") and args.distribution == Distribution.openmandriva and args.tar_strip_selinux_context:
+    if which("bsdtar") and args.distribution == Distribution.openmandriva and args.tar_strip_selinux_context:
         die("Sorry, bsdtar on OpenMandriva is incompatible with --tar-strip-selinux-context", MkosiNotSupportedException)
 
     find_cache(args)
@@ -3123,12 +3395,18 @@ def load_args(args: argparse.Namespace) -> MkosiConfig:
         else:
             args.source_file_transfer = SourceFileTransfer.copy_all
 
+    if args.source_file_transfer_final == SourceFileTransfer.sync:
+        die("Sorry, --source-file-transfer-final=sync is not supported")
+
     if args.source_file_transfer_final == SourceFileTransfer.mount and args.verb == Verb.qemu:
         die("Sorry, --source-file-transfer-final=mount is not supported when booting in QEMU")
 
     if args.skip_final_phase and args.verb != Verb.build:
         die("--skip-final-phase can only be used when building an image using 'mkosi build'", MkosiNotSupportedException)
 
+    if args.checkpoints and not args.incremental:
+        die("--checkpoints requires --incremental")
+
     if args.ssh_timeout < 0:
         die("--ssh-timeout must be >= 0")
 
@@ -3158,18 +3436,28 @@ def load_args(args: argparse.Namespace) -> MkosiConfig:
     return MkosiConfig(**vars(args))
 
 
-def cache_tree_path(config: MkosiConfig, is_final_image: bool) -> Path:
-    suffix = "final-cache" if is_final_image else "build-cache"
+def cache_tree_suffix(is_final_image: bool) -> str:
+    return "final-cache" if is_final_image else "build-cache"
 
+
+def cache_tree_prefix(config: MkosiConfig) -> Path:
     # If the image ID is specified, use cache file names that are independent of the image versions, so that
     # rebuilding and bumping versions is cheap and reuses previous versions if cached.
     if config.image_id is not None and config.output_dir:
-        return config.output_dir / f"{config.image_id}.{suffix}"
+        return config.output_dir / config.image_id
     elif config.image_id:
-        return Path(f"{config.image_id}.{suffix}")
+        return Path(config.image_id)
     # Otherwise, derive the cache file names directly from the output file names.
     else:
-        return Path(f"{config.output}.{suffix}")
+        return config.output
+
+
+def cache_tree_path(config: MkosiConfig, is_final_image: bool) -> Path:
+    # The fingerprint of all inputs of the cached tree is part of its name, so that a change to any of them results
+    # in a new cached tree instead of silently reusing a stale one.
+    prefix = cache_tree_prefix(config)
+    fingerprint = cache_fingerprint(cache_components(config, is_final_image))
+    return prefix.with_name(f"{prefix.name}.{fingerprint}.{cache_tree_suffix(is_final_image)}")
 
 
 def check_tree_input(path: Optional[Path]) -> None:
@@ -3340,6 +3628,7 @@ def print_summary(config: MkosiConfig) -> None:
         print("                  SSH port:", config.ssh_port)
 
     print("               Incremental:", yes_no(config.incremental))
+    print("                     Trace:", yes_no(config.trace))
     print("               Compression:", yes_no_or(should_compress_output(config)))
 
     if config.output_format == OutputFormat.disk:
@@ -3398,6 +3687,7 @@ def print_summary(config: MkosiConfig) -> None:
     env = [f"{k}={v}" for k, v in config.environment.items()]
     if config.build_script:
         print("                 Run tests:", yes_no(config.with_tests))
+        print("            Pipeline Build:", yes_no(config.pipeline_build))
 
     print("        Postinstall Script:", path_or_none(config.postinst_script, check_script_input))
     print("            Prepare Script:", path_or_none(config.prepare_script, check_script_input))
@@ -3560,20 +3850,140 @@ def run_kernel_install(state: MkosiState, cached: bool) -> None:
             run_workspace_command(state, ["kernel-install", "add", kver, Path("/") / kimg])
 
 
-def reuse_cache_tree(state: MkosiState) -> bool:
+def stage_checkpoints(state: MkosiState) -> List[Checkpoint]:
+    """Return the configured checkpoints that are taken in the current stage"""
     if not state.config.incremental:
-        return False
+        return []
 
-    cache = cache_tree_path(state.config, is_final_image=not state.do_run_build_script)
-    if not cache.exists():
-        return False
+    if state.for_cache:
+        # When building incrementally, the steps before the prepare checkpoint only run when generating the cached
+        # trees.
+        checkpoints = [Checkpoint.distribution, Checkpoint.prepare]
+    elif not state.do_run_build_script and state.config.source_file_transfer_final is None:
+        # The sources are not part of the fingerprint, so we can only use this checkpoint if they're not copied
+        # into the final image.
+        checkpoints = [Checkpoint.extra_trees]
+    else:
+        checkpoints = []
+
+    return [c for c in checkpoints if c in state.config.checkpoints]
+
+
+def checkpoint_path(state: MkosiState, checkpoint: Checkpoint) -> Path:
+    if checkpoint == Checkpoint.extra_trees:
+        components = extra_trees_components(state.config, install_dir(state) if state.config.build_script else None)
+    else:
+        components = cache_components(state.config, not state.do_run_build_script, checkpoint)
+
+    prefix = cache_tree_prefix(state.config)
+    suffix = checkpoint_suffix(not state.do_run_build_script, checkpoint)
+    return prefix.with_name(f"{prefix.name}.{cache_fingerprint(components)}.{suffix}")
+
+
+def checkpoint_suffix(is_final_image: bool, checkpoint: Checkpoint) -> str:
+    return f"{cache_tree_suffix(is_final_image)}-{checkpoint}"
+
+
+def reuse_cache_tree(
+    state: MkosiState,
+    mounts: Optional[contextlib.ExitStack] = None,
+    prepare_only: bool = False,
+) -> Tuple[bool, Optional[Checkpoint]]:
+    """Restore the most complete cached tree available for the current stage
+
+    Returns whether the restored tree includes all steps that are cached, and
+    the checkpoint the tree was saved at, if any. With @prepare_only, trees
+    that include the output of the build script are not considered.
+    """
+    if not state.config.incremental:
+        return False, None
+
+    is_final_image = not state.do_run_build_script
+    cache = cache_tree_path(state.config, is_final_image)
     if state.for_cache and cache.exists():
-        return True
+        return True, None
 
-    with complete_step(f"Basing off cached tree {cache}", "Copied cached tree"):
-        copy_path(cache, state.root)
+    checkpoints = stage_checkpoints(state)
+    candidates: List[Tuple[Path, bool, Optional[Checkpoint]]] = []
 
-    return True
+    if Checkpoint.extra_trees in checkpoints and not prepare_only:
+        candidates += [(checkpoint_path(state, Checkpoint.extra_trees), True, Checkpoint.extra_trees)]
+
+    candidates += [(cache, True, None)]
+
+    for checkpoint in (Checkpoint.prepare, Checkpoint.distribution):
+        if checkpoint in checkpoints:
+            candidates += [(checkpoint_path(state, checkpoint), False, checkpoint)]
+
+    if not cache.exists():
+        components = cache_components(state.config, is_final_image)
+        variants = cache_variants(cache_tree_prefix(state.config), cache_tree_suffix(is_final_image))
+        reason = cache_miss_reason(cache, variants, components)
+        MkosiPrinter.info(f"Not reusing {cache_tree_suffix(is_final_image)}: {reason}")
+
+    for path, cached, checkpoint in candidates:
+        if path.exists():
+            restore_cache_tree(state, path, mounts if cached and checkpoint is None else None)
+            return cached, checkpoint
+
+    if state.for_cache and not state.root.exists() and which("btrfs"):
+        # Trees that end up in the cache are created as subvolumes where possible, so they can be restored with a
+        # snapshot later on. If this doesn't work, the root directory is created when the image is mounted.
+        run(["btrfs", "subvol", "create", state.root],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=False)
+
+    return False, None
+
+
+def restore_cache_tree(state: MkosiState, cache: Path, mounts: Optional[contextlib.ExitStack]) -> None:
+    """Make @cache the root of the image, using the cheapest method available
+
+    If @mounts is given and the image is thrown away after the build script ran,
+    the cached tree may be mounted read-only as the lower layer of an overlayfs,
+    which stays mounted until @mounts is closed.
+    """
+    with complete_step(f"Basing off cached tree {cache}", "Restored cached tree using {} in {:.1f}s") as output:
+        start = time.monotonic()
+
+        if btrfs_subvol_snapshot(cache, state.root):
+            strategy = "btrfs snapshot"
+        elif (mounts is not None and state.do_run_build_script and not state.for_cache and
+              state.config.base_image is None):
+            # The base image is mounted as an overlayfs with the image root as its upper layer, which can't be an
+            # overlayfs itself, hence we don't use this method in that case.
+            upper = state.workspace / "cache-upper"
+            workdir = state.workspace / "cache-workdir"
+            for d in (state.root, upper, workdir):
+                d.mkdir(mode=0o755, exist_ok=True)
+            mounts.enter_context(mount_overlay(cache, upper, workdir, state.root))
+            strategy = "overlayfs"
+        else:
+            copy_path(cache, state.root)
+            strategy = "copy"
+
+        output += [strategy, time.monotonic() - start]
+
+
+def save_checkpoint(state: MkosiState, checkpoint: Checkpoint, stack: contextlib.ExitStack, cached: bool) -> None:
+    if checkpoint not in stage_checkpoints(state):
+        return
+
+    path = checkpoint_path(state, checkpoint)
+
+    # Like the cached trees, checkpoints are taken of the unmounted image so neither the API file systems nor the
+    # base image end up in them.
+    stack.close()
+
+    with complete_step(f"Saving checkpoint {checkpoint}…", f"Saved checkpoint {path_relative_to_cwd(path)}"):
+        unlink_try_hard(path)
+        if not btrfs_subvol_snapshot(state.root, path):
+            copy_path(state.root, path)
+
+    if state.config.chown:
+        chown_to_running_user(path)
+
+    stack.enter_context(mount_image(state, cached))
+    stack.callback(close_workspace_sessions, state)
 
 
 def invoke_repart(
@@ -3627,33 +4037,100 @@ def invoke_repart(
     return (None, None, False)
 
 
-def build_image(state: MkosiState, *, manifest: Optional[Manifest] = None) -> None:
+@dataclasses.dataclass(frozen=True)
+class PreparedTree:
+    """A final image tree that was prepared while the build script ran, see build_image()"""
+
+    workspace: Path
+    cached: bool
+    checkpoint: Optional[Checkpoint]
+
+
+def adopt_prepared_tree(state: MkosiState, tree: PreparedTree) -> Tuple[bool, Optional[Checkpoint]]:
+    """Move the root of @tree into the workspace of @state, along with /var/tmp
+
+    The package manager configuration written while preparing the tree
+    refers to paths in the prepared workspace, which are gone once the tree
+    is moved, so it is left behind. The final stage uses the configuration
+    in the workspace of @state instead, which refers to the root the tree
+    is moved to, or regenerates it, like it does for cached trees.
+    """
+    with complete_step(f"Using final tree prepared in {tree.workspace}"):
+        for name in ("root", "var-tmp"):
+            if not (tree.workspace / name).exists():
+                continue
+            unlink_in_background(state.workspace / name)
+            os.rename(tree.workspace / name, state.workspace / name)
+
+        unlink_in_background(tree.workspace)
+
+    return tree.cached, tree.checkpoint
+
+
+def build_image(
+    state: MkosiState,
+    *,
+    manifest: Optional[Manifest] = None,
+    mounts: Optional[contextlib.ExitStack] = None,
+    prepare_only: bool = False,
+    prepared_tree: Optional[PreparedTree] = None,
+) -> Optional[PreparedTree]:
+    """Build the image of the current stage
+
+    With @prepare_only, only the steps that don't depend on the output of the
+    build script are run and the prepared tree is returned. Passing it as
+    @prepared_tree to a later invocation continues where it left off.
+    """
     # If there's no build script set, there's no point in executing
     # the build script iteration. Let's quit early.
     if state.config.build_script is None and state.do_run_build_script:
-        return
+        return None
 
     make_build_dir(state.config)
 
-    cached = reuse_cache_tree(state)
+    if prepared_tree is not None and (Checkpoint.extra_trees not in stage_checkpoints(state) or
+                                      not checkpoint_path(state, Checkpoint.extra_trees).exists()):
+        cached, checkpoint = adopt_prepared_tree(state, prepared_tree)
+    else:
+        # A checkpoint including the output of the build script beats anything prepared without it.
+        if prepared_tree is not None:
+            unlink_in_background(prepared_tree.workspace)
+        cached, checkpoint = reuse_cache_tree(state, mounts, prepare_only)
     if state.for_cache and cached:
-        return
+        return None
+
+    # The steps up to a restored checkpoint are skipped just like the ones included in a cached tree.
+    installed = cached or checkpoint is not None
+    prepared = cached or checkpoint == Checkpoint.prepare
+    copied = checkpoint == Checkpoint.extra_trees
 
-    with mount_image(state, cached):
-        prepare_tree(state, cached)
-        install_skeleton_trees(state, cached)
-        install_distribution(state, cached)
-        configure_locale(state.root, cached)
-        configure_hostname(state, cached)
-        configure_root_password(state, cached)
-        configure_serial_terminal(state, cached)
-        configure_autologin(state, cached)
-        configure_dracut(state, cached)
-        configure_netdev(state, cached)
-        run_prepare_script(state, cached)
-        install_build_src(state)
-        install_build_dest(state)
-        install_extra_trees(state)
+    with contextlib.ExitStack() as stack:
+        stack.enter_context(mount_image(state, cached))
+        # Workspace sessions keep the image busy, so stop them before it is unmounted.
+        stack.callback(close_workspace_sessions, state)
+
+        prepare_tree(state, installed)
+        install_skeleton_trees(state, installed)
+        install_distribution(state, installed)
+        if not installed:
+            save_checkpoint(state, Checkpoint.distribution, stack, cached)
+        configure_locale(state.root, prepared)
+        configure_hostname(state, prepared)
+        configure_root_password(state, prepared)
+        configure_serial_terminal(state, prepared)
+        configure_autologin(state, prepared)
+        configure_dracut(state, prepared)
+        configure_netdev(state, prepared)
+        run_prepare_script(state, prepared)
+        if not prepared:
+            save_checkpoint(state, Checkpoint.prepare, stack, cached)
+        if prepare_only:
+            return PreparedTree(state.workspace, cached, None if cached else Checkpoint.prepare)
+        if not copied:
+            install_build_src(state)
+            install_build_dest(state)
+            install_extra_trees(state)
+            save_checkpoint(state, Checkpoint.extra_trees, stack, cached)
         run_kernel_install(state, cached)
         install_boot_loader(state)
         configure_ssh(state, cached)
@@ -3671,8 +4148,7 @@ def build_image(state: MkosiState, *, manifest: Optional[Manifest] = None) -> No
                 manifest.record_packages(state.root)
 
         if cleanup:
-            clean_package_manager_metadata(state)
-            remove_files(state)
+            clean_image_tree(state)
         reset_machine_id(state)
         reset_random_seed(state.root)
         run_finalize_script(state)
@@ -3693,6 +4169,8 @@ def build_image(state: MkosiState, *, manifest: Optional[Manifest] = None) -> No
     make_cpio(state)
     make_directory(state)
 
+    return None
+
 
 def one_zero(b: bool) -> str:
     return "1" if b else "0"
@@ -3796,11 +4274,93 @@ def remove_artifacts(state: MkosiState, for_cache: bool = False) -> None:
         return
 
     with complete_step(f"Removing artifacts from {what}…"):
-        unlink_try_hard(state.root)
-        unlink_try_hard(state.var_tmp())
+        unlink_in_background(state.root)
+        unlink_in_background(state.var_tmp())
+        unlink_in_background(state.workspace / "cache-upper")
+        unlink_in_background(state.workspace / "cache-workdir")
+
 
+def stage_tag(state: MkosiState) -> str:
+    return "development" if state.do_run_build_script else "final"
 
-def build_stuff(config: MkosiConfig) -> None:
+
+def build_cache_stage(state: MkosiState, tagged: bool = False) -> None:
+    """Build and save the cached tree of @state's stage, with @tagged its steps are prefixed with the stage"""
+    with MkosiPrinter.tagged(stage_tag(state)) if tagged else contextlib.nullcontext():
+        build_image(state)
+        save_cache(state)
+    # This might run in a child process, which doesn't run atexit handlers, so finish any removals it started.
+    wait_for_trash()
+
+
+def build_cache_trees(state: MkosiState) -> None:
+    """Build the cached trees of the development and the final stage
+
+    The two stages only share the package cache, which each of them uses
+    through an overlayfs of its own, see mount_cache(), so if both are needed
+    they are built concurrently in separate processes, each in its own
+    subdirectory of the workspace.
+    """
+    # Generate the cache version of the final image, and store it as "cache-pre-inst"
+    final = dataclasses.replace(state, do_run_build_script=False, for_cache=True)
+
+    # There is no point generating a pre-dev cache image if no build script is provided
+    if not state.config.build_script:
+        with complete_step("Running second (final) stage to generate cached copy…"):
+            build_cache_stage(final)
+            remove_artifacts(final)
+        return
+
+    # Generate the cache version of the build image, and store it as "cache-pre-dev"
+    dev = dataclasses.replace(state, workspace=state.workspace / "cache-dev", do_run_build_script=True,
+                              for_cache=True)
+    final = dataclasses.replace(final, workspace=state.workspace / "cache-final")
+    stages = [dev, final]
+
+    with complete_step("Running first (development) and second (final) stage to generate cached copies…"):
+        for stage in stages:
+            stage.workspace.mkdir()
+
+        # Each stage runs in a process of its own, which is only interrupted if we fail ourselves. Otherwise the
+        # other stage is allowed to finish even if one fails, so its process doesn't outlive us.
+        with contextlib.ExitStack() as stack:
+            calls = [stack.enter_context(ForkedCall(build_cache_stage, stage, tagged=True)) for stage in stages]
+            for call in calls:
+                call.wait()
+
+        for stage in stages:
+            remove_artifacts(stage)
+
+        for call in calls:
+            call.result()
+
+
+def prepare_final_tree(state: MkosiState) -> Optional[PreparedTree]:
+    with MkosiPrinter.tagged(stage_tag(state)):
+        tree = build_image(state, prepare_only=True)
+    # This runs in a child process, which doesn't run atexit handlers, so finish any removals it started.
+    wait_for_trash()
+    return tree
+
+
+def start_preparing_final_tree(state: MkosiState, stack: contextlib.ExitStack) -> ForkedCall[Optional[PreparedTree]]:
+    """Start preparing the tree of the final stage in a separate process, while the build script runs
+
+    The final stage is run up to and including the prepare script in its
+    own subdirectory of the workspace. The process is waited for when
+    @stack is closed. If @stack is closed because of an exception, the
+    process is interrupted first, so the error doesn't have to wait for
+    the preparation to finish.
+    """
+    final = dataclasses.replace(state, workspace=state.workspace / "final-prepare", do_run_build_script=False,
+                                for_cache=False)
+    final.workspace.mkdir()
+
+    MkosiPrinter.print_step("Preparing second (final) stage while the build script runs…")
+    return stack.enter_context(ForkedCall(prepare_final_tree, final))
+
+
+def build_stuff(config: MkosiConfig, previous_manifest: Optional[Dict[str, Any]] = None) -> None:
     make_output_dir(config)
     make_cache_dir(config)
     workspace = setup_workspace(config)
@@ -3808,75 +4368,88 @@ def build_stuff(config: MkosiConfig) -> None:
 
     manifest = Manifest(config)
 
-    # Make sure tmpfiles' aging doesn't interfere with our workspace
-    # while we are working on it.
-    with open_close(workspace.name, os.O_RDONLY | os.O_DIRECTORY | os.O_CLOEXEC) as dir_fd:
+    try:
+        # Make sure tmpfiles' aging doesn't interfere with our workspace
+        # while we are working on it.
+        with open_close(workspace.name, os.O_RDONLY | os.O_DIRECTORY | os.O_CLOEXEC) as dir_fd:
+
+            fcntl.flock(dir_fd, fcntl.LOCK_EX)
+
+            state = MkosiState(
+                config=config,
+                workspace=Path(workspace.name),
+                cache=cache,
+                do_run_build_script=False,
+                machine_id=config.machine_id or uuid.uuid4().hex,
+                for_cache=False,
+            )
 
-        fcntl.flock(dir_fd, fcntl.LOCK_EX)
+            # If caching is requested, then make sure we have cache trees around we can make use of
+            if need_cache_trees(state):
+                build_cache_trees(state)
+
+            with contextlib.ExitStack() as pipeline:
+                prepare: Optional[ForkedCall[Optional[PreparedTree]]] = None
+
+                if config.build_script:
+                    if config.pipeline_build and not config.skip_final_phase:
+                        prepare = start_preparing_final_tree(state, pipeline)
+
+                    with complete_step("Running first (development) stage…"):
+                        # Run the image builder for the first (development) stage in preparation for the build
+                        # script. The development image is thrown away afterwards, so the cached tree may stay
+                        # mounted until then instead of being copied.
+                        state = dataclasses.replace(state, do_run_build_script=True, for_cache=False)
+                        with contextlib.ExitStack() as mounts:
+                            build_image(state, mounts=mounts)
+                            run_build_script(state)
+                        remove_artifacts(state)
+
+                # Run the image builder for the second (final) stage
+                if not config.skip_final_phase:
+                    with complete_step("Running second (final) stage…"):
+                        state = dataclasses.replace(state, do_run_build_script=False, for_cache=False)
+                        build_image(state, manifest=manifest, prepared_tree=prepare.result() if prepare else None)
+                else:
+                    MkosiPrinter.print_step("Skipping (second) final image build phase.")
 
-        state = MkosiState(
-            config=config,
-            workspace=Path(workspace.name),
-            cache=cache,
-            do_run_build_script=False,
-            machine_id=config.machine_id or uuid.uuid4().hex,
-            for_cache=False,
-        )
+            postprocess_output(state, manifest, previous_manifest)
 
-        # If caching is requested, then make sure we have cache trees around we can make use of
-        if need_cache_trees(state):
-
-            # There is no point generating a pre-dev cache image if no build script is provided
-            if config.build_script:
-                with complete_step("Running first (development) stage to generate cached copy…"):
-                    # Generate the cache version of the build image, and store it as "cache-pre-dev"
-                    state = dataclasses.replace(state, do_run_build_script=True, for_cache=True)
-                    build_image(state)
-                    save_cache(state)
-                    remove_artifacts(state)
-
-            with complete_step("Running second (final) stage to generate cached copy…"):
-                # Generate the cache version of the build image, and store it as "cache-pre-inst"
-                state = dataclasses.replace(state, do_run_build_script=False, for_cache=True)
-                build_image(state)
-                save_cache(state)
-                remove_artifacts(state)
-
-        if config.build_script:
-            with complete_step("Running first (development) stage…"):
-                # Run the image builder for the first (development) stage in preparation for the build script
-                state = dataclasses.replace(state, do_run_build_script=True, for_cache=False)
-                build_image(state)
-                run_build_script(state)
-                remove_artifacts(state)
-
-        # Run the image builder for the second (final) stage
-        if not config.skip_final_phase:
-            with complete_step("Running second (final) stage…"):
-                state = dataclasses.replace(state, do_run_build_script=False, for_cache=False)
-                build_image(state, manifest=manifest)
-        else:
-            MkosiPrinter.print_step("Skipping (second) final image build phase.")
+            for p in state.config.output_paths():
+                if state.staging.joinpath(p.name).exists():
+                    shutil.move(str(state.staging / p.name), str(p))
+                if state.config.chown and p.exists(): 
+                    chown_to_running_user(p)
 
-        qcow2_output(state)
-        calculate_bmap(state)
-        copy_nspawn_settings(state)
-        calculate_sha256sum(state)
-        calculate_signature(state)
-        save_manifest(state, manifest)
+            for p in state.staging.iterdir():
+                shutil.move(str(p), str(state.config.output.parent / p.name))
+                if state.config.chown:
+                    chown_to_running_user(state.config.output.parent / p.name)
+    finally:
+        # Artifacts removed in the background might be in a trash directory in the workspace, so finish removing
+        # them before the workspace itself is removed.
+        wait_for_trash(Path(workspace.name))
 
-        for p in state.config.output_paths():
-            if state.staging.joinpath(p.name).exists():
-                shutil.move(str(state.staging / p.name), str(p))
-                if p in (state.config.output, state.config.output_split_kernel):
-                    compress_output(state.config, p)
-            if state.config.chown and p.exists(): 
-                chown_to_running_user(p)
 
-        for p in state.staging.iterdir():
-            shutil.move(str(p), str(state.config.output.parent / p.name))
-            if p.name.startswith(state.config.output.name):
-                compress_output(state.config, p)
+@contextlib.contextmanager
+def record_trace(config: MkosiConfig) -> Iterator[None]:
+    if not config.trace:
+        yield
+        return
+
+    Tracer.start()
+    try:
+        yield
+    finally:
+        Tracer.stop()
+
+        with open(config.output_trace, "w") as f:
+            Tracer.write(f)
+
+        if config.chown:
+            chown_to_running_user(config.output_trace)
+
+        MkosiPrinter.info(f"Wrote build trace to {path_relative_to_cwd(config.output_trace)}")
 
 
 def check_root() -> None:
@@ -4010,7 +4583,7 @@ def run_shell(config: MkosiConfig) -> None:
 def find_qemu_binary(config: MkosiConfig) -> str:
     binaries = ["qemu", "qemu-kvm", f"qemu-system-{config.architecture}"]
     for binary in binaries:
-        if shutil.which(binary) is not None:
+        if which(binary) is not None:
             return binary
 
     die("Couldn't find QEMU/KVM binary")
@@ -4120,7 +4693,7 @@ def qemu_check_kvm_support() -> bool:
 @contextlib.contextmanager
 def start_swtpm() -> Iterator[Optional[Path]]:
 
-    if not shutil.which("swtpm"):
+    if not which("swtpm"):
         MkosiPrinter.info("Couldn't find swtpm binary, not invoking qemu with TPM2 device.")
         yield None
         return
@@ -4501,6 +5074,9 @@ def run_verb(raw: argparse.Namespace) -> None:
             if not config.force:
                 check_outputs(config)
 
+        # Remember the manifest of the previous build before it is removed, to compare the new one with it.
+        previous_manifest = load_manifest(config.output_manifest) if needs_build(config) else None
+
         if needs_build(config) or config.verb == Verb.clean:
             check_root()
             unlink_output(config)
@@ -4511,7 +5087,9 @@ def run_verb(raw: argparse.Namespace) -> None:
         if needs_build(config):
             check_native(config)
             init_namespace()
-            build_stuff(config)
+
+            with record_trace(config):
+                build_stuff(config, previous_manifest)
 
             if config.auto_bump:
                 bump_image_version(config)
@@ -4530,3 +5108,6 @@ def run_verb(raw: argparse.Namespace) -> None:
 
         if config.verb == Verb.serve:
             run_serve(config)
+
+        if config.verb == Verb.manifest_diff:
+            show_manifest_diff(config)
@@ -1,14 +1,20 @@
 # SPDX-License-Identifier: LGPL-2.1+
 # PYTHON_ARGCOMPLETE_OK
 
+import argparse
+import concurrent.futures
 import contextlib
+import functools
+import multiprocessing
 import os
 import sys
 from subprocess import CalledProcessError
-from typing import Iterator
+from typing import Dict, Iterator, List
 
 from mkosi import complete_step, parse_args, run_verb
 from mkosi.backend import MkosiException, die
+from mkosi.remove import wait_for_trash
+from mkosi.scheduler import run_graph, topological_order
 
 
 @contextlib.contextmanager
@@ -22,23 +28,79 @@ def propagate_failed_return() -> Iterator[None]:
         sys.exit(1)
 
 
-@propagate_failed_return()
-def main() -> None:
-    args = parse_args()
-
-    for job_name, a in args.items():
-        # Change working directory if --directory is passed
-        if a.directory:
-            work_dir = a.directory
-            if os.path.isdir(work_dir):
-                os.chdir(work_dir)
-            else:
-                die(f"Error: {work_dir} is not a directory!")
-        if len(args) > 1:
+def run_job(job_name: str, a: argparse.Namespace, *, multiple: bool) -> None:
+    # Change working directory if --directory is passed
+    if a.directory:
+        work_dir = a.directory
+        if os.path.isdir(work_dir):
+            os.chdir(work_dir)
+        else:
+            die(f"Error: {work_dir} is not a directory!")
+    try:
+        if multiple:
             with complete_step(f"Processing {job_name}"):
                 run_verb(a)
         else:
             run_verb(a)
+    finally:
+        # Jobs might run in a process of their own, whose exit doesn't run atexit handlers.
+        wait_for_trash()
+
+
+def run_job_in_process(args: Dict[str, argparse.Namespace], job_name: str) -> None:
+    """Run @job_name in a process of its own, which exits once the job is done
+
+    The process is spawned rather than forked, as jobs are started from the
+    scheduler's worker threads, and a process forked while other threads hold
+    locks can never acquire them. This also means the job starts out from a
+    fresh interpreter, which only gets the job's pickled arguments.
+    """
+    # Pool workers are reused for further jobs, so use a new pool for every job.
+    with concurrent.futures.ProcessPoolExecutor(max_workers=1,
+                                                mp_context=multiprocessing.get_context("spawn")) as executor:
+        executor.submit(run_job, job_name, args[job_name], multiple=True).result()
+
+
+def job_dependencies(args: Dict[str, argparse.Namespace]) -> Dict[str, List[str]]:
+    """Map every job to the jobs whose output it needs, as declared with Dependencies="""
+    graph = {}
+    for job_name, a in args.items():
+        deps = []
+        for dep in a.dependencies:
+            # Allow referring to mkosi.files/mkosi.foo as just "foo".
+            if dep not in args and f"mkosi.{dep}" in args:
+                dep = f"mkosi.{dep}"
+            deps.append(dep)
+        graph[job_name] = deps
+
+    return graph
+
+
+@propagate_failed_return()
+def main() -> None:
+    args = parse_args()
+
+    try:
+        graph = job_dependencies(args)
+        order = topological_order(graph)
+    except ValueError as e:
+        die(str(e))
+
+    jobs = max(a.jobs for a in args.values())
+
+    if jobs <= 1 or len(args) == 1:
+        for job_name in order:
+            run_job(job_name, args[job_name], multiple=len(args) > 1)
+        return
+
+    # Every job runs in a process of its own, as it detaches into its own mount namespace and changes process wide
+    # state such as the working directory and $PATH. The threads only wait for those processes.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        results = run_graph(graph, functools.partial(run_job_in_process, args), executor)
+
+    failed = [job_name for job_name in order if results[job_name] is not None]
+    if failed:
+        die(f"Failed to build {', '.join(failed)}")
 
 
 if __name__ == "__main__":
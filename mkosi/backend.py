@@ -4,33 +4,36 @@ from __future__ import annotations
 
 import argparse
 import ast
-import collections
 import contextlib
 import dataclasses
 import enum
 import functools
 import importlib
+import multiprocessing
 import os
 import platform
 import pwd
 import re
 import resource
+import select
 import shlex
 import shutil
 import signal
 import subprocess
 import sys
 import tarfile
+import tempfile
+import threading
 import uuid
 from pathlib import Path
-from types import FrameType
+from types import FrameType, TracebackType
 from typing import (
     IO,
     TYPE_CHECKING,
     Any,
     Callable,
-    Deque,
     Dict,
+    Generic,
     Iterable,
     Iterator,
     List,
@@ -47,6 +50,8 @@ from typing import (
 )
 
 from mkosi.distributions import DistributionInstaller
+from mkosi.probe import cached_probe
+from mkosi.trace import Tracer
 
 T = TypeVar("T")
 V = TypeVar("V")
@@ -139,6 +144,7 @@ class Verb(enum.Enum):
     bump    = "bump"
     help    = "help"
     genkey  = "genkey"
+    manifest_diff = "manifest-diff"
 
     # Defining __str__ is required to get "print_help()" output to include the human readable (values) of Verb.
     def __str__(self) -> str:
@@ -278,6 +284,7 @@ class SourceFileTransfer(enum.Enum):
     copy_git_others = "copy-git-others"
     copy_git_more = "copy-git-more"
     mount = "mount"
+    sync = "sync"
 
     def __str__(self) -> str:
         return self.value
@@ -290,6 +297,7 @@ class SourceFileTransfer(enum.Enum):
             cls.copy_git_others: "use git ls-files --others, ignoring any file that git itself ignores",
             cls.copy_git_more: "use git ls-files --cached, ignoring any file that git itself ignores, but include the .git/ directory",
             cls.mount: "bind mount source files into the build image",
+            cls.sync: "bind mount a copy of the source files that is updated incrementally into the build image",
         }
 
 
@@ -310,6 +318,14 @@ class ManifestFormat(Parseable, enum.Enum):
     def __str__(self) -> str:
         return Parseable.__str__(self)
 
+class Checkpoint(Parseable, enum.Enum):
+    distribution = "distribution"  # after the distribution packages were installed
+    prepare      = "prepare"       # after the image was configured and the prepare script ran
+    extra_trees  = "extra_trees"   # after the build artifacts and extra trees were copied in
+
+    def __str__(self) -> str:
+        return Parseable.__str__(self)
+
 KNOWN_SUFFIXES = {
     ".xz",
     ".zstd",
@@ -375,6 +391,7 @@ class MkosiConfig:
     idmap: bool
     tar_strip_selinux_context: bool
     incremental: bool
+    checkpoints: List[Checkpoint]
     cache_initrd: bool
     base_packages: Union[str, bool]
     packages: List[str]
@@ -394,6 +411,7 @@ class MkosiConfig:
     build_packages: List[str]
     skip_final_phase: bool
     build_script: Optional[Path]
+    pipeline_build: bool
     prepare_script: Optional[Path]
     postinst_script: Optional[Path]
     finalize_script: Optional[Path]
@@ -424,7 +442,10 @@ class MkosiConfig:
     config_path: Optional[Path]
     all: bool
     all_directory: Optional[Path]
+    jobs: int
+    dependencies: List[str]
     debug: List[str]
+    trace: bool
     auto_bump: bool
     workspace_dir: Optional[Path]
     machine_id: Optional[str]
@@ -439,6 +460,7 @@ class MkosiConfig:
 
     # systemd-nspawn specific options
     nspawn_keep_unit: bool
+    workspace_session: bool
 
     passphrase: Optional[Path]
 
@@ -489,6 +511,14 @@ class MkosiConfig:
     def output_changelog(self) -> Path:
         return build_auxiliary_output_path(self, ".changelog")
 
+    @property
+    def output_manifest_diff(self) -> Path:
+        return build_auxiliary_output_path(self, ".manifest-diff")
+
+    @property
+    def output_trace(self) -> Path:
+        return build_auxiliary_output_path(self, ".trace.json")
+
     def output_paths(self) -> Tuple[Path, ...]:
         return (
             self.output,
@@ -503,6 +533,7 @@ class MkosiConfig:
             self.output_sshkey,
             self.output_manifest,
             self.output_changelog,
+            self.output_manifest_diff,
         )
 
 
@@ -518,6 +549,8 @@ class MkosiState:
     for_cache: bool
     environment: Dict[str, str] = dataclasses.field(init=False)
     installer: DistributionInstaller = dataclasses.field(init=False)
+    workspace_sessions: Dict[Tuple[bool, Tuple[str, ...]], WorkspaceSession] = \
+        dataclasses.field(init=False, default_factory=dict)
 
     def __post_init__(self) -> None:
         self.environment = self.config.environment.copy()
@@ -552,6 +585,71 @@ class MkosiState:
         return p
 
 
+@dataclasses.dataclass(frozen=True)
+class Compressor:
+    """A compression algorithm for the output, and its settings"""
+
+    algorithm: str
+    level: Optional[int] = None
+    threads: int = 0  # 0 means one thread per CPU
+    long: Optional[int] = None  # window log for long distance matching, 0 for the compressor's default
+
+    @property
+    def suffix(self) -> str:
+        return ".xz" if self.algorithm == "xz" else ".zst"
+
+    @property
+    def streamable(self) -> bool:
+        """Whether the compressor can read its input from a pipe"""
+        return self.algorithm != "zstd-seekable"
+
+
+OUTPUT_COMPRESSORS = ("xz", "zstd", "zstd-seekable")
+# The compression levels supported by each algorithm, zstd levels above 19 are passed with --ultra.
+COMPRESSION_LEVELS = {
+    "xz": range(0, 10),
+    "zstd": range(1, 23),
+    "zstd-seekable": range(1, 23),
+}
+# The window logs zstd supports for long distance matching, 0 stands for its default.
+ZSTD_WINDOW_LOGS = range(10, 32)
+
+
+def parse_compressor(value: str) -> Compressor:
+    """Parse a compression setting such as "zstd" or "zstd:level=19,long=27,threads=0"
+
+    Raises ValueError for unknown algorithms and invalid options.
+    """
+    algorithm, _, options = value.partition(":")
+    if algorithm not in OUTPUT_COMPRESSORS:
+        raise ValueError(f"Unknown compression {algorithm}")
+
+    settings: Dict[str, int] = {}
+    for option in filter(None, options.split(",")):
+        key, sep, v = option.partition("=")
+        # t2sz doesn't support long distance matching.
+        if key not in ("level", "threads", "long") or (key == "long" and algorithm != "zstd"):
+            raise ValueError(f"Unknown option {key} for {algorithm} compression")
+        if not sep and key == "long":
+            v = "0"
+        try:
+            settings[key] = int(v)
+        except ValueError:
+            raise ValueError(f"Invalid value {v!r} for {key} of {algorithm} compression") from None
+        if settings[key] < 0:
+            raise ValueError(f"Invalid value {v!r} for {key} of {algorithm} compression")
+
+    levels = COMPRESSION_LEVELS[algorithm]
+    if "level" in settings and settings["level"] not in levels:
+        raise ValueError(f"Invalid level {settings['level']} for {algorithm} compression, "
+                         f"must be between {levels[0]} and {levels[-1]}")
+    if settings.get("long") and settings["long"] not in ZSTD_WINDOW_LOGS:
+        raise ValueError(f"Invalid window log {settings['long']} for {algorithm} compression, "
+                         f"must be between {ZSTD_WINDOW_LOGS[0]} and {ZSTD_WINDOW_LOGS[-1]}")
+
+    return Compressor(algorithm, **settings)
+
+
 def should_compress_output(config: Union[argparse.Namespace, MkosiConfig]) -> Union[bool, str]:
     """A string or False.
 
@@ -572,12 +670,15 @@ def workspace(root: Path) -> Path:
 
 
 def nspawn_knows_arg(arg: str) -> bool:
-    # Specify some extra incompatible options so nspawn doesn't try to boot a container in the current
-    # directory if it has a compatible layout.
-    return "unrecognized option" not in run(["systemd-nspawn", arg,
-                                            "--directory", "/dev/null", "--image", "/dev/null"],
-                                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, check=False,
-                                            text=True).stderr
+    def probe() -> bool:
+        # Specify some extra incompatible options so nspawn doesn't try to boot a container in the current
+        # directory if it has a compatible layout.
+        return "unrecognized option" not in run(["systemd-nspawn", arg,
+                                                "--directory", "/dev/null", "--image", "/dev/null"],
+                                                stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, check=False,
+                                                text=True).stderr
+
+    return cached_probe("systemd-nspawn", f"knows-arg {arg}", probe)
 
 
 def format_rlimit(rlimit: int) -> str:
@@ -594,7 +695,142 @@ def nspawn_rlimit_params() -> Sequence[str]:
 
 
 def nspawn_version() -> int:
-    return int(run(["systemd-nspawn", "--version"], stdout=subprocess.PIPE).stdout.strip().split()[1])
+    def probe() -> int:
+        return int(run(["systemd-nspawn", "--version"], stdout=subprocess.PIPE).stdout.strip().split()[1])
+
+    return cached_probe("systemd-nspawn", "version", probe)
+
+
+# The payload of a workspace session container. It reads the number of the next command from its standard input,
+# runs the script written for it and reports the exit status through the response FIFO.
+WORKSPACE_SESSION_SERVER = """\
+while read -r n; do
+    if [ -e "$1/$n.capture" ]; then
+        /bin/sh "$1/$n.sh" </dev/null >"$1/$n.stdout"
+    else
+        /bin/sh "$1/$n.sh" </dev/null
+    fi
+    echo "$n $?" >"$1/response"
+done
+"""
+
+
+def mounts_below(path: Path) -> Tuple[str, ...]:
+    """Return the ids of everything mounted on or below @path"""
+    prefix = os.fspath(path)
+    mounts = []
+    with open("/proc/self/mountinfo") as f:
+        for line in f:
+            fields = line.split()
+            if fields[4] == prefix or fields[4].startswith(f"{prefix}/"):
+                mounts.append(fields[0])
+
+    return tuple(mounts)
+
+
+class WorkspaceSession:
+    """A long-lived container that runs workspace commands one after another
+
+    @cmdline starts the container, which runs WORKSPACE_SESSION_SERVER with
+    @directory mounted at @inner. Every command is written to a script in
+    @directory and its number is sent to the server. As the container only
+    sees the mounts that existed when it was started, @mounts records them,
+    see mounts_below().
+    """
+
+    def __init__(
+        self,
+        cmdline: Sequence[PathString],
+        directory: Path,
+        inner: Path,
+        mounts: Tuple[str, ...] = (),
+    ) -> None:
+        self.directory = directory
+        self.mounts = mounts
+        self.count = 0
+
+        os.mkfifo(directory / "response")
+        # Opened for both reading and writing, so neither this nor the server's open blocks.
+        self.response = os.open(directory / "response", os.O_RDWR | os.O_CLOEXEC)
+        self.proc = spawn([*cmdline, "/bin/sh", "-c", WORKSPACE_SESSION_SERVER, "sh", inner], stdin=subprocess.PIPE)
+
+    def run(self, cmd: Sequence[PathString], env: Mapping[str, str], capture_stdout: bool) -> CompletedProcess:
+        assert self.proc.stdin is not None
+
+        if "run" in ARG_DEBUG:
+            MkosiPrinter.info(f"+ {shell_join(cmd)}")
+
+        self.count += 1
+        n = self.count
+        script = self.directory / f"{n}.sh"
+        script.write_text(f"exec env {shell_join([f'{k}={v}' for k, v in env.items()])} {shell_join(cmd)}\n")
+        if capture_stdout:
+            self.directory.joinpath(f"{n}.capture").touch()
+
+        with do_delay_interrupt():
+            try:
+                self.proc.stdin.write(f"{n}\n".encode())
+                self.proc.stdin.flush()
+            except BrokenPipeError:
+                die("Workspace session exited unexpectedly")
+
+            response = b""
+            while not response.endswith(b"\n"):
+                ready, _, _ = select.select([self.response], [], [], 1)
+                if ready:
+                    response += os.read(self.response, 4096)
+                elif self.proc.poll() is not None:
+                    die("Workspace session exited unexpectedly")
+
+        done, status = response.decode().split()
+        assert int(done) == n
+
+        stdout = None
+        if capture_stdout:
+            stdout = self.directory.joinpath(f"{n}.stdout").read_text()
+
+        for name in (f"{n}.sh", f"{n}.capture", f"{n}.stdout"):
+            with contextlib.suppress(FileNotFoundError):
+                self.directory.joinpath(name).unlink()
+
+        return CompletedProcess(cmd, int(status), stdout=stdout)
+
+    def close(self) -> None:
+        assert self.proc.stdin is not None
+
+        # The server exits when its standard input is closed.
+        self.proc.stdin.close()
+        self.proc.wait()
+        os.close(self.response)
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def close_workspace_sessions(state: MkosiState) -> None:
+    for session in state.workspace_sessions.values():
+        session.close()
+    state.workspace_sessions.clear()
+
+
+def workspace_session(
+    state: MkosiState,
+    nspawn: List[PathString],
+    key: Tuple[bool, Tuple[str, ...]],
+) -> WorkspaceSession:
+    """Return the running session for @key, starting a new one if there is none or the mounts changed"""
+    mounts = mounts_below(state.root)
+
+    session = state.workspace_sessions.get(key)
+    if session is not None and session.mounts != mounts:
+        session.close()
+        session = None
+
+    if session is None:
+        directory = Path(tempfile.mkdtemp(prefix="mkosi-session-", dir=state.var_tmp()))
+        inner = Path("/var/tmp") / directory.name
+        session = WorkspaceSession([*nspawn, "--console=pipe", "--"], directory, inner, mounts)
+        state.workspace_sessions[key] = session
+
+    return session
 
 
 def run_workspace_command(
@@ -606,7 +842,7 @@ def run_workspace_command(
     capture_stdout: bool = False,
     check: bool = True,
 ) -> CompletedProcess:
-    nspawn = [
+    nspawn: List[PathString] = [
         "systemd-nspawn",
         "--quiet",
         f"--directory={state.root}",
@@ -626,21 +862,30 @@ def run_workspace_command(
     else:
         nspawn += ["--private-network"]
 
-    if env:
-        nspawn += [f"--setenv={k}={v}" for k, v in env.items()]
     if "workspace-command" in ARG_DEBUG:
         nspawn += ["--setenv=SYSTEMD_LOG_LEVEL=debug"]
 
     if nspawn_params:
         nspawn += nspawn_params
 
+    if state.config.nspawn_keep_unit:
+        nspawn += ["--keep-unit"]
+
+    if state.config.workspace_session:
+        # Commands that need the same container configuration share a container.
+        session = workspace_session(state, nspawn, (network, tuple(nspawn_params or [])))
+        result = session.run(cmd, env or {}, capture_stdout)
+        if check and result.returncode != 0:
+            die(f"Workspace command {shell_join(cmd)} returned non-zero exit code {result.returncode}.")
+        return result
+
+    if env:
+        nspawn += [f"--setenv={k}={v}" for k, v in env.items()]
+
     if capture_stdout:
         stdout = subprocess.PIPE
         nspawn += ["--console=pipe"]
 
-    if state.config.nspawn_keep_unit:
-        nspawn += ["--keep-unit"]
-
     try:
         return run([*nspawn, "--", *cmd], check=check, stdout=stdout, text=capture_stdout)
     except subprocess.CalledProcessError as e:
@@ -655,6 +900,11 @@ def do_delay_interrupt() -> Iterator[None]:
     # exit cleanly before doing mkosi's cleanup. If we don't do this, we get device or resource is busy
     # errors when unmounting stuff later on during cleanup. We only delay a single CTRL+C interrupt so that a
     # user can always exit mkosi even if a subprocess hangs by pressing CTRL+C twice.
+    if threading.current_thread() is not threading.main_thread():
+        # Only the main thread can install signal handlers, and it's the one CTRL+C is delivered to anyway.
+        yield
+        return
+
     interrupted = False
 
     def handler(signal: int, frame: Optional[FrameType]) -> None:
@@ -684,6 +934,18 @@ def do_noop() -> Iterator[None]:
 _FILE = Union[None, int, IO[Any]]
 
 
+def sudo_user_fallback(cmdline: Sequence[PathString], kwargs: Dict[str, Any]) -> List[PathString]:
+    # This is a workaround for copy_git_files, which uses the user= option to
+    # subprocess.run, which is only available starting with Python 3.9
+    # TODO: remove this function once mkosi defaults to at least Python 3.9
+    if "user" in kwargs and sys.version_info < (3, 9):
+        user = kwargs.pop("user")
+        user = f"#{user}" if isinstance(user, int) else user
+        return ["sudo", "-u", user, *cmdline]
+
+    return list(cmdline)
+
+
 def spawn(
     cmdline: Sequence[PathString],
     delay_interrupt: bool = True,
@@ -700,6 +962,8 @@ def spawn(
         # output.
         stdout = sys.stderr
 
+    cmdline = sudo_user_fallback(cmdline, kwargs)
+
     cm = do_delay_interrupt if delay_interrupt else do_noop
     try:
         with cm():
@@ -728,13 +992,7 @@ def run(
         # output.
         stdout = sys.stderr
 
-    # This is a workaround for copy_git_files, which uses the user= option to
-    # subprocess.run, which is only available starting with Python 3.9
-    # TODO: remove this branch once mkosi defaults to at least Python 3.9
-    if "user" in kwargs and sys.version_info < (3, 9):
-        user = kwargs.pop("user")
-        user = f"#{user}" if isinstance(user, int) else user
-        cmdline = ["sudo", "-u", user] + cmdline
+    cmdline = sudo_user_fallback(cmdline, kwargs)
 
     cm = do_delay_interrupt if delay_interrupt else do_noop
     try:
@@ -744,6 +1002,82 @@ def run(
         die(f"{cmdline[0]} not found in PATH.")
 
 
+class ForkedCall(Generic[T]):
+    """Call @func in a forked child process and hand its return value or exception back through a pipe
+
+    Steps of a build run in their own process as they mount things and
+    change process wide state such as $PATH. Used as a context manager, the
+    process is interrupted if the block raises an exception and is always
+    waited for when the block is left.
+    """
+
+    def __init__(self, func: Callable[..., T], *args: Any, **kwargs: Any) -> None:
+        self._outcome: Optional[Tuple[bool, Any]] = None
+        self._receiver, sender = multiprocessing.Pipe(duplex=False)
+        ctx = multiprocessing.get_context("fork")
+        self.process = ctx.Process(target=self._call, args=(sender, func, args, kwargs))
+        self.process.start()
+        sender.close()
+
+    @staticmethod
+    def _call(sender: Any, func: Callable[..., T], args: Sequence[Any], kwargs: Dict[str, Any]) -> None:
+        try:
+            outcome: Tuple[bool, Any] = (True, func(*args, **kwargs))
+        except BaseException as e:
+            outcome = (False, e)
+
+        try:
+            sender.send(outcome)
+        except Exception as e:
+            # The return value or the exception can't be pickled, report that instead.
+            sender.send((False, MkosiException(f"Cannot pass on the result of {func.__name__}: {e}")))
+
+    def interrupt(self) -> None:
+        """Send SIGINT to the process, so it unwinds like on CTRL+C and cleans up its mounts"""
+        if self.process.is_alive() and self.process.pid is not None:
+            with contextlib.suppress(ProcessLookupError):
+                os.kill(self.process.pid, signal.SIGINT)
+
+    def wait(self) -> None:
+        """Wait for the process to exit without raising its exception"""
+        if self._outcome is not None:
+            return
+
+        try:
+            # Receive before joining, the child can't exit before its result has been read from the pipe.
+            self._outcome = self._receiver.recv()
+        except EOFError:
+            self.process.join()
+            self._outcome = (False, MkosiException(f"Process {self.process.pid} exited with {self.process.exitcode} "
+                                                   "without a result"))
+
+        self._receiver.close()
+        self.process.join()
+
+    def result(self) -> T:
+        """Wait for the process to exit and return the return value of @func or raise its exception"""
+        self.wait()
+        assert self._outcome is not None
+
+        ok, value = self._outcome
+        if not ok:
+            raise value
+        return cast(T, value)
+
+    def __enter__(self) -> ForkedCall[T]:
+        return self
+
+    def __exit__(
+        self,
+        exc_type: Optional[Type[BaseException]],
+        exc: Optional[BaseException],
+        tb: Optional[TracebackType],
+    ) -> None:
+        if exc_type is not None:
+            self.interrupt()
+        self.wait()
+
+
 def tmp_dir() -> Path:
     path = os.environ.get("TMPDIR") or "/var/tmp"
     return Path(path)
@@ -790,7 +1124,30 @@ class MkosiPrinter:
 
     prefix = "‣ "
 
-    level = 0
+    # The nesting level of steps and the tag printed in front of them are kept per thread, as steps run
+    # concurrently in worker threads and forked processes. Forked processes inherit them from the thread that
+    # forked them.
+    local = threading.local()
+
+    @classmethod
+    def level(cls) -> int:
+        return cast(int, getattr(cls.local, "level", 0))
+
+    @classmethod
+    def set_level(cls, level: int) -> None:
+        """Set the nesting level of steps of the current thread, e.g. to the one of the thread that started it"""
+        cls.local.level = level
+
+    @classmethod
+    @contextlib.contextmanager
+    def tagged(cls, tag: str) -> Iterator[None]:
+        """Prefix the steps of the current thread with @tag, to tell them apart from ones that run concurrently"""
+        old = getattr(cls.local, "tag", "")
+        cls.local.tag = tag
+        try:
+            yield
+        finally:
+            cls.local.tag = old
 
     @classmethod
     def _print(cls, text: str) -> None:
@@ -800,9 +1157,14 @@ class MkosiPrinter:
     def color_error(cls, text: Any) -> str:
         return f"{cls.red}{text}{cls.reset}"
 
+    @classmethod
+    def tag_prefix(cls) -> str:
+        tag = getattr(cls.local, "tag", "")
+        return f"{cls.prefix}[{tag}] " if tag else cls.prefix
+
     @classmethod
     def print_step(cls, text: str) -> None:
-        prefix = cls.prefix + " " * cls.level
+        prefix = cls.tag_prefix() + " " * cls.level()
         if sys.exc_info()[0]:
             # We are falling through exception handling blocks.
             # De-emphasize this step here, so the user can tell more
@@ -818,20 +1180,21 @@ class MkosiPrinter:
 
     @classmethod
     def warn(cls, text: str) -> None:
-        cls._print(f"{cls.prefix}{cls.color_error(text)}\n")
+        cls._print(f"{cls.tag_prefix()}{cls.color_error(text)}\n")
 
     @classmethod
     @contextlib.contextmanager
     def complete_step(cls, text: str, text2: Optional[str] = None) -> Iterator[List[Any]]:
         cls.print_step(text)
 
-        cls.level += 1
+        level = cls.level()
+        cls.set_level(level + 1)
         try:
-            args: List[Any] = []
-            yield args
+            with Tracer.span(text, level):
+                args: List[Any] = []
+                yield args
         finally:
-            cls.level -= 1
-            assert cls.level >= 0
+            cls.set_level(level)
 
         if text2 is not None:
             cls.print_step(text2.format(*args))
@@ -928,19 +1291,3 @@ def sort_packages(packages: Iterable[str]) -> List[str]:
     m = {"(": 2, "/": 1}
     sort = lambda name: (m.get(name[0], 0), name)
     return sorted(packages, key=sort)
-
-
-def scandir_recursive(
-    root: Path,
-    filter: Optional[Callable[[os.DirEntry[str]], T]] = None,
-) -> Iterator[T]:
-    """Recursively walk the tree starting at @root, optionally apply filter, yield non-none values"""
-    queue: Deque[Union[str, Path]] = collections.deque([root])
-
-    while queue:
-        for entry in os.scandir(queue.pop()):
-            pred = filter(entry) if filter is not None else entry
-            if pred is not None:
-                yield cast(T, pred)
-            if entry.is_dir(follow_symlinks=False):
-                queue.append(entry.path)
@@ -0,0 +1,203 @@
+# SPDX-License-Identifier: LGPL-2.1+
+
+"""Single pass over an image file that computes its block map and checksum and punches holes into it"""
+
+import ctypes
+import ctypes.util
+import dataclasses
+import errno
+import functools
+import hashlib
+import itertools
+import os
+from pathlib import Path
+from typing import List, Optional, TextIO, Tuple
+
+BLOCK_SIZE = 4096
+# Must be a multiple of BLOCK_SIZE.
+BUFFER_SIZE = 4 * 1024**2
+ZEROES = memoryview(bytes(BUFFER_SIZE))
+
+FALLOC_FL_KEEP_SIZE = 0x01
+FALLOC_FL_PUNCH_HOLE = 0x02
+
+
+@dataclasses.dataclass
+class BlockRange:
+    """An inclusive range of mapped blocks and the SHA256 digest of their contents"""
+
+    first: int
+    last: int
+    sha256: "hashlib._Hash"
+
+
+@dataclasses.dataclass
+class ImageScan:
+    size: int
+    block_size: int
+    ranges: List[BlockRange]
+    sha256: Optional[str]
+
+    @property
+    def blocks_count(self) -> int:
+        return (self.size + self.block_size - 1) // self.block_size
+
+    @property
+    def mapped_blocks_count(self) -> int:
+        return sum(r.last - r.first + 1 for r in self.ranges)
+
+
+@functools.lru_cache(maxsize=None)
+def libc() -> ctypes.CDLL:
+    libc_name = ctypes.util.find_library("c")
+    if libc_name is None:
+        raise OSError(errno.ENOENT, "Could not find libc")
+    lib = ctypes.CDLL(libc_name, use_errno=True)
+    lib.fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+    return lib
+
+
+def punch_hole(fd: int, offset: int, length: int) -> None:
+    """Deallocate @length bytes at @offset of @fd, which read back as zeroes afterwards"""
+    if libc().fallocate(fd, FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE, offset, length) != 0:
+        e = ctypes.get_errno()
+        raise OSError(e, os.strerror(e))
+
+
+def hash_zeroes(h: "hashlib._Hash", length: int) -> None:
+    while length > 0:
+        n = min(length, BUFFER_SIZE)
+        h.update(ZEROES[:n])
+        length -= n
+
+
+def is_zero(data: memoryview) -> bool:
+    return data == ZEROES[:len(data)]
+
+
+def data_regions(fd: int, size: int) -> List[Tuple[int, int]]:
+    """Return the [start, end) offsets of the data regions of @fd, i.e. everything except holes"""
+    regions = []
+    offset = 0
+
+    while offset < size:
+        try:
+            start = os.lseek(fd, offset, os.SEEK_DATA)
+        except OSError as e:
+            if e.errno == errno.ENXIO:
+                break
+            raise
+        end = min(os.lseek(fd, start, os.SEEK_HOLE), size)
+        regions.append((start, end))
+        offset = end
+
+    return regions
+
+
+def scan_image(
+    path: Path,
+    *,
+    punch_holes: bool = False,
+    checksum: bool = False,
+    block_size: int = BLOCK_SIZE,
+) -> ImageScan:
+    """Read @path once, computing its block map and, with @checksum, the SHA256 digest of the whole file
+
+    Holes are found with SEEK_DATA/SEEK_HOLE and never read. With
+    @punch_holes, blocks that only contain zeroes are turned into holes,
+    like `fallocate --dig-holes` does, and are left out of the block map.
+    The digest of the whole file is computed from the same buffers, with
+    holes hashed as zeroes.
+    """
+    assert BUFFER_SIZE % block_size == 0
+
+    buf = bytearray(BUFFER_SIZE)
+    view = memoryview(buf)
+    ranges: List[BlockRange] = []
+    file_hash = hashlib.sha256() if checksum else None
+    hashed = 0
+
+    def map_blocks(first: int, data: memoryview) -> None:
+        last = first + (len(data) + block_size - 1) // block_size - 1
+        if ranges and ranges[-1].last == first - 1:
+            ranges[-1].last = last
+        else:
+            ranges.append(BlockRange(first, last, hashlib.sha256()))
+        ranges[-1].sha256.update(data)
+
+    with open(path, "r+b" if punch_holes else "rb", buffering=0) as f:
+        fd = f.fileno()
+        size = os.fstat(fd).st_size
+        next_block = 0
+
+        for start, end in data_regions(fd, size):
+            # Regions that aren't aligned to our block size might share a block with the previous one, which we
+            # already read completely.
+            first = max(start // block_size, next_block)
+            next_block = (end + block_size - 1) // block_size
+            offset = first * block_size
+            end = min(next_block * block_size, size)
+
+            while offset < end:
+                n = os.preadv(fd, [view[:min(BUFFER_SIZE, end - offset)]], offset)
+                if n == 0:
+                    break
+                data = view[:n]
+
+                if file_hash is not None:
+                    hash_zeroes(file_hash, offset - hashed)
+                    file_hash.update(data)
+                    hashed = offset + n
+
+                block = offset // block_size
+                if not punch_holes:
+                    map_blocks(block, data)
+                else:
+                    # Punch runs of zero blocks with a single call and map the runs between them.
+                    blocks = range(0, n, block_size)
+                    for zero, group in itertools.groupby(blocks, lambda i: is_zero(data[i:i + block_size])):
+                        indices = list(group)
+                        lo, hi = indices[0], min(indices[-1] + block_size, n)
+                        if zero:
+                            punch_hole(fd, offset + lo, hi - lo)
+                        else:
+                            map_blocks(block + lo // block_size, data[lo:hi])
+
+                offset += n
+
+        if file_hash is not None:
+            hash_zeroes(file_hash, size - hashed)
+
+    return ImageScan(size, block_size, ranges, file_hash.hexdigest() if file_hash is not None else None)
+
+
+def write_bmap(scan: ImageScan, f: TextIO) -> None:
+    """Write @scan as a block map in the format understood by bmaptool"""
+    mapped = scan.mapped_blocks_count
+    percent = 100 * mapped / scan.blocks_count if scan.blocks_count else 0
+    ranges = "".join(
+        f'        <Range chksum="{r.sha256.hexdigest()}"> '
+        f'{r.first if r.first == r.last else f"{r.first}-{r.last}"} </Range>\n'
+        for r in scan.ranges
+    )
+
+    # The checksum of the file is calculated with the checksum itself replaced by zeroes.
+    bmap = (
+        '<?xml version="1.0" ?>\n'
+        '<!-- Block map of an image file, listing the blocks that contain data and have to be copied -->\n'
+        '<bmap version="2.0">\n'
+        f'    <!-- Image size in bytes: {scan.size} -->\n'
+        f'    <ImageSize> {scan.size} </ImageSize>\n'
+        f'    <BlockSize> {scan.block_size} </BlockSize>\n'
+        f'    <BlocksCount> {scan.blocks_count} </BlocksCount>\n'
+        f'    <!-- Count of mapped blocks: {percent:.1f}% -->\n'
+        f'    <MappedBlocksCount> {mapped} </MappedBlocksCount>\n'
+        '    <ChecksumType> sha256 </ChecksumType>\n'
+        f'    <BmapFileChecksum> {"0" * 64} </BmapFileChecksum>\n'
+        '    <BlockMap>\n'
+        f'{ranges}'
+        '    </BlockMap>\n'
+        '</bmap>\n'
+    )
+    digest = hashlib.sha256(bmap.encode()).hexdigest()
+    f.write(bmap.replace("0" * 64, digest, 1))
@@ -0,0 +1,322 @@
+# SPDX-License-Identifier: LGPL-2.1+
+
+import dataclasses
+import hashlib
+import json
+import os
+import re
+import stat
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from mkosi.backend import Checkpoint, MkosiConfig
+
+
+@dataclasses.dataclass(frozen=True)
+class CacheStage:
+    """The inputs consumed by a group of build steps
+
+    @settings are compared by value. @trees name files or directories which are
+    identified by their metadata, @scripts name files identified by their
+    contents.
+    """
+
+    settings: Tuple[str, ...] = ()
+    build_settings: Tuple[str, ...] = ()
+    trees: Tuple[str, ...] = ()
+    scripts: Tuple[str, ...] = ()
+
+
+# The inputs of the build steps that are skipped when a cached tree is reused, in the order these steps run.
+# Settings that are only used after that point (e.g. PostInstallationScript=, ExtraTrees= or the output format) must
+# not be listed here, so changing them doesn't needlessly invalidate the cache. ImageVersion= is deliberately left
+# out so that bumping the version reuses the cache.
+CACHE_STAGES: Dict[Optional[Checkpoint], CacheStage] = {
+    Checkpoint.distribution: CacheStage(
+        settings=(
+            "distribution",
+            "release",
+            "mirror",
+            "local_mirror",
+            "repository_key_check",
+            "repositories",
+            "use_host_repositories",
+            "architecture",
+            "bootable",
+            "base_packages",
+            "packages",
+            "with_docs",
+            "with_tests",
+            # These add packages or configure the tree while the distribution is installed.
+            "with_network",
+            "password",
+            "password_is_hashed",
+            "autologin",
+            "netdev",
+            "ssh",
+            # prepare_tree() writes the machine ID into the tree before anything is installed.
+            "machine_id",
+        ),
+        build_settings=("build_packages",),
+        trees=("skeleton_trees", "repos_dir", "base_image"),
+    ),
+    Checkpoint.prepare: CacheStage(
+        settings=(
+            "image_id",
+            "hostname",
+            "environment",
+            "build_sources",
+            "qemu_headless",
+        ),
+        scripts=("prepare_script",),
+    ),
+    # The remaining steps up to the complete cached tree.
+    None: CacheStage(
+        settings=(
+            "kernel_command_line",
+            "cache_initrd",
+            "ssh_port",
+        ),
+    ),
+}
+
+# The settings that are deliberately not part of CACHE_STAGES because they don't change the contents of a cached
+# tree: they are only used after the cached steps, select what happens to the tree afterwards or only affect how mkosi
+# itself runs. Every setting has to be either listed in CACHE_STAGES or here.
+UNCACHED_SETTINGS = frozenset({
+    # The command line and the selection of what to build.
+    "verb",
+    "cmdline",
+    "force",
+    "directory",
+    "config_path",
+    "all",
+    "all_directory",
+    "dependencies",
+    "auto_bump",
+    # Where mkosi keeps its outputs, caches and work directories.
+    "output",
+    "output_dir",
+    "workspace_dir",
+    "cache_path",
+    "build_dir",
+    "include_dir",
+    "install_dir",
+    "chown",
+    # How mkosi runs its steps.
+    "incremental",
+    "checkpoints",
+    "jobs",
+    "pipeline_build",
+    "debug",
+    "trace",
+    "extra_search_paths",
+    "idmap",
+    "nspawn_keep_unit",
+    "workspace_session",
+    # Bumped with every build, see above.
+    "image_version",
+    # The build script and its sources are installed after the cached steps.
+    "build_script",
+    "skip_final_phase",
+    "source_file_transfer",
+    "source_file_transfer_final",
+    "source_resolve_symlinks",
+    "source_resolve_symlinks_final",
+    # The steps after the cached tree is complete.
+    "extra_trees",
+    "postinst_script",
+    "finalize_script",
+    "remove_packages",
+    "remove_files",
+    "clean_package_metadata",
+    "ssh_key",
+    "ssh_agent",
+    "secure_boot",
+    "secure_boot_key",
+    "secure_boot_certificate",
+    "secure_boot_valid_days",
+    "secure_boot_common_name",
+    "sign_expected_pcr",
+    # How the tree is turned into the output and what is generated alongside it.
+    "output_format",
+    "repart_dir",
+    "manifest_format",
+    "compress_output",
+    "qcow2",
+    "tar_strip_selinux_context",
+    "split_artifacts",
+    "checksum",
+    "sign",
+    "key",
+    "bmap",
+    "nspawn_settings",
+    "passphrase",
+    # Only used when running the image.
+    "ephemeral",
+    "ssh_timeout",
+    "qemu_smp",
+    "qemu_mem",
+    "qemu_kvm",
+    "qemu_args",
+    "qemu_boot",
+})
+
+FINGERPRINT_LENGTH = 16
+
+
+def digest(data: Any) -> str:
+    s = json.dumps(data, sort_keys=True, default=str)
+    return hashlib.sha256(s.encode()).hexdigest()[:FINGERPRINT_LENGTH]
+
+
+def tree_metadata(path: Path) -> List[Any]:
+    """Return the name, type, size and modification time of @path and everything below it"""
+    if not os.path.lexists(path):
+        return [str(path), None]
+
+    entries = []
+    for dirpath, dirnames, filenames in os.walk(path):
+        dirnames.sort()
+        for name in [".", *sorted(filenames), *dirnames]:
+            p = os.path.join(dirpath, name)
+            st = os.lstat(p)
+            link = os.readlink(p) if os.path.islink(p) else None
+            entries += [os.path.relpath(p, path), st.st_mode, st.st_size, st.st_mtime_ns, link]
+
+    if not entries:
+        # A file or a symlink instead of a directory.
+        st = os.stat(path)
+        entries = [str(path), st.st_mode, st.st_size, st.st_mtime_ns]
+
+    return entries
+
+
+def tree_contents(path: Path) -> List[Any]:
+    """Return the name, type and contents of everything below @path"""
+    entries: List[Any] = []
+    for dirpath, dirnames, filenames in os.walk(path):
+        dirnames.sort()
+        for name in sorted(filenames + dirnames):
+            p = Path(dirpath) / name
+            st = p.lstat()
+            if stat.S_ISLNK(st.st_mode):
+                data = os.readlink(p)
+            elif stat.S_ISREG(st.st_mode):
+                data = file_contents(p)
+            else:
+                data = None
+            entries += [str(p.relative_to(path)), st.st_mode, data]
+
+    return entries
+
+
+def file_contents(path: Path) -> Optional[str]:
+    if not path.exists():
+        return None
+
+    h = hashlib.sha256()
+    with path.open("rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+
+    return h.hexdigest()
+
+
+def cache_components(
+    config: MkosiConfig,
+    is_final_image: bool,
+    checkpoint: Optional[Checkpoint] = None,
+) -> Dict[str, str]:
+    """Return a digest for every input that determines the contents of a cached tree
+
+    The digests are keyed by setting name, which allows telling which settings
+    changed between two cached trees. Without @checkpoint, the inputs of all
+    steps that are cached are included, otherwise only the ones of the steps up
+    to @checkpoint.
+    """
+    from mkosi import __version__
+
+    values = dataclasses.asdict(config)
+    components = {"mkosi": digest(__version__)}
+
+    for stage, inputs in CACHE_STAGES.items():
+        settings = inputs.settings if is_final_image else inputs.settings + inputs.build_settings
+        components.update({name: digest(values[name]) for name in settings})
+
+        for name in inputs.trees:
+            value = getattr(config, name)
+            paths = value if isinstance(value, list) else [value] if value else []
+            components[name] = digest([tree_metadata(Path(p)) for p in paths])
+
+        for name in inputs.scripts:
+            value = getattr(config, name)
+            components[name] = digest(file_contents(value) if value else None)
+
+        if stage == checkpoint:
+            break
+
+    return components
+
+
+def extra_trees_components(config: MkosiConfig, install_dir: Optional[Path]) -> Dict[str, str]:
+    """Return the inputs of the final image at the extra trees checkpoint
+
+    This builds on the complete cached tree and adds the output of the build
+    script in @install_dir, which is identified by its contents as it is
+    regenerated on every build, as well as the extra trees.
+    """
+    components = cache_components(config, is_final_image=True)
+    components["extra_trees"] = digest([tree_metadata(p) for p in config.extra_trees])
+    components["install_dir"] = digest(tree_contents(install_dir) if install_dir else None)
+
+    return components
+
+
+def cache_fingerprint(components: Dict[str, str]) -> str:
+    return digest(components)
+
+
+def cache_variants(prefix: Path, suffix: str) -> List[Path]:
+    """Return all cached trees for @prefix and @suffix, regardless of their fingerprint, newest first"""
+    if not prefix.parent.exists():
+        return []
+
+    pattern = re.compile(rf"{re.escape(prefix.name)}\.[0-9a-f]{{{FINGERPRINT_LENGTH}}}\.{re.escape(suffix)}")
+    variants = [p for p in prefix.parent.iterdir() if pattern.fullmatch(p.name)]
+
+    return sorted(variants, key=lambda p: os.lstat(p).st_mtime_ns, reverse=True)
+
+
+def cache_sidecar(cache: Path) -> Path:
+    return cache.with_name(f"{cache.name}.json")
+
+
+def write_cache_components(cache: Path, components: Dict[str, str]) -> None:
+    with cache_sidecar(cache).open("w") as f:
+        json.dump({"fingerprint": cache_fingerprint(components), "components": components}, f, indent=2)
+
+
+def read_cache_components(cache: Path) -> Optional[Dict[str, str]]:
+    try:
+        with cache_sidecar(cache).open() as f:
+            components: Dict[str, str] = json.load(f)["components"]
+            return components
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def cache_miss_reason(cache: Path, variants: List[Path], components: Dict[str, str]) -> str:
+    """Explain why there is no cached tree at @cache by comparing with the newest of @variants"""
+    for other in variants:
+        if other == cache:
+            continue
+
+        previous = read_cache_components(other)
+        if previous is None:
+            continue
+
+        changed = sorted(k for k in components.keys() | previous.keys() if components.get(k) != previous.get(k))
+        return f"{', '.join(changed)} changed since {other.name}"
+
+    return "no cached tree found"
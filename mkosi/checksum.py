@@ -0,0 +1,80 @@
+# SPDX-License-Identifier: LGPL-2.1+
+
+import concurrent.futures
+import hashlib
+import os
+import threading
+from pathlib import Path
+from typing import IO, Dict, Iterable, Optional, Tuple
+
+from mkosi.backend import PathString
+
+BUFFER_SIZE = 4 * 1024**2
+
+# Digests of files we hashed or wrote ourselves, keyed by the identity of the file contents: device, inode, size
+# and modification time.
+DigestKey = Tuple[int, int, int, int]
+digests: Dict[DigestKey, str] = {}
+digests_lock = threading.Lock()
+
+buffers = threading.local()
+
+
+def digest_key(path: PathString) -> DigestKey:
+    st = os.stat(path)
+    return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+def seed_sha256(path: PathString, digest: str) -> None:
+    """Remember the SHA256 digest of @path computed while it was written, so it doesn't have to be read again"""
+    with digests_lock:
+        digests[digest_key(path)] = digest
+
+
+def sha256_file(path: PathString) -> str:
+    """Return the SHA256 digest of @path, reusing a previously computed digest if the file didn't change"""
+    key = digest_key(path)
+    with digests_lock:
+        if key in digests:
+            return digests[key]
+
+    # Every thread reads into its own buffer, which is reused for all files it hashes.
+    buf = getattr(buffers, "buf", None)
+    if buf is None:
+        buf = buffers.buf = bytearray(BUFFER_SIZE)
+    view = memoryview(buf)
+
+    h = hashlib.sha256()
+    with open(path, "rb", buffering=0) as f:
+        while True:
+            n = f.readinto(view)
+            if not n:
+                break
+            h.update(view[:n])
+
+    digest = h.hexdigest()
+    with digests_lock:
+        digests[key] = digest
+
+    return digest
+
+
+def sha256_files(paths: Iterable[Path], workers: Optional[int] = None) -> Dict[Path, str]:
+    """Return the SHA256 digests of @paths, hashing up to @workers files concurrently
+
+    hashlib releases the GIL while hashing large buffers, so threads are
+    enough to keep multiple cores busy.
+    """
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {p: executor.submit(sha256_file, p) for p in paths}
+        return {p: f.result() for p, f in futures.items()}
+
+
+def copy_and_sha256(src: IO[bytes], dst: IO[bytes]) -> str:
+    """Copy @src to @dst until EOF and return the SHA256 digest of everything that was copied"""
+    h = hashlib.sha256()
+    for chunk in iter(lambda: src.read(BUFFER_SIZE), b""):
+        h.update(chunk)
+        dst.write(chunk)
+
+    return h.hexdigest()
@@ -0,0 +1,127 @@
+# SPDX-License-Identifier: LGPL-2.1+
+
+"""Writer for cpio archives in the "newc" format, as used for initrds"""
+
+import os
+import stat
+from pathlib import Path
+from typing import IO, Dict, List, Optional, Tuple
+
+from mkosi.backend import die
+
+MAGIC = b"070701"
+TRAILER = b"TRAILER!!!"
+BUFFER_SIZE = 1024**2
+# All header fields are 32 bit hexadecimal numbers.
+MAX_FIELD = 0xFFFFFFFF
+
+
+def padding(size: int) -> bytes:
+    return b"\0" * (-size % 4)
+
+
+def cpio_header(
+    name: bytes,
+    *,
+    ino: int = 0,
+    mode: int = 0,
+    uid: int = 0,
+    gid: int = 0,
+    nlink: int = 1,
+    mtime: int = 0,
+    size: int = 0,
+    rdev: int = 0,
+) -> bytes:
+    """Return the header of an entry called @name, including the name itself and its padding"""
+    if size > MAX_FIELD:
+        die(f"{os.fsdecode(name)} is too large for a cpio archive: {size} bytes, the newc format only supports "
+            f"files up to {MAX_FIELD} bytes.")
+
+    fields = [ino, mode, uid, gid, nlink, mtime, size, 0, 0, os.major(rdev), os.minor(rdev), len(name) + 1, 0]
+    header = MAGIC + b"".join(b"%08X" % f for f in fields) + name + b"\0"
+    return header + padding(len(header))
+
+
+def cpio_entries(root: Path) -> List[Tuple[bytes, os.stat_result]]:
+    """Return the relative path and stat data of everything below @root, sorted by path
+
+    Parent directories sort before their contents, as a path sorts before all
+    paths it is a prefix of.
+    """
+    entries = []
+    queue = [(os.fsencode(root), b"")]
+
+    while queue:
+        path, prefix = queue.pop()
+        with os.scandir(path) as it:
+            for entry in it:
+                name = prefix + entry.name
+                st = entry.stat(follow_symlinks=False)
+                entries.append((name, st))
+                if stat.S_ISDIR(st.st_mode):
+                    queue.append((entry.path, name + b"/"))
+
+    entries.sort(key=lambda e: e[0])
+    return entries
+
+
+def copy_data(out: IO[bytes], path: bytes, size: int) -> None:
+    """Write exactly @size bytes of @path to @out, so the header stays valid if the file changes meanwhile"""
+    remaining = size
+    with open(path, "rb", buffering=0) as f:
+        while remaining:
+            chunk = f.read(min(remaining, BUFFER_SIZE))
+            if not chunk:
+                break
+            out.write(chunk)
+            remaining -= len(chunk)
+
+    out.write(b"\0" * remaining)
+
+
+def write_cpio(out: IO[bytes], root: Path, mtime_clamp: Optional[int] = None) -> None:
+    """Write a newc cpio archive of everything below @root to @out
+
+    The archive is reproducible: entries are sorted by path, inodes are
+    numbered in that order and modification times are clamped to
+    @mtime_clamp, if set. The data of files with multiple hardlinks is only
+    stored once, with the last link, like GNU cpio does.
+    """
+    entries = cpio_entries(root)
+    rootb = os.fsencode(root)
+
+    # Map every inode to a reproducible number and to the names of its hardlinks in the archive.
+    inodes: Dict[Tuple[int, int], int] = {}
+    links: Dict[int, List[bytes]] = {}
+    for name, st in entries:
+        ino = inodes.setdefault((st.st_dev, st.st_ino), len(inodes) + 1)
+        links.setdefault(ino, []).append(name)
+
+    for name, st in entries:
+        ino = inodes[(st.st_dev, st.st_ino)]
+        mtime = int(st.st_mtime)
+        if mtime_clamp is not None:
+            mtime = min(mtime, mtime_clamp)
+
+        path = os.path.join(rootb, name)
+        data = b""
+        size = 0
+        if stat.S_ISLNK(st.st_mode):
+            data = os.readlink(path)
+            size = len(data)
+        elif stat.S_ISREG(st.st_mode) and links[ino][-1] == name:
+            size = st.st_size
+
+        nlink = 2 if stat.S_ISDIR(st.st_mode) else len(links[ino])
+        rdev = st.st_rdev if stat.S_ISCHR(st.st_mode) or stat.S_ISBLK(st.st_mode) else 0
+
+        out.write(cpio_header(name, ino=ino, mode=st.st_mode, uid=st.st_uid, gid=st.st_gid, nlink=nlink,
+                              mtime=mtime, size=size, rdev=rdev))
+
+        if data:
+            out.write(data)
+        elif size:
+            copy_data(out, path, size)
+        out.write(padding(size))
+
+    out.write(cpio_header(TRAILER))
@@ -19,6 +19,7 @@ from mkosi.backend import (
 from mkosi.distributions import DistributionInstaller
 from mkosi.install import install_skeleton_trees, write_resource
 from mkosi.mounts import mount_api_vfs, mount_bind
+from mkosi.probe import cached_probe
 
 if TYPE_CHECKING:
     CompletedProcess = subprocess.CompletedProcess[Any]
@@ -254,8 +255,11 @@ DEBIAN_KERNEL_ARCHITECTURES = {
 
 
 def debootstrap_knows_arg(arg: str) -> bool:
-    return bytes("invalid option", "UTF-8") not in run(["debootstrap", arg],
-                                                       stdout=subprocess.PIPE, check=False).stdout
+    def probe() -> bool:
+        return bytes("invalid option", "UTF-8") not in run(["debootstrap", arg],
+                                                           stdout=subprocess.PIPE, check=False).stdout
+
+    return cached_probe("debootstrap", f"knows-arg {arg}", probe)
 
 
 @contextlib.contextmanager
@@ -20,6 +20,7 @@ from mkosi.backend import (
 )
 from mkosi.distributions import DistributionInstaller
 from mkosi.mounts import mount_api_vfs
+from mkosi.probe import which
 from mkosi.remove import unlink_try_hard
 
 FEDORA_KEYS_MAP = {
@@ -233,7 +234,7 @@ def invoke_dnf(state: MkosiState, command: str, packages: Iterable[str]) -> None
 
     config_file = state.workspace / "dnf.conf"
 
-    cmd = 'dnf' if shutil.which('dnf') else 'yum'
+    cmd = 'dnf' if which('dnf') else 'yum'
 
     cmdline = [
         cmd,
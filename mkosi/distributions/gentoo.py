@@ -1,7 +1,5 @@
 # SPDX-License-Identifier: LGPL-2.1+
 
-import contextlib
-import fcntl
 import os
 import re
 import tarfile
@@ -9,7 +7,7 @@ import urllib.parse
 import urllib.request
 from pathlib import Path
 from textwrap import dedent
-from typing import Dict, Generator, List, Sequence
+from typing import Dict, List, Sequence
 
 from mkosi.backend import (
     ARG_DEBUG,
@@ -23,7 +21,7 @@ from mkosi.backend import (
     safe_tar_extract,
 )
 from mkosi.distributions import DistributionInstaller
-from mkosi.install import copy_path, open_close
+from mkosi.install import copy_path, flock_path
 from mkosi.remove import unlink_try_hard
 
 ARCHITECTURES = {
@@ -35,13 +33,6 @@ ARCHITECTURES = {
 }
 
 
-@contextlib.contextmanager
-def flock_path(path: Path) -> Generator[int, None, None]:
-    with open_close(path, os.O_RDONLY | os.O_DIRECTORY | os.O_CLOEXEC) as fd:
-        fcntl.flock(fd, fcntl.LOCK_EX)
-        yield fd
-
-
 class Gentoo:
     arch_profile: Path
     baselayout_use: Path
@@ -1,15 +1,30 @@
 # SPDX-License-Identifier: LGPL-2.1+
 
+import concurrent.futures
 import contextlib
 import errno
 import fcntl
 import importlib.resources
+import json
 import os
 import shutil
 import stat
+import threading
 from pathlib import Path
 from textwrap import dedent
-from typing import Any, BinaryIO, Iterator, Optional, cast
+from typing import (
+    Any,
+    BinaryIO,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    cast,
+)
 
 from mkosi.backend import MkosiState, PathString, complete_step
 
@@ -61,14 +76,74 @@ def open_close(path: PathString, flags: int, mode: int = 0o664) -> Iterator[int]
         os.close(fd)
 
 
+@contextlib.contextmanager
+def flock_path(path: PathString) -> Iterator[int]:
+    with open_close(path, os.O_RDONLY | os.O_DIRECTORY) as fd:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield fd
+
+
 def copy_fd(oldfd: int, newfd: int) -> None:
     try:
         reflink(oldfd, newfd)
     except OSError as e:
         if e.errno not in {errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTTY}:
             raise
-        # While mypy handles this correctly, Pyright doesn't yet.
-        shutil.copyfileobj(open(oldfd, "rb", closefd=False), cast(Any, open(newfd, "wb", closefd=False)))
+        copy_sparse(oldfd, newfd)
+
+
+def copy_sparse(oldfd: int, newfd: int) -> None:
+    """Copy the data of @oldfd to @newfd, skipping over holes"""
+    size = os.fstat(oldfd).st_size
+    offset = 0
+
+    while offset < size:
+        try:
+            data = os.lseek(oldfd, offset, os.SEEK_DATA)
+        except OSError as e:
+            if e.errno == errno.ENXIO:
+                # Only a hole remains.
+                break
+            if e.errno != errno.EINVAL:
+                raise
+            # The file system doesn't know about holes.
+            data = offset
+            hole = size
+        else:
+            hole = os.lseek(oldfd, data, os.SEEK_HOLE)
+
+        os.lseek(newfd, data, os.SEEK_SET)
+        while data < hole:
+            n = os.sendfile(newfd, oldfd, data, hole - data)
+            if n == 0:
+                # The file was truncated while we copied it.
+                size = data
+                break
+            data += n
+
+        offset = hole
+
+    os.ftruncate(newfd, size)
+
+
+def copy_xattrs(oldpath: PathString, newpath: PathString) -> None:
+    """Copy the extended attributes (including ACLs and SELinux labels) of @oldpath to @newpath"""
+    try:
+        names = os.listxattr(oldpath, follow_symlinks=False)
+    except OSError as e:
+        if e.errno in {errno.ENOTSUP, errno.ENODATA}:
+            return
+        raise
+
+    for name in names:
+        try:
+            value = os.getxattr(oldpath, name, follow_symlinks=False)
+            os.setxattr(newpath, name, value, follow_symlinks=False)
+        except OSError as e:
+            # The target file system might not support the attribute, or we're not privileged enough to set it
+            # (e.g. trusted.*).
+            if e.errno not in {errno.ENOTSUP, errno.ENODATA, errno.EPERM, errno.EINVAL}:
+                raise
 
 
 def copy_file_object(oldobject: BinaryIO, newobject: BinaryIO) -> None:
@@ -100,6 +175,7 @@ def copy_file(oldpath: PathString, newpath: PathString) -> None:
             newpath.unlink()
             with open_close(newpath, os.O_WRONLY | os.O_CREAT, st.st_mode) as newfd:
                 copy_fd(oldfd, newfd)
+    copy_xattrs(oldpath, newpath)
     shutil.copystat(oldpath, newpath, follow_symlinks=False)
 
 
@@ -111,32 +187,245 @@ def symlink_f(target: str, path: Path) -> None:
         path.symlink_to(target)
 
 
-def copy_path(oldpath: PathString, newpath: Path, *, copystat: bool = True) -> None:
-    try:
-        newpath.mkdir(exist_ok=True)
-    except FileExistsError:
-        # something that is not a directory already exists
-        newpath.unlink()
-        newpath.mkdir()
-
-    for entry in os.scandir(oldpath):
-        newentry = newpath / entry.name
-        if entry.is_dir(follow_symlinks=False):
-            copy_path(entry.path, newentry)
-        elif entry.is_symlink():
-            target = os.readlink(entry.path)
-            symlink_f(target, newentry)
-            shutil.copystat(entry.path, newentry, follow_symlinks=False)
-        else:
-            st = entry.stat(follow_symlinks=False)
-            if stat.S_ISREG(st.st_mode):
-                copy_file(entry.path, newentry)
+def copy_symlink(oldpath: PathString, newpath: Path) -> None:
+    symlink_f(os.readlink(oldpath), newpath)
+    copy_xattrs(oldpath, newpath)
+    shutil.copystat(oldpath, newpath, follow_symlinks=False)
+
+
+CopyFunction = Callable[[PathString, Path], None]
+
+
+@contextlib.contextmanager
+def copy_pool(workers: Optional[int] = None) -> Iterator[Callable[[CopyFunction, PathString, Path], None]]:
+    """Yield a function that runs copy functions on a pool of @workers threads
+
+    The number of queued copies is bounded, so the producer is throttled
+    instead of building up a queue of every file in a tree when it is faster
+    than the copying. All copies have finished when the context is left, and
+    the first failure, if any, is raised then or on the next submission.
+    """
+    if workers is None:
+        workers = min(32, (os.cpu_count() or 1) + 4)
+
+    failures: List[BaseException] = []
+    slots = threading.BoundedSemaphore(workers * 8)
+
+    def done(future: "concurrent.futures.Future[None]") -> None:
+        slots.release()
+        e = future.exception()
+        if e is not None:
+            failures.append(e)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        def submit(fn: CopyFunction, old: PathString, new: Path) -> None:
+            if failures:
+                raise failures[0]
+            slots.acquire()
+            executor.submit(fn, old, new).add_done_callback(done)
+
+        yield submit
+
+    if failures:
+        raise failures[0]
+
+
+def copy_files(src: Path, dest: Path, paths: Iterable[str], *, workers: Optional[int] = None) -> None:
+    """Copy the files at @paths relative to @src to the same paths below @dest
+
+    The paths may be consumed lazily, e.g. while they're read from a pipe, and
+    are copied concurrently while that happens. Directories are copied
+    recursively.
+    """
+    created: Set[Path] = set()
+
+    with copy_pool(workers) as submit:
+        for path in paths:
+            src_path = src / path
+            dest_path = dest / path
+
+            if dest_path.parent not in created:
+                dest_path.parent.mkdir(parents=True, exist_ok=True)
+                created.add(dest_path.parent)
+
+            if src_path.is_dir() and not src_path.is_symlink():
+                copy_path(src_path, dest_path, workers=workers)
             else:
-                print("Ignoring", entry.path)
-                continue
+                submit(copy_file, src_path, dest_path)
+
+
+def copy_path(
+    oldpath: PathString,
+    newpath: Path,
+    *,
+    copystat: bool = True,
+    workers: Optional[int] = None,
+) -> None:
+    """Copy the directory tree @oldpath to @newpath
+
+    The tree is walked by the calling thread while files and symlinks are
+    copied by a pool of @workers threads. Files are copied sparsely and
+    hardlinks within the tree are preserved. Permissions, timestamps and
+    extended attributes of directories are applied once all their children
+    were copied, and for @newpath itself only if @copystat is true.
+    """
+    directories: List[Tuple[PathString, Path]] = []
+    # Maps the inodes of files with multiple links to their first copy, the other links are created once it
+    # was copied.
+    inodes: Dict[Tuple[int, int], Path] = {}
+    links: List[Tuple[Path, Path]] = []
+
+    with copy_pool(workers) as submit:
+        todo: List[Tuple[PathString, Path]] = [(oldpath, newpath)]
+        while todo:
+            old, new = todo.pop()
+
+            try:
+                new.mkdir(exist_ok=True)
+            except FileExistsError:
+                # something that is not a directory already exists
+                new.unlink()
+                new.mkdir()
+
+            if copystat or new != newpath:
+                directories.append((old, new))
+
+            for entry in os.scandir(old):
+                newentry = new / entry.name
+                if entry.is_dir(follow_symlinks=False):
+                    todo.append((entry.path, newentry))
+                elif entry.is_symlink():
+                    submit(copy_symlink, entry.path, newentry)
+                else:
+                    st = entry.stat(follow_symlinks=False)
+                    if stat.S_ISREG(st.st_mode) and st.st_nlink > 1 and (st.st_dev, st.st_ino) in inodes:
+                        links.append((inodes[st.st_dev, st.st_ino], newentry))
+                    elif stat.S_ISREG(st.st_mode):
+                        if st.st_nlink > 1:
+                            inodes[st.st_dev, st.st_ino] = newentry
+                        submit(copy_file, entry.path, newentry)
+                    else:
+                        print("Ignoring", entry.path)
+
+    for target, link in links:
+        try:
+            os.link(target, link)
+        except FileExistsError:
+            link.unlink()
+            os.link(target, link)
+
+    # Directories were recorded before their subdirectories, so going backwards handles children first.
+    for old, new in reversed(directories):
+        copy_xattrs(old, new)
+        shutil.copystat(old, new, follow_symlinks=True)
 
-    if copystat:
-        shutil.copystat(oldpath, newpath, follow_symlinks=True)
+
+def remove_path(path: Path) -> None:
+    if path.is_dir() and not path.is_symlink():
+        shutil.rmtree(path)
+    else:
+        path.unlink()
+
+
+def in_sync(path: Path, entry: List[Any]) -> bool:
+    """Return whether @path still has the metadata @entry that sync_path() recorded for its source
+
+    Only the type of directories is compared, as their size and modification time change whenever something is
+    built in them. sync_path() restores their metadata anyway.
+    """
+    try:
+        st = path.lstat()
+    except FileNotFoundError:
+        return False
+
+    if stat.S_ISDIR(entry[0]):
+        return stat.S_ISDIR(st.st_mode)
+
+    link = os.readlink(path) if stat.S_ISLNK(st.st_mode) else None
+    return [st.st_mode, st.st_size, st.st_mtime_ns, link] == entry
+
+
+def sync_path(
+    src: Path,
+    dest: Path,
+    index: Path,
+    *,
+    ignore: Optional[Callable[[str, List[str]], Iterable[str]]] = None,
+    workers: Optional[int] = None,
+) -> None:
+    """Make @dest a copy of @src, copying only what changed since the last sync
+
+    @index records the type, size, modification time and mode of every entry
+    of @src that was synced to @dest. Entries that didn't change since, and
+    whose copy in @dest still has the same metadata, are left alone, so they
+    keep their inodes and timestamps and build systems working on @dest only
+    rebuild what actually changed. Copies that were modified in @dest, e.g.
+    by a build, are refreshed. Entries that were removed from @src (or are
+    now ignored) are removed from @dest as well. The metadata of all
+    directories is synced last, so their modification times match @src
+    even if entries were copied into or removed from them. @ignore works
+    like the argument of the same name of shutil.copytree().
+    """
+    old: Dict[str, List[Any]] = {}
+    if dest.exists():
+        try:
+            old = json.loads(index.read_text())
+        except (FileNotFoundError, ValueError):
+            pass
+
+    new: Dict[str, List[Any]] = {}
+    directories: List[Tuple[Path, Path]] = [(src, dest)]
+
+    dest.mkdir(mode=0o755, exist_ok=True)
+
+    with copy_pool(workers) as submit:
+        for dirpath, dirnames, filenames in os.walk(src):
+            names = dirnames + filenames
+            ignored = set(ignore(dirpath, names)) if ignore else set()
+            dirnames[:] = [d for d in dirnames if d not in ignored]
+
+            for name in names:
+                if name in ignored:
+                    continue
+
+                srcpath = Path(dirpath) / name
+                path = str(srcpath.relative_to(src))
+                target = dest / path
+
+                st = srcpath.lstat()
+                link = os.readlink(srcpath) if stat.S_ISLNK(st.st_mode) else None
+                new[path] = [st.st_mode, st.st_size, st.st_mtime_ns, link]
+
+                if stat.S_ISDIR(st.st_mode):
+                    # Directories are always visited, so their metadata is restored once their entries are synced.
+                    directories.append((srcpath, target))
+
+                if new[path] == old.get(path) and in_sync(target, new[path]):
+                    continue
+
+                if os.path.lexists(target) and stat.S_IFMT(target.lstat().st_mode) != stat.S_IFMT(st.st_mode):
+                    remove_path(target)
+
+                if stat.S_ISDIR(st.st_mode):
+                    target.mkdir(exist_ok=True)
+                elif stat.S_ISLNK(st.st_mode):
+                    submit(copy_symlink, srcpath, target)
+                elif stat.S_ISREG(st.st_mode):
+                    submit(copy_file, srcpath, target)
+                else:
+                    del new[path]
+
+    # Going backwards removes the children of a directory before the directory itself.
+    for path in sorted(old.keys() - new.keys(), reverse=True):
+        if os.path.lexists(dest / path):
+            remove_path(dest / path)
+
+    for srcpath, target in reversed(directories):
+        shutil.copystat(srcpath, target, follow_symlinks=False)
+
+    tmp = index.with_name(f".{index.name}.tmp")
+    tmp.write_text(json.dumps(new))
+    tmp.rename(index)
 
 
 def install_skeleton_trees(state: MkosiState, cached: bool, *, late: bool=False) -> None:
@@ -1,15 +1,20 @@
 # SPDX-License-Identifier: LGPL-2.1+
 
+import concurrent.futures
 import dataclasses
 import json
+import os
+import re
 from datetime import datetime
 from pathlib import Path
-from subprocess import DEVNULL, PIPE
+from subprocess import PIPE
 from textwrap import dedent
 from typing import IO, Any, Dict, List, Optional, Tuple, cast
 
 from mkosi.backend import Distribution, ManifestFormat, MkosiConfig, PackageType, run
 
+DEB_CHANGELOG_WORKERS = 8
+
 
 @dataclasses.dataclass
 class PackageManifest:
@@ -25,12 +30,13 @@ class PackageManifest:
     architecture: str
     size: int
 
-    def as_dict(self) -> Dict[str, str]:
+    def as_dict(self) -> Dict[str, Any]:
         return {
             "type": self.type,
             "name": self.name,
             "version": self.version,
             "architecture": self.architecture,
+            "size": self.size,
         }
 
 
@@ -58,21 +64,55 @@ class SourcePackageManifest:
         return t
 
 
-def parse_pkg_desc(f: Path) -> Tuple[str, str, str, str]:
-    name = version = base = arch = ""
+def parse_pkg_desc(f: Path) -> Tuple[str, str, str, str, int, datetime]:
+    """Return the name, version, base, architecture, size and install time of a pacman package"""
+    fields: Dict[str, str] = {}
     with f.open() as desc:
         for line in desc:
             line = line.strip()
-            if line == "%NAME%":
-                name = next(desc).strip()
-            elif line == "%VERSION%":
-                version = next(desc).strip()
-            elif line == "%BASE%":
-                base = next(desc).strip()
-            elif line == "%ARCH%":
-                arch = next(desc).strip()
-                break
-    return name, version, base, arch
+            if line.startswith("%") and line.endswith("%"):
+                fields[line] = next(desc, "").strip()
+
+    return (
+        fields.get("%NAME%", ""),
+        fields.get("%VERSION%", ""),
+        fields.get("%BASE%", ""),
+        fields.get("%ARCH%", ""),
+        int(fields.get("%SIZE%") or 0),
+        datetime.fromtimestamp(int(fields.get("%INSTALLDATE%") or 0)),
+    )
+
+
+# The version suffix of a Gentoo package name, see https://projects.gentoo.org/pms/8/pms.html#x1-250003.2.
+GENTOO_VERSION = re.compile(r"-([0-9]+(\.[0-9]+)*[a-z]?((_(alpha|beta|pre|rc|p)[0-9]*)*)(-r[0-9]+)?)$")
+
+
+def parse_vdb_entry(path: Path) -> Tuple[str, str, str, int, datetime]:
+    """Return the name, source, version, size and install time of a package in the portage database
+
+    Packages installed in multiple slots are named after their slot, e.g.
+    dev-lang/python:3.11, as their name alone is not unique.
+    """
+    def read(name: str) -> str:
+        try:
+            return path.joinpath(name).read_text().strip()
+        except FileNotFoundError:
+            return ""
+
+    category = read("CATEGORY") or path.parent.name
+    pf = read("PF") or path.name
+    m = GENTOO_VERSION.search(pf)
+    pn, version = (pf[:m.start()], m.group(1)) if m else (pf, "")
+
+    source = f"{category}/{pn}"
+    # The subslot after the slash doesn't distinguish parallel installations.
+    slot = read("SLOT").partition("/")[0]
+    name = f"{source}:{slot}" if slot and slot != "0" else source
+
+    # Portage doesn't record when a package was merged, but its database entry is created at that point.
+    installtime = datetime.fromtimestamp(path.stat().st_mtime)
+
+    return name, source, version, int(read("SIZE") or 0), installtime
 
 
 @dataclasses.dataclass
@@ -93,7 +133,8 @@ class Manifest:
             self.record_deb_packages(root)
         if cast(Any, self.config.distribution).package_type == PackageType.pkg:
             self.record_pkg_packages(root)
-        # TODO: add implementations for other package managers
+        if cast(Any, self.config.distribution).package_type == PackageType.ebuild:
+            self.record_ebuild_packages(root)
 
     def record_rpm_packages(self, root: Path) -> None:
         # On Debian, rpm/dnf ship with a patch to store the rpmdb under ~/ so rpm
@@ -103,18 +144,23 @@ class Manifest:
         if not (root / dbpath).exists():
             dbpath = "/var/lib/rpm"
 
+        # Records and fields are separated by ASCII record and unit separators, as the changelogs span multiple
+        # lines. The changelog format matches the one of "rpm -q --changelog", which is an alias for this query
+        # format. Querying all changelogs at once avoids opening the rpmdb once per source package.
+        qf = "\x1f".join(["%{NEVRA}", "%{SOURCERPM}", "%{NAME}", "%{ARCH}", "%{SIZE}", "%{INSTALLTIME}"])
+        if self.need_source_info():
+            qf += "\x1f" + r"[* %{CHANGELOGTIME:day} %{CHANGELOGNAME}\n%{CHANGELOGTEXT}\n\n]"
+        qf += "\x1e"
+
         c = run(
-            ["rpm", f"--root={root}", f"--dbpath={dbpath}", "-qa", "--qf",
-             r"%{NEVRA}\t%{SOURCERPM}\t%{NAME}\t%{ARCH}\t%{SIZE}\t%{INSTALLTIME}\n"],
+            ["rpm", f"--root={root}", f"--dbpath={dbpath}", "-qa", "--qf", qf],
             stdout=PIPE,
             text=True,
         )
 
-        packages = sorted(c.stdout.splitlines())
-
-        for package in packages:
-            nevra, srpm, name, arch, size, installtime = package.split("\t")
+        packages = sorted(record.split("\x1f") for record in c.stdout.split("\x1e") if record)
 
+        for nevra, srpm, name, arch, size, installtime, *changelog in packages:
             assert nevra.startswith(f"{name}-")
             evra = nevra[len(name) + 1 :]
             # Some packages have architecture '(none)', and it's not part of NEVRA, e.g.:
@@ -143,12 +189,7 @@ class Manifest:
 
             source = self.source_packages.get(srpm)
             if source is None:
-                c = run(["rpm", f"--root={root}", f"--dbpath={dbpath}", "-q", "--changelog", nevra],
-                        stdout=PIPE,
-                        stderr=DEVNULL,
-                        text=True)
-                changelog = c.stdout.strip()
-                source = SourcePackageManifest(srpm, changelog)
+                source = SourcePackageManifest(srpm, changelog[0].strip())
                 self.source_packages[srpm] = source
 
             source.add(package)
@@ -156,15 +197,17 @@ class Manifest:
     def record_deb_packages(self, root: Path) -> None:
         c = run(
             ["dpkg-query", f"--admindir={root}/var/lib/dpkg", "--show", "--showformat",
-             r'${Package}\t${source:Package}\t${Version}\t${Architecture}\t${Installed-Size}\t${db-fsys:Last-Modified}\n'],
+             r'${Package}\t${source:Package}\t${Version}\t${Architecture}\t${Installed-Size}\t${db-fsys:Last-Modified}\t${source:Version}\n'],
             stdout=PIPE,
             text=True,
         )
 
         packages = sorted(c.stdout.splitlines())
+        # The binary package and version to look up the changelog of every source package with.
+        changelogs: Dict[str, Tuple[str, str]] = {}
 
         for package in packages:
-            name, source, version, arch, size, installtime = package.split("\t")
+            name, source, version, arch, size, installtime, source_version = package.split("\t")
 
             # dpkg records the size in KBs, the field is optional
             # db-fsys:Last-Modified is not available in very old dpkg, so just skip creating
@@ -187,49 +230,115 @@ class Manifest:
 
             source_package = self.source_packages.get(source)
             if source_package is None:
-                # Yes, --quiet is specified twice, to avoid output about download stats.
-                # Note that the argument of the 'changelog' verb is the binary package name,
-                # not the source package name.
-                cmd = [
-                    "apt-get",
-                    "--quiet",
-                    "--quiet",
-                    "-o", f"Dir={root}",
-                    "-o", f"DPkg::Chroot-Directory={root}",
-                    "changelog",
-                    name,
-                ]
-
-                # If we are building with docs then it's easy, as the changelogs are saved
-                # in the image, just fetch them. Otherwise they will be downloaded from the network.
-                if self.config.with_docs:
-                    # By default apt drops privileges and runs as the 'apt' user, but that means it
-                    # loses access to the build directory, which is 700.
-                    cmd += ["--option", "Acquire::Changelogs::AlwaysOnline=false",
-                            "--option", "Debug::NoDropPrivs=true"]
-                else:
-                    # Override the URL to avoid HTTPS, so that we don't need to install
-                    # ca-certificates to make it work.
-                    if self.config.distribution == Distribution.ubuntu:
-                        cmd += ["--option", "Acquire::Changelogs::URI::Override::Origin::Ubuntu=http://changelogs.ubuntu.com/changelogs/pool/@CHANGEPATH@/changelog"]
-                    else:
-                        cmd += ["--option", "Acquire::Changelogs::URI::Override::Origin::Debian=http://metadata.ftp-master.debian.org/changelogs/@CHANGEPATH@_changelog"]
-
-                # We have to run from the root, because if we use the RootDir option to make
-                # apt from the host look at the repositories in the image, it will also pick
-                # the 'methods' executables from there, but the ABI might not be compatible.
-                result = run(cmd, text=True, stdout=PIPE)
-                source_package = SourcePackageManifest(source, result.stdout.strip())
+                source_package = SourcePackageManifest(source, None)
                 self.source_packages[source] = source_package
+                changelogs[source] = (name, source_version)
 
             source_package.add(package)
 
+        if not changelogs:
+            return
+
+        # Without WithDocs=, every changelog is downloaded separately, so fetch a few of them at once.
+        with concurrent.futures.ThreadPoolExecutor(max_workers=DEB_CHANGELOG_WORKERS) as executor:
+            futures = {
+                source: executor.submit(self.deb_changelog, root, name, source, version)
+                for source, (name, version) in changelogs.items()
+            }
+            for source, future in futures.items():
+                self.source_packages[source].changelog = future.result()
+
+    def deb_changelog(self, root: Path, name: str, source: str, version: str) -> str:
+        """Return the changelog of version @version of source package @source, which @name was built from
+
+        Changelogs are cached in the package cache directory, if there is one,
+        so they are only fetched again when the version of a package changes.
+        """
+        cache = self.config.cache_path / "changelogs" / f"{source}_{version}" if self.config.cache_path else None
+        if cache and cache.exists():
+            return cache.read_text()
+
+        # Yes, --quiet is specified twice, to avoid output about download stats.
+        # Note that the argument of the 'changelog' verb is the binary package name,
+        # not the source package name.
+        cmd = [
+            "apt-get",
+            "--quiet",
+            "--quiet",
+            "-o", f"Dir={root}",
+            "-o", f"DPkg::Chroot-Directory={root}",
+            "changelog",
+            name,
+        ]
+
+        # If we are building with docs then it's easy, as the changelogs are saved
+        # in the image, just fetch them. Otherwise they will be downloaded from the network.
+        if self.config.with_docs:
+            # By default apt drops privileges and runs as the 'apt' user, but that means it
+            # loses access to the build directory, which is 700.
+            cmd += ["--option", "Acquire::Changelogs::AlwaysOnline=false",
+                    "--option", "Debug::NoDropPrivs=true"]
+        else:
+            # Override the URL to avoid HTTPS, so that we don't need to install
+            # ca-certificates to make it work.
+            if self.config.distribution == Distribution.ubuntu:
+                cmd += ["--option", "Acquire::Changelogs::URI::Override::Origin::Ubuntu=http://changelogs.ubuntu.com/changelogs/pool/@CHANGEPATH@/changelog"]
+            else:
+                cmd += ["--option", "Acquire::Changelogs::URI::Override::Origin::Debian=http://metadata.ftp-master.debian.org/changelogs/@CHANGEPATH@_changelog"]
+
+        # We have to run from the root, because if we use the RootDir option to make
+        # apt from the host look at the repositories in the image, it will also pick
+        # the 'methods' executables from there, but the ABI might not be compatible.
+        # This runs on a worker thread, where SIGINT handlers can't be installed.
+        result = run(cmd, text=True, stdout=PIPE, delay_interrupt=False)
+        changelog: str = result.stdout.strip()
+
+        if cache and changelog:
+            cache.parent.mkdir(exist_ok=True)
+            tmp = cache.with_name(f".{cache.name}.{os.getpid()}.tmp")
+            tmp.write_text(changelog)
+            tmp.rename(cache)
+
+        return changelog
+
     def record_pkg_packages(self, root: Path) -> None:
         packages = sorted(root.joinpath("var/lib/pacman/local").glob("*/desc"))
 
-        for desc in packages:
-            name, version, source, arch = parse_pkg_desc(desc)
-            package = PackageManifest("pkg", name, version, arch, 0)
+        # There is one file per package, so read them in parallel.
+        with concurrent.futures.ThreadPoolExecutor() as executor:
+            descs = list(executor.map(parse_pkg_desc, packages))
+
+        for name, version, source, arch, size, installtime in descs:
+            # See record_rpm_packages().
+            if self.config.base_image and installtime < self._init_timestamp:
+                continue
+
+            package = PackageManifest("pkg", name, version, arch, size)
+            self.packages.append(package)
+
+            source_package = self.source_packages.get(source)
+            if source_package is None:
+                source_package = SourcePackageManifest(source, None)
+                self.source_packages[source] = source_package
+            source_package.add(package)
+
+    def record_ebuild_packages(self, root: Path) -> None:
+        # Entries of packages that are being merged or unmerged start with a dash or a dot.
+        packages = sorted(
+            p for p in root.joinpath("var/db/pkg").glob("*/*")
+            if p.is_dir() and not p.name.startswith(("-", "."))
+        )
+
+        # There are thousands of directories with a few files each, so read them in parallel.
+        with concurrent.futures.ThreadPoolExecutor() as executor:
+            entries = list(executor.map(parse_vdb_entry, packages))
+
+        for name, source, version, size, installtime in entries:
+            # See record_rpm_packages().
+            if self.config.base_image and installtime < self._init_timestamp:
+                continue
+
+            package = PackageManifest("ebuild", name, version, "", size)
             self.packages.append(package)
 
             source_package = self.source_packages.get(source)
@@ -279,3 +388,87 @@ class Manifest:
         for package in self.source_packages.values():
             print(f"\n{80*'-'}\n", file=out)
             out.write(package.report())
+
+
+@dataclasses.dataclass
+class PackageChange:
+    """A package that was added, removed or changed between two manifests"""
+
+    name: str
+    architecture: str
+    old_version: Optional[str]
+    new_version: Optional[str]
+    size_delta: int
+
+    def report(self) -> str:
+        if self.old_version is None:
+            change = f"+ {self.name} {self.new_version}"
+        elif self.new_version is None:
+            change = f"- {self.name} {self.old_version}"
+        else:
+            change = f"~ {self.name} {self.old_version} -> {self.new_version}"
+        if self.architecture:
+            change += f" ({self.architecture})"
+        return f"{change}, {self.size_delta:+} bytes"
+
+
+def load_manifest(path: Path) -> Optional[Dict[str, Any]]:
+    """Return the JSON manifest at @path, or None if there is none"""
+    try:
+        with path.open() as f:
+            manifest: Dict[str, Any] = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if not isinstance(manifest.get("packages"), list):
+        return None
+
+    return manifest
+
+
+def diff_manifests(old: Dict[str, Any], new: Dict[str, Any]) -> List[PackageChange]:
+    """Return the packages that were added, removed or changed their version between @old and @new
+
+    Packages are matched by name and architecture. Manifests written before
+    package sizes were recorded count the size of their packages as zero.
+    """
+    before = {(p["name"], p.get("architecture", "")): p for p in old["packages"]}
+    after = {(p["name"], p.get("architecture", "")): p for p in new["packages"]}
+
+    changes = []
+    for key in sorted(before.keys() | after.keys()):
+        a, b = before.get(key), after.get(key)
+        if a and b and a["version"] == b["version"]:
+            continue
+
+        changes.append(PackageChange(
+            name=key[0],
+            architecture=key[1],
+            old_version=a["version"] if a else None,
+            new_version=b["version"] if b else None,
+            size_delta=(b.get("size", 0) if b else 0) - (a.get("size", 0) if a else 0),
+        ))
+
+    return changes
+
+
+def write_manifest_diff(old: Dict[str, Any], new: Dict[str, Any], out: IO[str]) -> None:
+    """Create a human-readable report of the packages that changed between two manifests"""
+    changes = diff_manifests(old, new)
+    old_size = sum(p.get("size", 0) for p in old["packages"])
+    new_size = sum(p.get("size", 0) for p in new["packages"])
+
+    print(f"Packages: {len(new['packages'])} ({len(new['packages']) - len(old['packages']):+})", file=out)
+    print(f"Size:     {new_size} ({new_size - old_size:+})", file=out)
+
+    for title, selected in (
+        ("Added", [c for c in changes if c.old_version is None]),
+        ("Removed", [c for c in changes if c.new_version is None]),
+        ("Changed", [c for c in changes if c.old_version is not None and c.new_version is not None]),
+    ):
+        if not selected:
+            continue
+
+        print(f"\n{title}: {len(selected)} ({sum(c.size_delta for c in selected):+} bytes)", file=out)
+        for change in selected:
+            print(f"  {change.report()}", file=out)
@@ -1,12 +1,15 @@
 # SPDX-License-Identifier: LGPL-2.1+
 
+from __future__ import annotations
+
 import contextlib
 import os
 import stat
 from pathlib import Path
-from typing import ContextManager, Iterator, List, Optional, Sequence, Union, cast
+from typing import Any, ContextManager, Iterator, List, Optional, Sequence, Union
 
-from mkosi.backend import complete_step, run, scandir_recursive
+from mkosi.backend import complete_step, run
+from mkosi.walk import TreeVisitor, walk_tree
 
 PathString = Union[Path, str]
 
@@ -15,6 +18,23 @@ def stat_is_whiteout(st: os.stat_result) -> bool:
     return stat.S_ISCHR(st.st_mode) and st.st_rdev == 0
 
 
+class WhiteoutVisitor(TreeVisitor):
+    """Collect the paths of all whiteout files"""
+
+    def __init__(self) -> None:
+        self.matches: List[str] = []
+
+    def visit(self, state: Any, path: str, entry: os.DirEntry[str]) -> Any:
+        # Directories, regular files and symlinks are told apart by the directory entry itself, so only the rare
+        # other entries need to be stat()ed.
+        if entry.is_dir(follow_symlinks=False):
+            return True
+        if not entry.is_file(follow_symlinks=False) and not entry.is_symlink():
+            if stat_is_whiteout(entry.stat(follow_symlinks=False)):
+                self.matches.append(path)
+        return None
+
+
 def delete_whiteout_files(path: Path) -> None:
     """Delete any char(0,0) device nodes underneath @path
 
@@ -23,9 +43,10 @@ def delete_whiteout_files(path: Path) -> None:
     """
 
     with complete_step("Removing overlay whiteout files…"):
-        for entry in cast(Iterator[os.DirEntry[str]], scandir_recursive(path)):
-            if stat_is_whiteout(entry.stat(follow_symlinks=False)):
-                os.unlink(entry.path)
+        visitor = WhiteoutVisitor()
+        walk_tree(path, [visitor])
+        for match in visitor.matches:
+            os.unlink(path / match)
 
 
 @contextlib.contextmanager
@@ -0,0 +1,122 @@
+# SPDX-License-Identifier: LGPL-2.1+
+
+"""Cache for the results of probing the capabilities of host tools"""
+
+import json
+import os
+import pwd
+import shutil
+import threading
+from pathlib import Path
+from typing import Any, Callable, Dict, Optional, Tuple, TypeVar, cast
+
+T = TypeVar("T")
+
+# Results of shutil.which(), keyed by binary and $PATH, which changes with ExtraSearchPaths=.
+which_cache: Dict[Tuple[str, str], Optional[str]] = {}
+# Results of probes, keyed by binary path and probe name, only valid for as long as the binary is unchanged.
+probe_cache: Dict[Tuple[str, str], Any] = {}
+probe_cache_file: Optional[Dict[str, Any]] = None
+lock = threading.RLock()
+
+
+def reset_lock() -> None:
+    """Replace the lock in a forked child, as it might have been held by another thread at the time of the fork"""
+    global lock
+    lock = threading.RLock()
+
+
+os.register_at_fork(after_in_child=reset_lock)
+
+
+def probe_cache_path() -> Path:
+    # Look up the home directory of the user we're running as, as sudo might preserve $HOME of the invoking user.
+    cache = os.environ.get("XDG_CACHE_HOME") or Path(pwd.getpwuid(os.getuid()).pw_dir) / ".cache"
+    return Path(cache) / "mkosi/probes.json"
+
+
+def debug(message: str) -> None:
+    from mkosi.backend import ARG_DEBUG, MkosiPrinter
+
+    if "probes" in ARG_DEBUG:
+        MkosiPrinter.info(f"Probe {message}")
+
+
+def which(binary: str) -> Optional[str]:
+    """Like shutil.which(), but only searches $PATH once per binary"""
+    key = (binary, os.environ.get("PATH", ""))
+    with lock:
+        if key not in which_cache:
+            which_cache[key] = shutil.which(binary)
+            debug(f"which {binary}: {which_cache[key]}")
+
+        return which_cache[key]
+
+
+def binary_identity(path: str) -> Dict[str, int]:
+    st = os.stat(path)
+    return {"size": st.st_size, "mtime": st.st_mtime_ns}
+
+
+def load_probe_cache() -> Dict[str, Any]:
+    global probe_cache_file
+
+    if probe_cache_file is None:
+        try:
+            with probe_cache_path().open() as f:
+                probe_cache_file = json.load(f)
+        except (OSError, ValueError):
+            probe_cache_file = {}
+
+        if not isinstance(probe_cache_file, dict):
+            probe_cache_file = {}
+
+    return probe_cache_file
+
+
+def save_probe_cache(data: Dict[str, Any]) -> None:
+    path = probe_cache_path()
+    tmp = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with tmp.open("w") as f:
+            json.dump(data, f, indent=2, sort_keys=True)
+        tmp.rename(path)
+    except OSError:
+        # The cache is an optimization, failing to write it must not break the build.
+        pass
+
+
+def cached_probe(binary: str, name: str, func: Callable[[], T]) -> T:
+    """Return the result of @func, which probes a capability of @binary
+
+    Results are kept in memory and in a cache file, which is keyed by the
+    path, size and modification time of @binary, so the probe is only run
+    again once @binary changes. Results must be serializable to JSON. If
+    @binary can't be found, @func is called without caching its result.
+    """
+    path = which(binary)
+    if path is None:
+        return func()
+
+    with lock:
+        if (path, name) in probe_cache:
+            return cast(T, probe_cache[(path, name)])
+
+        data = load_probe_cache()
+        identity = binary_identity(path)
+        entry = data.get(path)
+        if not isinstance(entry, dict) or entry.get("identity") != identity:
+            entry = data[path] = {"identity": identity, "probes": {}}
+
+        if name in entry["probes"]:
+            result: T = entry["probes"][name]
+            debug(f"{name} of {path}: {result!r} (cached)")
+        else:
+            result = func()
+            debug(f"{name} of {path}: {result!r}")
+            entry["probes"][name] = result
+            save_probe_cache(data)
+
+        probe_cache[(path, name)] = result
+        return result
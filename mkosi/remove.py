@@ -1,12 +1,60 @@
 # SPDX-License-Identifier: LGPL-2.1+
 
+from __future__ import annotations
+
+import atexit
+import concurrent.futures
+import contextlib
+import fcntl
+import itertools
 import os
 import shutil
+import stat
+import struct
 import subprocess
+import tempfile
+import threading
 from pathlib import Path
-from typing import Optional, cast
+from typing import Dict, Iterable, List, Optional, cast
 
 from mkosi.backend import PathString, run
+from mkosi.probe import which
+
+# _IOW(BTRFS_IOCTL_MAGIC, 15, struct btrfs_ioctl_vol_args)
+BTRFS_IOC_SNAP_DESTROY = 0x5000940F
+# The inode number of the root directory of every btrfs subvolume
+BTRFS_FIRST_FREE_OBJECTID = 256
+OPEN_DIRECTORY_FLAGS = os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW | os.O_CLOEXEC
+
+TRASH_WORKERS = 4
+
+TRASH_PREFIX = ".mkosi-trash-"
+
+# Trash directories, keyed by the device they are on, as we can only rename() within a filesystem.
+trash_dirs: Dict[int, Path] = {}
+# The file descriptors that keep our trash directories locked, so other mkosi processes don't consider them stale.
+trash_locks: Dict[Path, int] = {}
+trash_futures: List[concurrent.futures.Future[None]] = []
+trash_executor: Optional[concurrent.futures.ThreadPoolExecutor] = None
+trash_counter = itertools.count()
+trash_lock = threading.Lock()
+
+
+def reset_trash() -> None:
+    """Forget the parent's removals in a forked child, whose copy of the thread pool has no threads"""
+    global trash_executor, trash_lock
+
+    trash_dirs.clear()
+    # The locks stay with the parent, which still uses its trash directories.
+    for fd in trash_locks.values():
+        os.close(fd)
+    trash_locks.clear()
+    trash_futures.clear()
+    trash_executor = None
+    trash_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=reset_trash)
 
 
 def btrfs_subvol_delete(path: Path) -> None:
@@ -30,20 +78,77 @@ def btrfs_subvol_delete(path: Path) -> None:
         stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
 
 
+def btrfs_subvol_destroy_at(dir_fd: int, name: str) -> bool:
+    """Delete the btrfs subvolume @name in @dir_fd with an ioctl, return whether that worked"""
+    # struct btrfs_ioctl_vol_args is an s64 fd followed by a 4088 byte name. It has to be passed as a mutable
+    # buffer, as immutable ones are limited to 1024 bytes.
+    args = bytearray(struct.pack("=q4088s", 0, os.fsencode(name)))
+    try:
+        fcntl.ioctl(dir_fd, BTRFS_IOC_SNAP_DESTROY, args)
+    except OSError:
+        return False
+
+    return True
+
+
+def remove_tree_at(dir_fd: int, name: str) -> None:
+    """Remove @name in @dir_fd and everything below it, without following symlinks
+
+    btrfs subvolumes are deleted with a single ioctl instead of removing
+    their contents one by one. Subvolumes that contain other subvolumes
+    can't be deleted that way, so for those we recurse into them first.
+    """
+    st = os.stat(name, dir_fd=dir_fd, follow_symlinks=False)
+    if not stat.S_ISDIR(st.st_mode):
+        os.unlink(name, dir_fd=dir_fd)
+        return
+
+    subvolume = st.st_ino == BTRFS_FIRST_FREE_OBJECTID
+    if subvolume and btrfs_subvol_destroy_at(dir_fd, name):
+        return
+
+    fd = os.open(name, OPEN_DIRECTORY_FLAGS, dir_fd=dir_fd)
+    try:
+        with os.scandir(fd) as it:
+            entries = [(entry.name, entry.is_dir(follow_symlinks=False)) for entry in it]
+
+        for entry, is_dir in entries:
+            if is_dir:
+                remove_tree_at(fd, entry)
+            else:
+                os.unlink(entry, dir_fd=fd)
+    finally:
+        os.close(fd)
+
+    if subvolume and btrfs_subvol_destroy_at(dir_fd, name):
+        return
+
+    os.rmdir(name, dir_fd=dir_fd)
+
+
+def remove_tree(path: Path) -> None:
+    fd = os.open(path.parent, OPEN_DIRECTORY_FLAGS & ~os.O_NOFOLLOW)
+    try:
+        remove_tree_at(fd, path.name)
+    finally:
+        os.close(fd)
+
+
 def unlink_try_hard(path: Optional[PathString]) -> None:
     if path is None:
         return
 
     path = Path(path)
     try:
-        path.unlink()
+        remove_tree(path)
         return
     except FileNotFoundError:
         return
     except Exception:
         pass
 
-    if shutil.which("btrfs"):
+    # Read-only btrfs subvolumes can't be emptied, make them writable first.
+    if which("btrfs"):
         try:
             btrfs_subvol_delete(path)
             return
@@ -51,3 +156,147 @@ def unlink_try_hard(path: Optional[PathString]) -> None:
             pass
 
     shutil.rmtree(path)
+
+
+def trash_dir(path: Path, dev: int, parent: Path) -> Path:
+    """Return the trash directory for @path, which has to be on the device @dev. Call with trash_lock held.
+
+    New trash directories are created in @parent.
+    """
+    trash = trash_dirs.get(dev)
+
+    # If the trash directory is below the path we're deleting, moving the path into it won't work, and the pending
+    # deletions in it would race with the deletion of the path. Let them finish and use a new trash directory.
+    if trash is not None and (trash == path or path in trash.parents):
+        wait_for_trash_futures()
+        release_trash_dir(trash)
+        trash = None
+
+    if trash is None or not trash.exists():
+        trash = trash_dirs[dev] = Path(tempfile.mkdtemp(prefix=TRASH_PREFIX, dir=parent))
+        fd = os.open(trash, OPEN_DIRECTORY_FLAGS)
+        fcntl.flock(fd, fcntl.LOCK_SH)
+        trash_locks[trash] = fd
+
+    return trash
+
+
+def release_trash_dir(trash: Path) -> None:
+    """Remove the empty trash directory @trash and unlock it. Call with trash_lock held."""
+    with contextlib.suppress(OSError):
+        trash.rmdir()
+
+    fd = trash_locks.pop(trash, None)
+    if fd is not None:
+        os.close(fd)
+
+
+def remove_stale_trash(directories: Iterable[Path]) -> None:
+    """Remove the trash directories in @directories that were left behind by mkosi runs that crashed
+
+    Trash directories that are still in use are locked by the process using
+    them and are skipped.
+    """
+    for directory in directories:
+        for trash in directory.glob(f"{TRASH_PREFIX}*"):
+            try:
+                fd = os.open(trash, OPEN_DIRECTORY_FLAGS)
+            except OSError:
+                continue
+
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                pass
+            else:
+                unlink_in_background(trash)
+            finally:
+                os.close(fd)
+
+
+def unlink_in_background(path: Optional[PathString], trash_parent: Optional[Path] = None) -> None:
+    """Remove @path like unlink_try_hard(), but without waiting for it
+
+    @path is renamed into a trash directory on the same filesystem, which
+    makes it disappear atomically, and is then removed by a pool of
+    background threads. Pending removals are completed when mkosi exits,
+    or when wait_for_trash() is called. If @path can't be renamed, e.g.
+    because it is a mount point, it is removed synchronously instead.
+
+    If no trash directory exists on the filesystem yet, it is created in
+    @trash_parent, or next to @path if @trash_parent is on a different
+    filesystem or not given.
+    """
+    global trash_executor
+
+    if path is None:
+        return
+
+    path = Path(path).absolute()
+    try:
+        os.lstat(path)
+        dev = os.stat(path.parent).st_dev
+    except FileNotFoundError:
+        return
+
+    if trash_parent is None or os.stat(trash_parent).st_dev != dev:
+        trash_parent = path.parent
+
+    with trash_lock:
+        try:
+            target = trash_dir(path, dev, trash_parent) / f"{next(trash_counter)}-{path.name}"
+            os.rename(path, target)
+        except OSError:
+            unlink_try_hard(path)
+            return
+
+        if trash_executor is None:
+            trash_executor = concurrent.futures.ThreadPoolExecutor(max_workers=TRASH_WORKERS,
+                                                                   thread_name_prefix="mkosi-trash")
+            atexit.register(wait_for_trash)
+
+        trash_futures.append(trash_executor.submit(unlink_try_hard, target))
+
+
+def wait_for_trash_futures() -> None:
+    """Wait for all pending removals and raise the first error, if any. Call with trash_lock held."""
+    futures = trash_futures[:]
+    trash_futures.clear()
+    for future in futures:
+        future.result()
+
+
+def wait_for_trash(below: Optional[Path] = None) -> None:
+    """Wait for all removals started by unlink_in_background()
+
+    If @below is given, only wait if any trash directory is located below
+    it, so it can be safely removed afterwards.
+    """
+    with trash_lock:
+        dirs = [t for t in trash_dirs.values() if below is None or below in t.parents]
+        if not dirs:
+            return
+
+        wait_for_trash_futures()
+        for t in dirs:
+            release_trash_dir(t)
+
+        for dev in [dev for dev, t in trash_dirs.items() if t in dirs]:
+            del trash_dirs[dev]
+
+
+def empty_directory(path: Path) -> None:
+    """Remove the contents of @path in the background, leaving an empty directory behind
+
+    @path is usually consumed later on, e.g. copied into the image or
+    bind mounted into the build container, so the trash directory is
+    created next to it rather than in it. If that's not possible because
+    @path is a mount point, we wait for the removals to finish instead.
+    """
+    try:
+        for f in os.listdir(path):
+            unlink_in_background(path / f, trash_parent=path.absolute().parent)
+    except FileNotFoundError:
+        return
+
+    wait_for_trash(below=path.absolute())
@@ -0,0 +1,83 @@
+# SPDX-License-Identifier: LGPL-2.1+
+
+import concurrent.futures
+from typing import (
+    Any,
+    Callable,
+    Collection,
+    Dict,
+    List,
+    Mapping,
+    Optional,
+    Set,
+    TypeVar,
+)
+
+T = TypeVar("T")
+
+
+class DependencyFailed(Exception):
+    """Raised for nodes that were not run because one of their dependencies failed"""
+
+
+def topological_order(graph: Mapping[T, Collection[T]]) -> List[T]:
+    """Return the nodes of @graph so that every node comes after its dependencies
+
+    @graph maps every node to the nodes it depends on. Ties are broken by the
+    order of @graph. Raises ValueError for unknown dependencies and cycles.
+    """
+    for node, deps in graph.items():
+        for dep in deps:
+            if dep not in graph:
+                raise ValueError(f"{node} depends on unknown {dep}")
+
+    order: List[T] = []
+    done: Set[T] = set()
+
+    while len(order) < len(graph):
+        ready = [n for n, deps in graph.items() if n not in done and all(d in done for d in deps)]
+        if not ready:
+            cycle = ", ".join(str(n) for n in graph if n not in done)
+            raise ValueError(f"Dependency cycle between {cycle}")
+
+        order += ready
+        done.update(ready)
+
+    return order
+
+
+def run_graph(
+    graph: Mapping[T, Collection[T]],
+    func: Callable[[T], Any],
+    executor: concurrent.futures.Executor,
+) -> Dict[T, Optional[BaseException]]:
+    """Run @func for every node of @graph on @executor, as soon as all its dependencies succeeded
+
+    Returns a mapping from every node to the exception it failed with, or None
+    if it succeeded. Nodes depending on a failed node are not run and fail with
+    DependencyFailed.
+    """
+    topological_order(graph)  # validate
+
+    results: Dict[T, Optional[BaseException]] = {}
+    running: Dict["concurrent.futures.Future[Any]", T] = {}
+
+    while len(results) < len(graph):
+        for node, deps in graph.items():
+            if node in results or node in running.values():
+                continue
+
+            failed = [d for d in deps if d in results and results[d] is not None]
+            if failed:
+                results[node] = DependencyFailed(f"{node} not run because {failed[0]} failed")
+            elif all(d in results for d in deps):
+                running[executor.submit(func, node)] = node
+
+        if not running:
+            continue
+
+        done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+            results[running.pop(future)] = future.exception()
+
+    return results
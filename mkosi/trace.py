@@ -0,0 +1,119 @@
+# SPDX-License-Identifier: LGPL-2.1+
+
+import contextlib
+import dataclasses
+import json
+import os
+import resource
+import threading
+import time
+from typing import IO, Any, Dict, Iterator, List
+
+
+@dataclasses.dataclass(frozen=True)
+class ResourceSample:
+    """Process wide resource counters at a given point in time"""
+
+    wall: float
+    cpu_self: float
+    cpu_children: float
+    read_bytes: int
+    write_bytes: int
+
+
+def read_io_counters() -> Dict[str, int]:
+    """Return the storage I/O counters of this process from /proc/self/io
+
+    The kernel folds the counters of reaped children into the parent, so
+    this includes the I/O done by the tools we spawned.
+    """
+    counters = {}
+    try:
+        with open("/proc/self/io") as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                counters[key] = int(value)
+    except (OSError, ValueError):
+        pass
+
+    return counters
+
+
+def sample_resources() -> ResourceSample:
+    rself = resource.getrusage(resource.RUSAGE_SELF)
+    rchildren = resource.getrusage(resource.RUSAGE_CHILDREN)
+    io = read_io_counters()
+
+    if "read_bytes" in io and "write_bytes" in io:
+        read_bytes, write_bytes = io["read_bytes"], io["write_bytes"]
+    else:
+        # Without task I/O accounting, fall back to the block counters from getrusage().
+        read_bytes = (rself.ru_inblock + rchildren.ru_inblock) * 512
+        write_bytes = (rself.ru_oublock + rchildren.ru_oublock) * 512
+
+    return ResourceSample(
+        wall=time.monotonic(),
+        cpu_self=rself.ru_utime + rself.ru_stime,
+        cpu_children=rchildren.ru_utime + rchildren.ru_stime,
+        read_bytes=read_bytes,
+        write_bytes=write_bytes,
+    )
+
+
+class Tracer:
+    """Record steps as Chrome trace events
+
+    The resulting file can be loaded into chrome://tracing or
+    https://ui.perfetto.dev. Steps are recorded as "complete" events, which
+    these viewers nest by their time ranges.
+    """
+
+    enabled = False
+    events: List[Dict[str, Any]] = []
+    lock = threading.Lock()
+
+    @classmethod
+    def start(cls) -> None:
+        cls.events = []
+        cls.enabled = True
+
+    @classmethod
+    def stop(cls) -> None:
+        cls.enabled = False
+
+    @classmethod
+    @contextlib.contextmanager
+    def span(cls, name: str, level: int) -> Iterator[None]:
+        if not cls.enabled:
+            yield
+            return
+
+        begin = sample_resources()
+        try:
+            yield
+        finally:
+            end = sample_resources()
+            event = {
+                "name": name,
+                "cat": "step",
+                "ph": "X",
+                "ts": round(begin.wall * 1_000_000),
+                "dur": round((end.wall - begin.wall) * 1_000_000),
+                "pid": os.getpid(),
+                "tid": threading.get_ident(),
+                "args": {
+                    "level": level,
+                    "cpu_self_s": round(end.cpu_self - begin.cpu_self, 3),
+                    "cpu_children_s": round(end.cpu_children - begin.cpu_children, 3),
+                    "read_bytes": end.read_bytes - begin.read_bytes,
+                    "write_bytes": end.write_bytes - begin.write_bytes,
+                },
+            }
+            with cls.lock:
+                cls.events.append(event)
+
+    @classmethod
+    def write(cls, out: IO[str]) -> None:
+        with cls.lock:
+            events = sorted(cls.events, key=lambda e: (e["ts"], -e["dur"]))
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, out, indent=1)
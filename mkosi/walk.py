@@ -0,0 +1,177 @@
+# SPDX-License-Identifier: LGPL-2.1+
+
+"""Single-pass walker for the image tree, shared by all consumers that need to scan it"""
+
+from __future__ import annotations
+
+import errno
+import fnmatch
+import os
+import re
+from pathlib import Path
+from typing import Any, List, Optional, Pattern, Sequence, Tuple, Union
+
+OPEN_DIRECTORY_FLAGS = os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW | os.O_CLOEXEC
+
+
+class TreeVisitor:
+    """A consumer of walk_tree()
+
+    Every visitor carries a state per directory. walk_tree() only calls
+    visit() for entries of directories the visitor has a state other than
+    None for, and only descends into directories that at least one visitor
+    is interested in, so visitors that only care about a few paths keep the
+    walk cheap.
+    """
+
+    def root_state(self) -> Any:
+        """Return the state for the entries of the root directory, or None to visit nothing"""
+        return True
+
+    def visit(self, state: Any, path: str, entry: os.DirEntry[str]) -> Any:
+        """Visit @entry, at @path relative to the root
+
+        If @entry is a directory, return the state for its entries, or None
+        to skip them. Use @entry's methods rather than os.stat() on @path:
+        they are relative to the directory's file descriptor and cache their
+        results across visitors.
+        """
+        raise NotImplementedError
+
+
+def scan_directory(
+    fd: int,
+    prefix: str,
+    subscribers: Sequence[Tuple[TreeVisitor, Any]],
+) -> List[Tuple[str, List[Tuple[TreeVisitor, Any]]]]:
+    """Visit the entries of the directory @fd and return its subdirectories that visitors are interested in"""
+    subdirs = []
+
+    with os.scandir(fd) as it:
+        for entry in it:
+            path = prefix + entry.name
+            is_dir = entry.is_dir(follow_symlinks=False)
+            children = []
+            for visitor, state in subscribers:
+                child = visitor.visit(state, path, entry)
+                if is_dir and child is not None:
+                    children.append((visitor, child))
+
+            if children:
+                subdirs.append((entry.name, children))
+
+    # Subdirectories are popped off the end, reverse them so they're walked in the order they were read.
+    subdirs.reverse()
+    return subdirs
+
+
+def walk_tree(root: Path, visitors: Sequence[TreeVisitor]) -> None:
+    """Walk the tree below @root once, calling all @visitors for every entry they are interested in
+
+    The walk is relative to directory file descriptors and never follows
+    symlinks, so it can't escape from @root. Only one file descriptor per
+    level of the tree is open at any time. Directories that disappear while
+    walking, e.g. because a visitor removed them, or that are replaced by
+    something else, are skipped.
+    """
+    subscribers = [(v, s) for v in visitors for s in [v.root_state()] if s is not None]
+    if not subscribers:
+        return
+
+    fd = os.open(root, os.O_RDONLY | os.O_DIRECTORY | os.O_CLOEXEC)
+    levels: List[Tuple[int, str, List[Tuple[str, List[Tuple[TreeVisitor, Any]]]]]] = [(fd, "", [])]
+
+    try:
+        levels[-1] = (fd, "", scan_directory(fd, "", subscribers))
+
+        while levels:
+            fd, prefix, subdirs = levels[-1]
+            if not subdirs:
+                os.close(levels.pop()[0])
+                continue
+
+            name, children = subdirs.pop()
+            try:
+                child = os.open(name, OPEN_DIRECTORY_FLAGS, dir_fd=fd)
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+            except OSError as e:
+                # The directory was replaced by a symlink, which O_NOFOLLOW refuses to open.
+                if e.errno == errno.ELOOP:
+                    continue
+                raise
+
+            path = f"{prefix}{name}/"
+            # Track the file descriptor before scanning, so it's closed if a visitor raises.
+            levels.append((child, path, []))
+            levels[-1] = (child, path, scan_directory(child, path, children))
+    finally:
+        for fd, _, _ in levels:
+            os.close(fd)
+
+
+def compile_glob_part(part: str) -> Union[str, Pattern[str]]:
+    return re.compile(fnmatch.translate(part)) if glob_has_magic(part) else part
+
+
+def glob_has_magic(part: str) -> bool:
+    return any(c in part for c in "*?[")
+
+
+class GlobVisitor(TreeVisitor):
+    """Collect the paths matching any of a list of globs
+
+    Patterns are relative to the root of the walk and have the same syntax
+    as for glob.glob(): wildcards only match within a path component and
+    don't match names starting with "." unless the pattern component does.
+    Unlike glob.glob(), symlinks to directories are never followed, so
+    patterns can't match anything outside the tree. Entries below a match
+    are not visited, as removing the match removes them too.
+    """
+
+    def __init__(self, patterns: Sequence[str]) -> None:
+        self.patterns = []
+        for pattern in patterns:
+            parts = [p for p in pattern.split("/") if p and p != "."]
+            if parts:
+                self.patterns.append([(p, compile_glob_part(p)) for p in parts])
+
+        self.matches: List[str] = []
+
+    def root_state(self) -> Optional[List[Tuple[int, int]]]:
+        return [(i, 0) for i in range(len(self.patterns))] or None
+
+    def visit(self, state: List[Tuple[int, int]], path: str, entry: os.DirEntry[str]) -> Any:
+        children = []
+        for pattern, index in state:
+            part, matcher = self.patterns[pattern][index]
+            if isinstance(matcher, str):
+                if entry.name != matcher:
+                    continue
+            elif (entry.name.startswith(".") and not part.startswith(".")) or not matcher.match(entry.name):
+                continue
+
+            if index + 1 == len(self.patterns[pattern]):
+                self.matches.append(path)
+                return None
+
+            children.append((pattern, index + 1))
+
+        return children or None
+
+
+class DiskUsageVisitor(TreeVisitor):
+    """Sum up the disk usage of all regular files
+
+    Symlinks are ignored: they either point into the tree, in which case
+    their target is counted anyway, or outside of it, in which case we
+    don't need to count it.
+    """
+
+    def __init__(self) -> None:
+        self.size = 0
+
+    def visit(self, state: Any, path: str, entry: os.DirEntry[str]) -> Any:
+        if entry.is_file(follow_symlinks=False):
+            self.size += entry.stat(follow_symlinks=False).st_blocks * 512
+        return True
@@ -1,21 +1,34 @@
 # SPDX-License-Identifier: LGPL-2.1+
 
+import io
+import json
 import os
 import secrets
+import time
+import threading
+import sys
 import tarfile
 from pathlib import Path
 
 import pytest
 
 from mkosi.backend import (
+    Compressor,
     Distribution,
+    ForkedCall,
+    MkosiPrinter,
     MkosiException,
     PackageType,
+    WorkspaceSession,
+    complete_step,
+    parse_compressor,
     safe_tar_extract,
     set_umask,
     strip_suffixes,
+    sudo_user_fallback,
     workspace,
 )
+from mkosi.trace import Tracer
 
 
 def test_distribution() -> None:
@@ -80,3 +93,128 @@ def test_strip_suffixes() -> None:
     assert strip_suffixes(Path("home.xz/test.xz")) == Path("home.xz/test")
     assert strip_suffixes(Path("home.xz/test")) == Path("home.xz/test")
     assert strip_suffixes(Path("home.xz/test.txt")) == Path("home.xz/test.txt")
+
+
+def test_parse_compressor() -> None:
+    assert parse_compressor("xz") == Compressor("xz")
+    assert parse_compressor("zstd:level=19,long=27,threads=0") == Compressor("zstd", level=19, threads=0, long=27)
+    assert parse_compressor("zstd:long") == Compressor("zstd", long=0)
+    assert parse_compressor("zstd-seekable:level=3").suffix == ".zst"
+    assert not parse_compressor("zstd-seekable").streamable
+
+    assert parse_compressor("xz:level=9") == Compressor("xz", level=9)
+    assert parse_compressor("zstd:level=22,long=31") == Compressor("zstd", level=22, long=31)
+
+    for value in ("lz4", "xz:long=27", "zstd:level=fast", "zstd:level=-1", "zstd:foo=1", "xz:level=10",
+                  "zstd:level=23", "zstd:level=0", "zstd:long=9", "zstd:long=32", "zstd-seekable:level=23",
+                  "zstd-seekable:long=27", "zstd-seekable:long"):
+        with pytest.raises(ValueError):
+            parse_compressor(value)
+
+
+def test_complete_step_trace() -> None:
+    Tracer.start()
+    try:
+        with complete_step("outer"):
+            with complete_step("inner"):
+                pass
+    finally:
+        Tracer.stop()
+
+    out = io.StringIO()
+    Tracer.write(out)
+    events = json.loads(out.getvalue())["traceEvents"]
+
+    assert [e["name"] for e in events] == ["outer", "inner"]
+    assert [e["args"]["level"] for e in events] == [0, 1]
+    assert all(e["ph"] == "X" and e["dur"] >= 0 for e in events)
+    assert events[0]["ts"] + events[0]["dur"] >= events[1]["ts"] + events[1]["dur"]
+
+
+def test_complete_step_threads(monkeypatch: pytest.MonkeyPatch) -> None:
+    out = io.StringIO()
+    monkeypatch.setattr(MkosiPrinter, "out_file", out)
+    monkeypatch.setattr(MkosiPrinter, "isatty", False)
+    monkeypatch.setattr(MkosiPrinter, "bold", "")
+    monkeypatch.setattr(MkosiPrinter, "reset", "")
+    inner = threading.Event()
+    outer = threading.Event()
+
+    def worker() -> None:
+        MkosiPrinter.set_level(1)
+        with MkosiPrinter.tagged("final"):
+            inner.wait()
+            with complete_step("worker"):
+                outer.set()
+
+    with complete_step("outer"):
+        thread = threading.Thread(target=worker)
+        thread.start()
+        # The nesting of this thread's steps doesn't affect the worker's and the other way around.
+        with complete_step("inner"):
+            inner.set()
+            outer.wait()
+            thread.join()
+        with complete_step("after"):
+            pass
+
+    assert out.getvalue().splitlines() == ["‣ outer", "‣  inner", "‣ [final]  worker", "‣  after"]
+    assert MkosiPrinter.level() == 0
+
+
+def test_workspace_session(tmp_path: Path) -> None:
+    directory = tmp_path / "session"
+    directory.mkdir()
+
+    # Run the server on the host instead of in a container.
+    session = WorkspaceSession([], directory, directory)
+
+    result = session.run(["sh", "-c", "echo $FOO; exit 3"], {"FOO": "a b"}, capture_stdout=True)
+    assert result.returncode == 3
+    assert result.stdout == "a b\n"
+
+    result = session.run(["true"], {}, capture_stdout=False)
+    assert result.returncode == 0
+    assert result.stdout is None
+    assert sorted(p.name for p in directory.iterdir()) == ["response"]
+
+    session.close()
+    assert session.proc.returncode == 0
+    assert not directory.exists()
+
+
+def test_sudo_user_fallback(monkeypatch: pytest.MonkeyPatch) -> None:
+    kwargs = {"user": 1000, "text": True}
+    monkeypatch.setattr(sys, "version_info", (3, 8, 18))
+    assert sudo_user_fallback(["git", "status"], kwargs) == ["sudo", "-u", "#1000", "git", "status"]
+    assert kwargs == {"text": True}
+
+    kwargs = {"user": 1000}
+    monkeypatch.setattr(sys, "version_info", (3, 9, 0))
+    assert sudo_user_fallback(["git", "status"], kwargs) == ["git", "status"]
+    assert kwargs == {"user": 1000}
+
+
+def fail(message: str) -> None:
+    raise MkosiException(message)
+
+
+def test_forked_call() -> None:
+    with ForkedCall(os.getpid) as call:
+        pid = call.result()
+    assert pid == call.process.pid != os.getpid()
+
+    with ForkedCall(fail, "broken") as call:
+        pass
+    with pytest.raises(MkosiException, match="broken"):
+        call.result()
+
+    # An error in the block interrupts the process instead of waiting for it.
+    start = time.monotonic()
+    with pytest.raises(RuntimeError):
+        with ForkedCall(time.sleep, 60) as call:
+            time.sleep(0.5)
+            raise RuntimeError("failed")
+    assert time.monotonic() - start < 30
+    with pytest.raises(KeyboardInterrupt):
+        call.result()
@@ -0,0 +1,122 @@
+# SPDX-License-Identifier: LGPL-2.1+
+
+import dataclasses
+from pathlib import Path
+from typing import Any, List
+
+import pytest
+
+import mkosi
+from mkosi.backend import Checkpoint, MkosiConfig, MkosiException
+from mkosi.cache import (
+    CACHE_STAGES,
+    UNCACHED_SETTINGS,
+    cache_components,
+    cache_miss_reason,
+    cache_variants,
+    read_cache_components,
+    write_cache_components,
+)
+
+
+def parse(argv: List[str]) -> MkosiConfig:
+    return mkosi.load_args(mkosi.parse_args(argv)["default"])
+
+
+def test_cache_tree_path(tmpdir: Path) -> None:
+    config = parse(["--output-dir", str(tmpdir), "--image-id", "test", "-p", "vim", "build"])
+
+    final = mkosi.cache_tree_path(config, is_final_image=True)
+    assert final.parent == config.output_dir
+    assert final.name.startswith("test.") and final.name.endswith(".final-cache")
+    assert final == mkosi.cache_tree_path(config, is_final_image=True)
+    assert final != mkosi.cache_tree_path(config, is_final_image=False)
+
+    # Settings that only matter after the cached tree is restored don't invalidate it.
+    bumped = dataclasses.replace(config, image_version="2", postinst_script=Path("mkosi.postinst"))
+    assert mkosi.cache_tree_path(bumped, is_final_image=True) == final
+
+    changed = dataclasses.replace(config, packages=["vim", "emacs"])
+    assert mkosi.cache_tree_path(changed, is_final_image=True) != final
+
+
+def test_cache_miss_reason(tmpdir: Path) -> None:
+    config = parse(["--output-dir", str(tmpdir), "--image-id", "test", "-p", "vim", "build"])
+    assert config.output_dir is not None
+    prefix = config.output_dir / "test"
+
+    old = mkosi.cache_tree_path(config, is_final_image=True)
+    old.mkdir(parents=True)
+    components = cache_components(config, is_final_image=True)
+    write_cache_components(old, components)
+    assert read_cache_components(old) == components
+
+    changed = dataclasses.replace(config, packages=["emacs"])
+    new = mkosi.cache_tree_path(changed, is_final_image=True)
+    variants = cache_variants(prefix, "final-cache")
+    assert variants == [old]
+
+    reason = cache_miss_reason(new, variants, cache_components(changed, is_final_image=True))
+    assert reason == f"packages changed since {old.name}"
+    assert cache_miss_reason(new, [], components) == "no cached tree found"
+
+
+def test_checkpoint_components(tmpdir: Path) -> None:
+    config = parse(["--incremental", "--checkpoints", "distribution,prepare", "-p", "vim", "build"])
+    assert config.checkpoints == [Checkpoint.distribution, Checkpoint.prepare]
+
+    prepare = Path(tmpdir) / "mkosi.prepare"
+    prepare.write_text("#!/bin/sh\n")
+    config = dataclasses.replace(config, prepare_script=prepare)
+
+    distribution = cache_components(config, is_final_image=True, checkpoint=Checkpoint.distribution)
+    prepared = cache_components(config, is_final_image=True, checkpoint=Checkpoint.prepare)
+    assert "prepare_script" not in distribution
+    assert distribution.items() <= prepared.items()
+    assert prepared.items() <= cache_components(config, is_final_image=True).items()
+
+    # Editing the prepare script only invalidates the checkpoints after it.
+    prepare.write_text("#!/bin/sh\necho hello\n")
+    assert cache_components(config, is_final_image=True, checkpoint=Checkpoint.distribution) == distribution
+    assert cache_components(config, is_final_image=True, checkpoint=Checkpoint.prepare) != prepared
+
+    # The serial console is configured on uncached trees only.
+    headless = dataclasses.replace(config, qemu_headless=True)
+    assert cache_components(headless, is_final_image=True, checkpoint=Checkpoint.distribution) == distribution
+    assert cache_components(headless, is_final_image=True, checkpoint=Checkpoint.prepare) != prepared
+
+    with pytest.raises(MkosiException):
+        parse(["--checkpoints", "prepare", "build"])
+
+
+@pytest.mark.parametrize(
+    "setting,value",
+    [
+        ("ssh", True),
+        ("netdev", True),
+        ("password", "secret"),
+        ("autologin", True),
+        ("with_network", True),
+        ("machine_id", "b92bd4c6a1a34fb3a6e4f6e0c7c2b4a1"),
+    ],
+)
+def test_distribution_components(setting: str, value: Any) -> None:
+    config = parse(["--incremental", "--checkpoints", "distribution", "build"])
+    distribution = cache_components(config, is_final_image=True, checkpoint=Checkpoint.distribution)
+
+    # Settings that change the packages installed with the distribution invalidate its checkpoint.
+    changed = dataclasses.replace(config, **{setting: value})
+    assert cache_components(changed, is_final_image=True, checkpoint=Checkpoint.distribution) != distribution
+
+
+def test_settings_classified() -> None:
+    keyed = set()
+    for stage in CACHE_STAGES.values():
+        keyed |= {*stage.settings, *stage.build_settings, *stage.trees, *stage.scripts}
+
+    # A new setting has to be added to CACHE_STAGES if it changes the contents of a cached tree, or to
+    # UNCACHED_SETTINGS if it doesn't.
+    fields = {f.name for f in dataclasses.fields(MkosiConfig)}
+    assert fields - keyed - UNCACHED_SETTINGS == set()
+    assert keyed & UNCACHED_SETTINGS == set()
+    assert (keyed | UNCACHED_SETTINGS) - fields == set()
@@ -0,0 +1,43 @@
+# SPDX-License-Identifier: LGPL-2.1+
+
+import hashlib
+from pathlib import Path
+
+from mkosi.checksum import copy_and_sha256, seed_sha256, sha256_file, sha256_files
+
+
+def test_sha256_files(tmp_path: Path) -> None:
+    paths = []
+    for i in range(4):
+        p = tmp_path / f"file{i}"
+        p.write_bytes(bytes([i]) * (i * 3 * 1024**2 + 7))
+        paths.append(p)
+
+    digests = sha256_files(paths, workers=2)
+    assert list(digests) == paths
+    for p in paths:
+        assert digests[p] == hashlib.sha256(p.read_bytes()).hexdigest()
+        # Hashing must not modify the file.
+        assert p.stat().st_size > 0
+
+
+def test_seed_sha256(tmp_path: Path) -> None:
+    p = tmp_path / "file"
+    p.write_bytes(b"abc")
+
+    seed_sha256(p, "seeded")
+    assert sha256_file(p) == "seeded"
+
+    # Rewriting the file changes its size, so the seeded digest is not used anymore.
+    p.write_bytes(b"abcd")
+    assert sha256_file(p) == hashlib.sha256(b"abcd").hexdigest()
+
+
+def test_copy_and_sha256(tmp_path: Path) -> None:
+    data = b"x" * (5 * 1024**2 + 3)
+    (tmp_path / "src").write_bytes(data)
+
+    with (tmp_path / "src").open("rb") as src, (tmp_path / "dst").open("wb") as dst:
+        assert copy_and_sha256(src, dst) == hashlib.sha256(data).hexdigest()
+
+    assert (tmp_path / "dst").read_bytes() == data
@@ -56,6 +56,8 @@ class MkosiConfig:
         self.reference_config[job_name] = {
             "all": False,
             "all_directory": None,
+            "jobs": 1,
+            "dependencies": [],
             "architecture": platform.machine(),
             "bmap": False,
             "bootable": False,
@@ -65,13 +67,16 @@ class MkosiConfig:
             "remove_files": [],
             "remove_packages": [],
             "build_script": None,
+            "pipeline_build": False,
             "environment": [],
             "build_sources": None,
             "cache_path": None,
+            "checkpoints": [],
             "checksum": False,
             "cmdline": [],
             "compress_output": None,
             "debug": [],
+            "trace": False,
             "config_path": None,
             "directory": None,
             "distribution": None,
@@ -133,6 +138,7 @@ class MkosiConfig:
             "qemu_kvm": mkosi.qemu_check_kvm_support(),
             "qemu_args": [],
             "nspawn_keep_unit": False,
+            "workspace_session": False,
             "qemu_boot": "uefi",
             "netdev": False,
             "ephemeral": False,
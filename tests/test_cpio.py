@@ -0,0 +1,80 @@
+# SPDX-License-Identifier: LGPL-2.1+
+
+import io
+import os
+from pathlib import Path
+from typing import List, Tuple
+
+import pytest
+
+from mkosi.backend import MkosiException
+from mkosi.cpio import write_cpio
+
+
+def read_cpio(data: bytes) -> List[Tuple[str, int, int, int, int, bytes]]:
+    """Return the name, inode, mode, nlink, mtime and data of every entry"""
+    entries = []
+    offset = 0
+    while True:
+        assert data[offset:offset + 6] == b"070701"
+        fields = [int(data[offset + 6 + i * 8:offset + 14 + i * 8], 16) for i in range(13)]
+        ino, mode, _, _, nlink, mtime, size = fields[:7]
+        namesize = fields[11]
+        offset += 110
+        name = data[offset:offset + namesize - 1].decode()
+        offset += namesize
+        offset += -offset % 4
+        if name == "TRAILER!!!":
+            break
+        entries.append((name, ino, mode, nlink, mtime, data[offset:offset + size]))
+        offset += size
+        offset += -offset % 4
+
+    assert offset == len(data)
+    return entries
+
+
+def test_write_cpio(tmp_path: Path) -> None:
+    root = tmp_path / "root"
+    (root / "usr/bin").mkdir(parents=True)
+    (root / "usr/bin/a").write_bytes(b"hello")
+    os.link(root / "usr/bin/a", root / "usr/bin/b")
+    (root / "usr/lib").symlink_to("usr/bin")
+    (root / "usr-file").write_bytes(b"12345678")
+    os.utime(root / "usr-file", (2000000000, 2000000000))
+    os.utime(root / "usr/bin/a", (1000, 1000))
+
+    out = io.BytesIO()
+    write_cpio(out, root, mtime_clamp=1500000000)
+    entries = read_cpio(out.getvalue())
+
+    assert [e[0] for e in entries] == ["usr", "usr-file", "usr/bin", "usr/bin/a", "usr/bin/b", "usr/lib"]
+    assert [e[1] for e in entries] == [1, 2, 3, 4, 4, 5]
+
+    usr_file = entries[1]
+    assert usr_file[4] == 1500000000
+    assert usr_file[5] == b"12345678"
+
+    # The hardlinked data is only stored with the last link.
+    a, b = entries[3], entries[4]
+    assert a[3] == b[3] == 2
+    assert a[4] == 1000
+    assert a[5] == b""
+    assert b[5] == b"hello"
+
+    assert entries[5][5] == b"usr/bin"
+
+    # The output is reproducible.
+    again = io.BytesIO()
+    write_cpio(again, root, mtime_clamp=1500000000)
+    assert again.getvalue() == out.getvalue()
+
+
+def test_write_cpio_too_large(tmp_path: Path) -> None:
+    root = tmp_path / "root"
+    root.mkdir()
+    with (root / "huge").open("wb") as f:
+        f.truncate(4 * 1024**3)
+
+    with pytest.raises(MkosiException):
+        write_cpio(io.BytesIO(), root)
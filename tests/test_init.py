@@ -1,8 +1,26 @@
 # SPDX-License-Identifier: LGPL-2.1+
 
+import argparse
+import contextlib
+import dataclasses
+import hashlib
+import lzma
+import multiprocessing
+import os
+import shutil
+import subprocess
+import time
+from pathlib import Path
+from typing import Any, ContextManager, Dict, List, cast
+
 import pytest
 
 import mkosi
+from mkosi.backend import Checkpoint, MkosiConfig, MkosiState, OutputFormat, SourceFileTransfer
+from mkosi.checksum import sha256_file
+from mkosi.distributions import debian
+from mkosi.manifest import Manifest
+from mkosi.remove import wait_for_trash
 
 
 def test_parse_bytes() -> None:
@@ -24,3 +42,287 @@ def test_parse_bytes() -> None:
         mkosi.parse_bytes("-3M")
     with pytest.raises(ValueError):
         mkosi.parse_bytes("-4G")
+
+
+def test_copy_git_files(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setenv("SUDO_UID", str(os.getuid()))
+
+    def git(*args: str, cwd: Path) -> None:
+        subprocess.run(["git", "-c", "user.name=mkosi", "-c", "user.email=mkosi@example.com",
+                        "-c", "protocol.file.allow=always", *args], cwd=cwd, check=True, stdout=subprocess.DEVNULL,
+                       stderr=subprocess.DEVNULL)
+
+    sub = tmp_path / "sub"
+    sub.mkdir()
+    git("init", cwd=sub)
+    sub.joinpath("subfile").write_text("sub")
+    git("add", "subfile", cwd=sub)
+    git("commit", "-m", "sub", cwd=sub)
+
+    top = tmp_path / "top"
+    top.joinpath("dir").mkdir(parents=True)
+    git("init", cwd=top)
+    top.joinpath("dir/tracked").write_text("tracked")
+    git("add", "dir/tracked", cwd=top)
+    git("submodule", "add", str(sub), "sub", cwd=top)
+    git("commit", "-m", "top", cwd=top)
+    top.joinpath("untracked").write_text("untracked")
+    top.joinpath("sub/subuntracked").write_text("untracked")
+
+    dest = tmp_path / "cached"
+    mkosi.copy_git_files(top, dest, source_file_transfer=SourceFileTransfer.copy_git_cached)
+    assert dest.joinpath("dir/tracked").read_text() == "tracked"
+    assert dest.joinpath("sub/subfile").read_text() == "sub"
+    assert not dest.joinpath("untracked").exists()
+    assert not dest.joinpath(".git").exists()
+
+    dest = tmp_path / "others"
+    mkosi.copy_git_files(top, dest, source_file_transfer=SourceFileTransfer.copy_git_others)
+    assert dest.joinpath("untracked").exists()
+    assert dest.joinpath("sub/subuntracked").exists()
+
+    dest = tmp_path / "more"
+    mkosi.copy_git_files(top, dest, source_file_transfer=SourceFileTransfer.copy_git_more)
+    assert dest.joinpath(".git/HEAD").exists()
+    assert dest.joinpath("sub/.git").exists()
+    assert not dest.joinpath("untracked").exists()
+
+
+@pytest.mark.skipif(shutil.which("xz") is None, reason="xz not installed")
+def test_open_output_stream(tmp_path: Path) -> None:
+    config = cast(MkosiConfig, argparse.Namespace(compress_output="xz", output_format=OutputFormat.tar))
+    data = b"archive" * 100000
+
+    with mkosi.open_output_stream(config, tmp_path / "image.tar") as f:
+        subprocess.run(["cat"], input=data, stdout=f, check=True)
+
+    assert not (tmp_path / "image.tar").exists()
+    compressed = tmp_path / "image.tar.xz"
+    assert lzma.decompress(compressed.read_bytes()) == data
+    assert sha256_file(compressed) == hashlib.sha256(compressed.read_bytes()).hexdigest()
+
+
+def test_build_cache_trees(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.chdir(tmp_path)
+    config = mkosi.load_args(mkosi.parse_args(["--distribution", "fedora", "build"])["default"])
+    config = dataclasses.replace(config, build_script=tmp_path / "mkosi.build")
+    state = MkosiState(config=config, workspace=tmp_path / "workspace", cache=tmp_path / "cache",
+                       do_run_build_script=False, machine_id="0" * 32, for_cache=False)
+    state.workspace.mkdir()
+
+    def build_image(state: MkosiState) -> None:
+        state.root.mkdir()
+        (state.root / "stage").write_text(f"{state.do_run_build_script} {os.getpid()}")
+
+    def save_cache(state: MkosiState) -> None:
+        shutil.move(str(state.root), str(tmp_path / f"cache-{state.do_run_build_script}"))
+
+    monkeypatch.setattr(mkosi, "build_image", build_image)
+    monkeypatch.setattr(mkosi, "save_cache", save_cache)
+    mkosi.build_cache_trees(state)
+
+    # Both stages ran in their own process and workspace.
+    dev = (tmp_path / "cache-True/stage").read_text().split()
+    final = (tmp_path / "cache-False/stage").read_text().split()
+    assert dev[0] == "True" and final[0] == "False"
+    assert len({dev[1], final[1], str(os.getpid())}) == 3
+
+
+def fake_mount(*args: Any) -> ContextManager[Path]:
+    return contextlib.nullcontext(args[-1])
+
+
+def test_build_cache_trees_overlap(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.chdir(tmp_path)
+    config = mkosi.load_args(mkosi.parse_args(["--distribution", "fedora", "build"])["default"])
+    config = dataclasses.replace(config, build_script=tmp_path / "mkosi.build")
+    state = MkosiState(config=config, workspace=tmp_path / "workspace", cache=tmp_path / "cache",
+                       do_run_build_script=False, machine_id="0" * 32, for_cache=False)
+    state.workspace.mkdir()
+    state.cache.mkdir()
+    barrier = multiprocessing.get_context("fork").Barrier(2)
+
+    # Both stages have to be using the package cache at the same time to get past the barrier.
+    def build_image(state: MkosiState) -> None:
+        with mkosi.mount_cache(state):
+            barrier.wait(timeout=10)
+
+    monkeypatch.setattr(mkosi, "mount_overlay", fake_mount)
+    monkeypatch.setattr(mkosi, "mount_bind", fake_mount)
+    monkeypatch.setattr(mkosi, "build_image", build_image)
+    monkeypatch.setattr(mkosi, "save_cache", lambda state: None)
+    mkosi.build_cache_trees(state)
+
+
+def test_merge_package_cache(tmp_path: Path) -> None:
+    cache = tmp_path / "cache"
+    (cache / "metadata").mkdir(parents=True)
+    (cache / "metadata/repomd.xml").write_text("old")
+    (cache / "packages").mkdir()
+    (cache / "packages/a.rpm").write_text("a")
+
+    upper = tmp_path / "upper"
+    (upper / "metadata").mkdir(parents=True)
+    (upper / "metadata/repomd.xml").write_text("new")
+    (upper / "packages").mkdir()
+    (upper / "packages/b.rpm").write_text("b")
+    (upper / "latest").symlink_to("packages")
+
+    mkosi.merge_package_cache(upper, cache)
+
+    assert not upper.exists()
+    assert (cache / "metadata/repomd.xml").read_text() == "new"
+    assert (cache / "packages/a.rpm").read_text() == "a"
+    assert (cache / "packages/b.rpm").read_text() == "b"
+    assert os.readlink(cache / "latest") == "packages"
+
+
+def test_adopt_prepared_tree(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.chdir(tmp_path)
+    config = mkosi.load_args(mkosi.parse_args(["--distribution", "debian", "--remove-package", "gcc",
+                                               "build"])["default"])
+    state = MkosiState(config=config, workspace=tmp_path / "workspace", cache=tmp_path / "cache",
+                       do_run_build_script=False, machine_id="0" * 32, for_cache=False)
+    prepared = state.workspace / "final-prepare"
+    (prepared / "root/etc").mkdir(parents=True)
+    (prepared / "root/etc/os-release").write_text("ID=debian\n")
+    (prepared / "apt.conf").write_text(f'Dir "{prepared / "root"}";\n')
+    state.var_tmp().joinpath("leftover").write_text("")
+
+    tree = mkosi.PreparedTree(prepared, cached=False, checkpoint=Checkpoint.prepare)
+    assert mkosi.adopt_prepared_tree(state, tree) == (False, Checkpoint.prepare)
+    wait_for_trash()
+
+    assert (state.root / "etc/os-release").read_text() == "ID=debian\n"
+    assert (state.workspace / "var-tmp/leftover").exists()
+    # Package manager configuration refers to the prepared workspace, which is gone now.
+    assert not prepared.exists()
+    assert not (state.workspace / "apt.conf").exists()
+
+    # Package manager invocations of the final stage operate on the adopted root.
+    calls = []
+
+    def run(cmdline: List[str], env: Dict[str, str], **kwargs: Any) -> None:
+        calls.append(cmdline)
+        assert f'Dir "{state.root}";' in Path(env["APT_CONFIG"]).read_text()
+
+    monkeypatch.setattr(debian, "run", run)
+    monkeypatch.setattr(debian, "mount_api_vfs", lambda root: contextlib.nullcontext())
+    mkosi.remove_packages(state)
+    assert calls and "gcc" in calls[0]
+
+
+def test_postprocess_output(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.chdir(tmp_path)
+    config = mkosi.load_args(mkosi.parse_args(["--distribution", "fedora", "--format", "tar", "--checksum",
+                                               "--compress-output", "xz", "build"])["default"])
+    state = MkosiState(config=config, workspace=tmp_path / "workspace", cache=tmp_path / "cache",
+                       do_run_build_script=False, machine_id="0" * 32, for_cache=False)
+    state.workspace.mkdir()
+    data = {config.output.name: b"tar" * 1000, config.output_split_kernel.name: b"kernel" * 1000}
+    for name, content in data.items():
+        (state.staging / name).write_bytes(content)
+
+    mkosi.postprocess_output(state, Manifest(config), None)
+
+    sums = {}
+    for line in (state.staging / config.output_checksum.name).read_text().splitlines():
+        digest, name = line.split(" *")
+        sums[name] = digest
+
+    # Every output is compressed before it is hashed.
+    assert sorted(sums) == sorted(f"{name}.xz" for name in data)
+    for name, content in data.items():
+        compressed = state.staging / f"{name}.xz"
+        assert lzma.decompress(compressed.read_bytes()) == content
+        assert sums[compressed.name] == hashlib.sha256(compressed.read_bytes()).hexdigest()
+
+
+def test_postprocess_output_bmap(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.chdir(tmp_path)
+    config = mkosi.load_args(mkosi.parse_args(["--distribution", "fedora", "--format", "disk", "--checksum", "--bmap",
+                                               "build"])["default"])
+    state = MkosiState(config=config, workspace=tmp_path / "workspace", cache=tmp_path / "cache",
+                       do_run_build_script=False, machine_id="0" * 32, for_cache=False)
+    state.workspace.mkdir()
+    content = b"disk" * 1024 + bytes(8192) + b"end"
+    (state.staging / config.output.name).write_bytes(content)
+
+    mkosi.postprocess_output(state, Manifest(config), None)
+
+    # The image is made sparse, mapped and hashed in the same pass, without changing its contents.
+    image = state.staging / config.output.name
+    assert image.read_bytes() == content
+    assert sha256_file(image) == hashlib.sha256(content).hexdigest()
+    sums = (state.staging / config.output_checksum.name).read_text()
+    assert f"{hashlib.sha256(content).hexdigest()} *{config.output.name}\n" in sums
+    bmap = (state.staging / config.output_bmap.name).read_text()
+    assert "<MappedBlocksCount> 2 </MappedBlocksCount>" in bmap
+    assert f'<Range chksum="{hashlib.sha256(b"disk" * 1024).hexdigest()}"> 0 </Range>' in bmap
+
+
+def test_start_preparing_final_tree_interrupt(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.chdir(tmp_path)
+    config = mkosi.load_args(mkosi.parse_args(["--distribution", "fedora", "build"])["default"])
+    state = MkosiState(config=config, workspace=tmp_path / "workspace", cache=tmp_path / "cache",
+                       do_run_build_script=True, machine_id="0" * 32, for_cache=False)
+    state.workspace.mkdir()
+    monkeypatch.setattr(mkosi, "build_image", lambda state, prepare_only: time.sleep(60))
+
+    # A failure while the final tree is prepared interrupts the preparation instead of waiting for it.
+    start = time.monotonic()
+    with pytest.raises(RuntimeError):
+        with contextlib.ExitStack() as pipeline:
+            prepare = mkosi.start_preparing_final_tree(state, pipeline)
+            time.sleep(0.5)
+            raise RuntimeError("build script failed")
+
+    assert time.monotonic() - start < 30
+    with pytest.raises(BaseException):
+        prepare.result()
+
+
+def test_start_preparing_final_tree_overlap(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.chdir(tmp_path)
+    config = mkosi.load_args(mkosi.parse_args(["--distribution", "fedora", "build"])["default"])
+    state = MkosiState(config=config, workspace=tmp_path / "workspace", cache=tmp_path / "cache",
+                       do_run_build_script=True, machine_id="0" * 32, for_cache=False)
+    state.workspace.mkdir()
+    state.cache.mkdir()
+    barrier = multiprocessing.get_context("fork").Barrier(2)
+
+    # The development stage and the preparation of the final tree have to be using the package cache at the same
+    # time to get past the barrier.
+    def build_image(state: MkosiState, prepare_only: bool = False) -> None:
+        with mkosi.mount_cache(state):
+            barrier.wait(timeout=10)
+
+    monkeypatch.setattr(mkosi, "mount_overlay", fake_mount)
+    monkeypatch.setattr(mkosi, "mount_bind", fake_mount)
+    monkeypatch.setattr(mkosi, "build_image", build_image)
+
+    with contextlib.ExitStack() as pipeline:
+        prepare = mkosi.start_preparing_final_tree(state, pipeline)
+        build_image(state)
+        assert prepare.result() is None
+
+
+def test_source_ignore(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.chdir(tmp_path)
+    sources = tmp_path / "src"
+    for d in ("build", "lib/build", "lib/.git", "mkosi.cache", "lib/mkosi.cache"):
+        (sources / d).mkdir(parents=True)
+    (sources / "lib/build/main.c").write_text("")
+    monkeypatch.chdir(sources)
+
+    config = mkosi.load_args(mkosi.parse_args(["--distribution", "fedora", "--output-dir=build",
+                                               "--build-sources", os.fspath(sources), "build"])["default"])
+    target = tmp_path / "copy"
+    shutil.copytree(sources, target, ignore=mkosi.source_ignore(config))
+
+    # The directories mkosi uses are only left out at the top level of the sources, .git everywhere.
+    assert not (target / "build").exists()
+    assert not (target / "mkosi.cache").exists()
+    assert (target / "lib/build/main.c").exists()
+    assert (target / "lib/mkosi.cache").exists()
+    assert not (target / "lib/.git").exists()
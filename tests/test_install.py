@@ -1,11 +1,14 @@
 # SPDX-License-Identifier: LGPL-2.1+
 
 import filecmp
+import os
+import shutil
+import stat
 from pathlib import Path
 
 import pytest
 
-from mkosi.install import copy_file
+from mkosi.install import copy_file, copy_path, sync_path
 
 def test_copy_file(tmpdir: Path) -> None:
     dir_path = Path(tmpdir)
@@ -31,3 +34,108 @@ def test_copy_file(tmpdir: Path) -> None:
     file_2.write_text("Testing copying content from file_1 to file_2, with previous data.")
     copy_file(file_1, file_2)
     assert filecmp.cmp(file_1, file_2)
+
+
+def test_copy_path(tmpdir: Path) -> None:
+    src = Path(tmpdir) / "src"
+    dst = Path(tmpdir) / "dst"
+
+    for i in range(20):
+        d = src / f"dir{i}" / "sub"
+        d.mkdir(parents=True)
+        for j in range(10):
+            d.joinpath(f"file{j}").write_text(f"{i} {j}")
+        d.joinpath("link").symlink_to("file0")
+        os.utime(d, (0, 1000 + i))
+        os.utime(d.parent, (0, 2000 + i))
+    src.joinpath("dir0/sub/file0").chmod(0o600)
+
+    copy_path(src, dst, workers=4)
+
+    for i in range(20):
+        d = dst / f"dir{i}" / "sub"
+        assert d.joinpath("file9").read_text() == f"{i} 9"
+        assert os.readlink(d / "link") == "file0"
+        # Timestamps of directories must survive their children being copied in.
+        assert d.stat().st_mtime == 1000 + i
+        assert d.parent.stat().st_mtime == 2000 + i
+
+    assert stat.S_IMODE(dst.joinpath("dir0/sub/file0").stat().st_mode) == 0o600
+    assert sorted(p.name for p in dst.iterdir()) == sorted(p.name for p in src.iterdir())
+
+
+def test_copy_path_hardlinks_and_holes(tmpdir: Path) -> None:
+    src = Path(tmpdir) / "src"
+    dst = Path(tmpdir) / "dst"
+    src.joinpath("a").mkdir(parents=True)
+    src.joinpath("b").mkdir()
+
+    src.joinpath("a/file").write_text("hardlinked")
+    os.link(src / "a/file", src / "b/link")
+
+    with src.joinpath("sparse").open("wb") as f:
+        f.write(b"begin")
+        f.seek(64 * 1024 * 1024)
+        f.write(b"end")
+
+    copy_path(src, dst)
+
+    assert dst.joinpath("a/file").stat().st_ino == dst.joinpath("b/link").stat().st_ino
+    assert dst.joinpath("b/link").read_text() == "hardlinked"
+
+    sparse = dst.joinpath("sparse")
+    assert sparse.stat().st_size == src.joinpath("sparse").stat().st_size
+    assert filecmp.cmp(src / "sparse", sparse, shallow=False)
+    # Whether holes are preserved depends on the file system, but we should never allocate more than the source.
+    assert sparse.stat().st_blocks <= src.joinpath("sparse").stat().st_blocks
+
+
+def test_sync_path(tmpdir: Path) -> None:
+    src = Path(tmpdir) / "src"
+    dst = Path(tmpdir) / "dst"
+    index = Path(tmpdir) / "index.json"
+
+    src.joinpath("dir").mkdir(parents=True)
+    src.joinpath("dir/unchanged").write_text("unchanged")
+    src.joinpath("dir/changed").write_text("old")
+    src.joinpath("removed").write_text("removed")
+    src.joinpath("ignored").write_text("ignored")
+    src.joinpath("link").symlink_to("dir/unchanged")
+
+    ignore = shutil.ignore_patterns("ignored")
+    sync_path(src, dst, index, ignore=ignore)
+
+    assert dst.joinpath("dir/changed").read_text() == "old"
+    assert os.readlink(dst / "link") == "dir/unchanged"
+    assert not dst.joinpath("ignored").exists()
+    unchanged = dst.joinpath("dir/unchanged").stat()
+
+    src.joinpath("dir/changed").write_text("new")
+    os.utime(src / "dir/changed", ns=(0, unchanged.st_mtime_ns + 1_000_000_000))
+    src.joinpath("removed").unlink()
+    src.joinpath("added").write_text("added")
+    # Files that didn't come from the sources, e.g. build artifacts, are left alone.
+    dst.joinpath("artifact").write_text("artifact")
+
+    sync_path(src, dst, index, ignore=ignore)
+
+    assert dst.joinpath("dir/changed").read_text() == "new"
+    assert dst.joinpath("dir/changed").stat().st_mtime_ns == src.joinpath("dir/changed").stat().st_mtime_ns
+    assert dst.joinpath("added").read_text() == "added"
+    assert not dst.joinpath("removed").exists()
+    assert dst.joinpath("artifact").exists()
+    assert dst.joinpath("dir/unchanged").stat().st_ino == unchanged.st_ino
+    assert dst.joinpath("dir/unchanged").stat().st_mtime_ns == unchanged.st_mtime_ns
+
+    # Copies modified in the destination are refreshed, even though their source didn't change.
+    dst.joinpath("dir/unchanged").write_text("modified by the build")
+    os.utime(src / "dir", ns=(0, 1_000_000_000))
+    src_dir_mtime = src.joinpath("dir").stat().st_mtime_ns
+    changed = dst.joinpath("dir/changed").stat()
+
+    sync_path(src, dst, index, ignore=ignore)
+
+    assert dst.joinpath("dir/unchanged").read_text() == "unchanged"
+    # Directories keep the modification time of their source, even though an entry was rewritten in them.
+    assert dst.joinpath("dir").stat().st_mtime_ns == src_dir_mtime
+    assert dst.joinpath("dir/changed").stat().st_ino == changed.st_ino
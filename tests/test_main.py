@@ -0,0 +1,42 @@
+# SPDX-License-Identifier: LGPL-2.1+
+
+import argparse
+import os
+from pathlib import Path
+
+import pytest
+
+import mkosi.__main__
+from mkosi import parse_args
+from mkosi.remove import unlink_in_background
+
+
+def fail(*args: object) -> None:
+    raise AssertionError("The job ran in the calling process")
+
+
+def test_run_job_in_process(
+    tmp_path: Path,
+    monkeypatch: pytest.MonkeyPatch,
+    capfd: pytest.CaptureFixture[str],
+) -> None:
+    monkeypatch.chdir(tmp_path)
+    args = parse_args(["--distribution", "fedora", "--directory", os.fspath(tmp_path), "summary"])
+
+    # The job runs in a spawned process, which imports mkosi afresh and doesn't see anything patched here. Its
+    # changes to the working directory stay in that process as well.
+    monkeypatch.setattr(mkosi.__main__, "run_verb", fail)
+    monkeypatch.chdir("/")
+    mkosi.__main__.run_job_in_process(args, "default")
+
+    assert "Distribution: fedora" in capfd.readouterr().out
+    assert os.getcwd() == "/"
+
+
+def test_run_job_waits_for_trash(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    (tmp_path / "output/tree").mkdir(parents=True)
+    monkeypatch.setattr(mkosi.__main__, "run_verb", lambda a: unlink_in_background(tmp_path / "output/tree"))
+
+    # Job processes don't run atexit handlers, so the job finishes its removals itself.
+    mkosi.__main__.run_job("default", argparse.Namespace(directory=None), multiple=True)
+    assert list((tmp_path / "output").iterdir()) == []
@@ -0,0 +1,173 @@
+# SPDX-License-Identifier: LGPL-2.1+
+
+import argparse
+import io
+import json
+import subprocess
+from pathlib import Path
+from typing import Any, Dict, List, cast
+
+import pytest
+
+import mkosi.manifest
+from mkosi.backend import ManifestFormat, MkosiConfig
+from mkosi.manifest import Manifest, diff_manifests, load_manifest, write_manifest_diff
+
+
+def test_record_rpm_packages(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    records = [
+        ["bash-5.1-1.fc36.x86_64", "bash-5.1-1.fc36.src.rpm", "bash", "x86_64", "100", "1",
+         "* Mon Jan 01 2022 Someone\n- Update to 5.1\n\n* Sun Dec 12 2021 Someone\n- Rebuild\n\n"],
+        ["bash-doc-5.1-1.fc36.noarch", "bash-5.1-1.fc36.src.rpm", "bash-doc", "noarch", "20", "1",
+         "* Mon Jan 01 2022 Someone\n- Update to 5.1\n\n"],
+        ["gpg-pubkey-45719a39-5f2c0192", "(none)", "gpg-pubkey", "(none)", "0", "1", ""],
+    ]
+    calls: List[List[str]] = []
+
+    def run(cmdline: List[str], **kwargs: Any) -> "subprocess.CompletedProcess[str]":
+        calls.append(cmdline)
+        stdout = "".join("\x1f".join(r) + "\x1e" for r in reversed(records))
+        return subprocess.CompletedProcess(cmdline, 0, stdout=stdout)
+
+    monkeypatch.setattr(mkosi.manifest, "run", run)
+
+    config = argparse.Namespace(manifest_format=[ManifestFormat.changelog], base_image=None)
+    manifest = Manifest(cast(MkosiConfig, config))
+    manifest.record_rpm_packages(tmp_path)
+
+    # Everything, including the changelogs, is queried at once.
+    assert len(calls) == 1
+    assert [p.name for p in manifest.packages] == ["bash", "bash-doc", "gpg-pubkey"]
+    assert [p.size for p in manifest.packages] == [100, 20, 0]
+
+    bash = manifest.source_packages["bash-5.1-1.fc36.src.rpm"]
+    assert [p.name for p in bash.packages] == ["bash", "bash-doc"]
+    assert bash.changelog == "* Mon Jan 01 2022 Someone\n- Update to 5.1\n\n* Sun Dec 12 2021 Someone\n- Rebuild"
+    assert manifest.source_packages["(none)"].changelog == ""
+
+
+def test_record_deb_packages(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    packages = [
+        ["libc6", "glibc", "2.36-1", "amd64", "100", "1", "2.36-1"],
+        ["libc-bin", "glibc", "2.36-1", "amd64", "10", "1", "2.36-1"],
+        ["bash", "bash", "5.2-1", "amd64", "20", "1", "5.2-1"],
+    ]
+    fetched: List[str] = []
+
+    def run(cmdline: List[str], **kwargs: Any) -> "subprocess.CompletedProcess[str]":
+        if cmdline[0] == "dpkg-query":
+            stdout = "".join("\t".join(p) + "\n" for p in packages)
+        else:
+            fetched.append(cmdline[cmdline.index("changelog") + 1])
+            stdout = f"{cmdline[cmdline.index('changelog') + 1]} changelog\n"
+        return subprocess.CompletedProcess(cmdline, 0, stdout=stdout)
+
+    monkeypatch.setattr(mkosi.manifest, "run", run)
+
+    config = argparse.Namespace(
+        manifest_format=[ManifestFormat.changelog],
+        base_image=None,
+        cache_path=tmp_path / "cache",
+        with_docs=True,
+    )
+    (tmp_path / "cache").mkdir()
+
+    manifest = Manifest(cast(MkosiConfig, config))
+    manifest.record_deb_packages(tmp_path)
+
+    assert sorted(fetched) == ["bash", "libc-bin"]
+    assert list(manifest.source_packages) == ["bash", "glibc"]
+    assert manifest.source_packages["glibc"].changelog == "libc-bin changelog"
+    assert [p.name for p in manifest.source_packages["glibc"].packages] == ["libc-bin", "libc6"]
+
+    # The changelogs are cached by source package and version.
+    packages[2][2] = packages[2][6] = "5.2-2"
+    fetched.clear()
+    manifest = Manifest(cast(MkosiConfig, config))
+    manifest.record_deb_packages(tmp_path)
+
+    assert fetched == ["bash"]
+    assert manifest.source_packages["glibc"].changelog == "libc-bin changelog"
+
+
+def test_manifest_diff(tmp_path: Path) -> None:
+    def package(name: str, version: str, size: int) -> Dict[str, Any]:
+        return {"type": "deb", "name": name, "version": version, "architecture": "amd64", "size": size}
+
+    old = {"packages": [package("bash", "5.1", 100), package("dash", "0.5", 50), package("zsh", "5.8", 10)]}
+    new = {"packages": [package("bash", "5.2", 150), package("zsh", "5.8", 10), package("fish", "3.5", 70)]}
+
+    (tmp_path / "old.manifest").write_text(json.dumps(old))
+    assert load_manifest(tmp_path / "old.manifest") == old
+    assert load_manifest(tmp_path / "missing.manifest") is None
+
+    changes = diff_manifests(old, new)
+    assert [(c.name, c.old_version, c.new_version, c.size_delta) for c in changes] == [
+        ("bash", "5.1", "5.2", 50),
+        ("dash", "0.5", None, -50),
+        ("fish", None, "3.5", 70),
+    ]
+
+    out = io.StringIO()
+    write_manifest_diff(old, new, out)
+    assert out.getvalue() == """\
+Packages: 3 (+0)
+Size:     230 (+70)
+
+Added: 1 (+70 bytes)
+  + fish 3.5 (amd64), +70 bytes
+
+Removed: 1 (-50 bytes)
+  - dash 0.5 (amd64), -50 bytes
+
+Changed: 1 (+50 bytes)
+  ~ bash 5.1 -> 5.2 (amd64), +50 bytes
+"""
+
+
+def test_record_pkg_packages(tmp_path: Path) -> None:
+    for name, version, base in (("linux", "6.0-1", "linux"), ("linux-headers", "6.0-1", "linux")):
+        desc = tmp_path / "var/lib/pacman/local" / f"{name}-{version}" / "desc"
+        desc.parent.mkdir(parents=True)
+        desc.write_text(
+            f"%NAME%\n{name}\n\n%VERSION%\n{version}\n\n%BASE%\n{base}\n\n%DESC%\nThe kernel\n\n"
+            "%ARCH%\nx86_64\n\n%INSTALLDATE%\n1665000000\n\n%SIZE%\n1000\n\n%DEPENDS%\ncoreutils\nkmod\n\n"
+        )
+
+    config = argparse.Namespace(manifest_format=[ManifestFormat.json], base_image=None)
+    manifest = Manifest(cast(MkosiConfig, config))
+    manifest.record_pkg_packages(tmp_path)
+
+    assert [(p.name, p.version, p.architecture, p.size) for p in manifest.packages] == [
+        ("linux", "6.0-1", "x86_64", 1000),
+        ("linux-headers", "6.0-1", "x86_64", 1000),
+    ]
+    assert [p.name for p in manifest.source_packages["linux"].packages] == ["linux", "linux-headers"]
+
+
+def test_record_ebuild_packages(tmp_path: Path) -> None:
+    for category, pf, slot in (
+        ("app-shells", "bash-5.1_p16-r1", "0"),
+        ("dev-lang", "python-3.11.0", "3.11/3.11"),
+        ("dev-lang", "python-3.10.8-r1", "3.10"),
+        ("media-fonts", "font-adobe-100dpi-1.0.3-r3", "0"),
+    ):
+        entry = tmp_path / "var/db/pkg" / category / pf
+        entry.mkdir(parents=True)
+        (entry / "CATEGORY").write_text(f"{category}\n")
+        (entry / "PF").write_text(f"{pf}\n")
+        (entry / "SLOT").write_text(f"{slot}\n")
+        (entry / "SIZE").write_text("42\n")
+    (tmp_path / "var/db/pkg/app-shells/-MERGING-zsh-5.9").mkdir()
+
+    config = argparse.Namespace(manifest_format=[ManifestFormat.json], base_image=None)
+    manifest = Manifest(cast(MkosiConfig, config))
+    manifest.record_ebuild_packages(tmp_path)
+
+    assert [(p.name, p.version, p.size) for p in manifest.packages] == [
+        ("app-shells/bash", "5.1_p16-r1", 42),
+        ("dev-lang/python:3.10", "3.10.8-r1", 42),
+        ("dev-lang/python:3.11", "3.11.0", 42),
+        ("media-fonts/font-adobe-100dpi", "1.0.3-r3", 42),
+    ]
+    assert len(manifest.source_packages["dev-lang/python"].packages) == 2
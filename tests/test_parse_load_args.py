@@ -38,6 +38,7 @@ def test_parse_load_verb() -> None:
     assert parse(["serve"]).verb == Verb.serve
     assert parse(["build"]).verb == Verb.build
     assert parse(["shell"]).verb == Verb.shell
+    assert parse(["manifest-diff"]).verb == Verb.manifest_diff
     assert parse(["boot"]).verb == Verb.boot
     assert parse(["--bootable", "qemu"]).verb == Verb.qemu
     with pytest.raises(SystemExit):
@@ -108,4 +109,8 @@ def test_shell_boot() -> None:
 
 def test_compression() -> None:
     assert not parse(["--format", "disk", "--compress-output", "False"]).compress_output
+    assert parse(["--format", "disk", "--compress-output", "zstd:level=3"]).compress_output == "zstd:level=3"
+
+    with pytest.raises(SystemExit):
+        parse(["--format", "disk", "--compress-output", "zstd:level=high"])
 
@@ -0,0 +1,49 @@
+# SPDX-License-Identifier: LGPL-2.1+
+
+import os
+from pathlib import Path
+
+import pytest
+
+from mkosi import probe
+
+
+def test_cached_probe(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    binary = tmp_path / "bin/frobnicate"
+    binary.parent.mkdir()
+    binary.write_text("#!/bin/sh\n")
+    binary.chmod(0o755)
+
+    monkeypatch.setenv("PATH", os.fspath(binary.parent))
+    monkeypatch.setenv("XDG_CACHE_HOME", os.fspath(tmp_path / "cache"))
+    monkeypatch.setattr(probe, "which_cache", {})
+    monkeypatch.setattr(probe, "probe_cache", {})
+    monkeypatch.setattr(probe, "probe_cache_file", None)
+
+    calls = []
+
+    def knows_arg() -> bool:
+        calls.append(1)
+        return True
+
+    assert probe.which("frobnicate") == os.fspath(binary)
+    assert probe.cached_probe("frobnicate", "knows-arg --foo", knows_arg) is True
+    assert probe.cached_probe("frobnicate", "knows-arg --foo", knows_arg) is True
+    assert len(calls) == 1
+
+    # A new invocation reads the result from disk.
+    monkeypatch.setattr(probe, "probe_cache", {})
+    monkeypatch.setattr(probe, "probe_cache_file", None)
+    assert probe.cached_probe("frobnicate", "knows-arg --foo", knows_arg) is True
+    assert len(calls) == 1
+
+    # Changing the binary invalidates the results.
+    binary.write_text("#!/bin/sh\nexit 0\n")
+    monkeypatch.setattr(probe, "probe_cache", {})
+    monkeypatch.setattr(probe, "probe_cache_file", None)
+    assert probe.cached_probe("frobnicate", "knows-arg --foo", knows_arg) is True
+    assert len(calls) == 2
+
+    # Missing binaries are not cached.
+    assert probe.cached_probe("missing", "version", lambda: 0) == 0
+    assert probe.which("missing") is None
@@ -0,0 +1,120 @@
+# SPDX-License-Identifier: LGPL-2.1+
+
+import fcntl
+import os
+from pathlib import Path
+
+import pytest
+
+from mkosi import remove
+
+
+@pytest.fixture(autouse=True)
+def trash(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(remove, "trash_dirs", {})
+    monkeypatch.setattr(remove, "trash_locks", {})
+    monkeypatch.setattr(remove, "trash_futures", [])
+
+
+def make_tree(path: Path) -> None:
+    (path / "a/b").mkdir(parents=True)
+    (path / "a/b/file").write_text("data")
+    (path / "a/link").symlink_to("b")
+
+
+def test_unlink_try_hard(tmp_path: Path) -> None:
+    make_tree(tmp_path / "tree")
+    outside = tmp_path / "outside"
+    outside.mkdir()
+    (outside / "keep").write_text("")
+    (tmp_path / "tree/a/escape").symlink_to(outside)
+
+    remove.unlink_try_hard(tmp_path / "tree")
+    remove.unlink_try_hard(tmp_path / "missing")
+
+    assert not (tmp_path / "tree").exists()
+    # Symlinks are removed, not followed.
+    assert (outside / "keep").exists()
+
+
+def test_unlink_in_background(tmp_path: Path) -> None:
+    parent = tmp_path / "parent"
+    make_tree(parent / "tree")
+    (parent / "file").write_text("")
+
+    remove.unlink_in_background(parent / "tree")
+    remove.unlink_in_background(parent / "file")
+    remove.unlink_in_background(parent / "missing")
+
+    # The paths are gone at once, only the trash directory is left.
+    entries = list(parent.iterdir())
+    assert len(entries) == 1
+    assert entries[0].name.startswith(".mkosi-trash-")
+
+    remove.wait_for_trash()
+    assert list(parent.iterdir()) == []
+    assert not remove.trash_dirs
+
+
+def test_unlink_in_background_trash_below(tmp_path: Path) -> None:
+    workspace = tmp_path / "workspace"
+    make_tree(workspace / "root")
+
+    remove.unlink_in_background(workspace / "root")
+    trash = next(workspace.iterdir())
+
+    # Waiting for trash below an unrelated directory doesn't do anything.
+    remove.wait_for_trash(tmp_path / "other")
+    assert trash.exists()
+
+    # Removing the directory that contains the trash directory finishes the pending removals first.
+    remove.unlink_in_background(workspace)
+    assert not workspace.exists()
+    remove.wait_for_trash()
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_empty_directory(tmp_path: Path) -> None:
+    installdir = tmp_path / "installdir"
+    make_tree(installdir)
+    (installdir / "file").write_text("")
+
+    remove.empty_directory(installdir)
+
+    # The directory is empty right away, the trash directory is created next to it.
+    assert list(installdir.iterdir()) == []
+    assert [p.name.startswith(".mkosi-trash-") for p in tmp_path.iterdir() if p != installdir] == [True]
+
+    remove.wait_for_trash()
+    assert list(tmp_path.iterdir()) == [installdir]
+
+    remove.empty_directory(tmp_path / "missing")
+
+
+def test_remove_stale_trash(tmp_path: Path) -> None:
+    stale = tmp_path / ".mkosi-trash-stale"
+    make_tree(stale / "0-tree")
+    # A trash directory of another mkosi process that is still removing things.
+    other = tmp_path / ".mkosi-trash-other"
+    make_tree(other / "0-tree")
+    fd = os.open(other, os.O_RDONLY | os.O_DIRECTORY)
+    fcntl.flock(fd, fcntl.LOCK_SH)
+    # And one of our own.
+    make_tree(tmp_path / "tree")
+    remove.unlink_in_background(tmp_path / "tree")
+    (ours,) = remove.trash_dirs.values()
+
+    try:
+        remove.remove_stale_trash([tmp_path, tmp_path / "missing"])
+        assert not stale.exists()
+        assert ours.exists()
+        remove.wait_for_trash()
+        assert (other / "0-tree/a/b/file").exists()
+        assert not ours.exists()
+    finally:
+        os.close(fd)
+
+    # Once the other process is gone, its trash directory is stale as well.
+    remove.remove_stale_trash([tmp_path])
+    remove.wait_for_trash()
+    assert list(tmp_path.iterdir()) == []
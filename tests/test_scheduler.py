@@ -0,0 +1,43 @@
+# SPDX-License-Identifier: LGPL-2.1+
+
+import concurrent.futures
+import threading
+from typing import List
+
+import pytest
+
+from mkosi.scheduler import DependencyFailed, run_graph, topological_order
+
+
+def test_topological_order() -> None:
+    graph = {"sysext": ["base"], "base": [], "other": [], "portable": ["base", "sysext"]}
+    assert topological_order(graph) == ["base", "other", "sysext", "portable"]
+
+    with pytest.raises(ValueError):
+        topological_order({"a": ["b"], "b": ["a"]})
+
+    with pytest.raises(ValueError):
+        topological_order({"a": ["missing"]})
+
+
+def test_run_graph() -> None:
+    graph = {"base": [], "sysext": ["base"], "broken": [], "needs-broken": ["broken"], "other": []}
+    ran: List[str] = []
+    lock = threading.Lock()
+
+    def build(node: str) -> None:
+        with lock:
+            ran.append(node)
+        if node == "broken":
+            raise RuntimeError("broken")
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+        results = run_graph(graph, build, executor)
+
+    assert sorted(ran) == ["base", "broken", "other", "sysext"]
+    assert ran.index("base") < ran.index("sysext")
+    assert results["base"] is None
+    assert results["sysext"] is None
+    assert results["other"] is None
+    assert isinstance(results["broken"], RuntimeError)
+    assert isinstance(results["needs-broken"], DependencyFailed)
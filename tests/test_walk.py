@@ -0,0 +1,108 @@
+# SPDX-License-Identifier: LGPL-2.1+
+
+import errno
+import glob
+import os
+import shutil
+from pathlib import Path
+from typing import Any, List, Optional
+
+import pytest
+
+from mkosi.walk import DiskUsageVisitor, GlobVisitor, TreeVisitor, walk_tree
+
+
+class RecordingVisitor(TreeVisitor):
+    def __init__(self) -> None:
+        self.paths: List[str] = []
+
+    def visit(self, state: Any, path: str, entry: os.DirEntry[str]) -> Any:
+        self.paths.append(path)
+        return True
+
+
+def test_walk_tree(tmp_path: Path) -> None:
+    root = tmp_path / "root"
+    for d in ["var/lib/dnf", "var/log", "usr/share/doc/foo", "usr/bin"]:
+        (root / d).mkdir(parents=True)
+    for f in ["var/lib/dnf/history", "var/log/dnf.log", "var/log/dnf.rpm.log", "var/log/.dnf.hidden",
+              "usr/share/doc/foo/README", "usr/bin/bash"]:
+        (root / f).write_bytes(b"x" * 5000)
+    (tmp_path / "outside").mkdir()
+    (tmp_path / "outside/dnf.log").write_text("")
+    (root / "var/log/escape").symlink_to(tmp_path / "outside")
+
+    patterns = ["/var/lib/dnf", "/var/log/dnf.*", "usr/share/doc/*/README", "/var/log/*/dnf.log", "/nonexistent"]
+    metadata = GlobVisitor(patterns)
+    usage = DiskUsageVisitor()
+    recording = RecordingVisitor()
+    walk_tree(root, [metadata, usage, recording])
+
+    # Everything matches what glob.glob() finds, except that symlinks out of the tree are not followed.
+    expected = {os.path.relpath(p, root) for pattern in patterns for p in glob.glob(f"{root}/{pattern.lstrip('/')}")}
+    assert expected - set(metadata.matches) == {"var/log/escape/dnf.log"}
+    assert sorted(metadata.matches) == ["usr/share/doc/foo/README", "var/lib/dnf", "var/log/dnf.log",
+                                        "var/log/dnf.rpm.log"]
+
+    assert usage.size == sum(os.lstat(os.path.join(d, f)).st_blocks * 512
+                             for d, _, files in os.walk(root) for f in files)
+    assert "var/log/escape" in recording.paths
+    assert not any(p.startswith("var/log/escape/") for p in recording.paths)
+
+
+def test_walk_tree_prunes(tmp_path: Path) -> None:
+    (tmp_path / "a/b/c").mkdir(parents=True)
+    (tmp_path / "x/y/z").mkdir(parents=True)
+
+    class CountingGlobVisitor(GlobVisitor):
+        visited: List[str] = []
+
+        def visit(self, state: Any, path: str, entry: os.DirEntry[str]) -> Any:
+            self.visited.append(path)
+            return super().visit(state, path, entry)
+
+    visitor = CountingGlobVisitor(["a/b"])
+    walk_tree(tmp_path, [visitor])
+
+    # Only the directories that can contain a match are read, and nothing below the match.
+    assert visitor.matches == ["a/b"]
+    assert sorted(visitor.visited) == ["a", "a/b", "x"]
+
+    # Visitors that aren't interested in anything don't cause a walk at all.
+    walk_tree(tmp_path / "nonexistent", [GlobVisitor([])])
+
+
+def test_walk_tree_replaced_by_symlink(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    (tmp_path / "root/a/b").mkdir(parents=True)
+    (tmp_path / "root/c").mkdir()
+    (tmp_path / "outside").mkdir()
+    (tmp_path / "outside/secret").write_text("")
+
+    class ReplacingVisitor(RecordingVisitor):
+        def visit(self, state: Any, path: str, entry: os.DirEntry[str]) -> Any:
+            if path == "a":
+                # Replace the directory after it was scanned but before it is entered.
+                shutil.rmtree(tmp_path / "root/a")
+                os.symlink(tmp_path / "outside", tmp_path / "root/a")
+            return super().visit(state, path, entry)
+
+    visitor = ReplacingVisitor()
+    walk_tree(tmp_path / "root", [visitor])
+
+    # The symlink is skipped instead of aborting the walk or being followed.
+    assert sorted(visitor.paths) == ["a", "c"]
+
+    # Depending on the kernel, opening a symlink with O_DIRECTORY and O_NOFOLLOW fails with ENOTDIR or ELOOP.
+    real_open = os.open
+
+    def open_eloop(path: str, flags: int, mode: int = 0o777, *, dir_fd: Optional[int] = None) -> int:
+        if path == "a":
+            raise OSError(errno.ELOOP, os.strerror(errno.ELOOP), path)
+        return real_open(path, flags, mode, dir_fd=dir_fd)
+
+    (tmp_path / "root/a").unlink()
+    (tmp_path / "root/a/b").mkdir(parents=True)
+    monkeypatch.setattr(os, "open", open_eloop)
+    visitor = RecordingVisitor()
+    walk_tree(tmp_path / "root", [visitor])
+    assert sorted(visitor.paths) == ["a", "c"]